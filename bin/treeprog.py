@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+import os
+import sys
+
+# this script is named like the package: import the package, not itself
+if sys.path and os.path.abspath(sys.path[0]) == os.path.dirname(os.path.abspath(__file__)):
+    del sys.path[0]
+
+from treeprog import server  # noqa: E402
+
+COMMANDS = {
+    "serve": server.main,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print(f"usage: treeprog {{{','.join(COMMANDS)}}} ...", file=sys.stderr)
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+import os
+import xml.etree.ElementTree as ET
+from collections.abc import Mapping
+from typing import Any, Iterator, List, Optional
+
+# A node is any hashable object with `children` (left to right), `parent`
+# (None at the root), `root`, `name` and `payload`, equal to the other views
+# of the same node; AlgoTree nodes qualify as they are. Nodes may also give
+# hints the evaluators use when present: `depth`, an int, and `tree_index`,
+# the `TreeIndex` of their tree (see `shared.ArrayNode`).
+
+
+def depth(node: Any) -> int:
+    """
+    Args:
+        node: A node.
+
+    Returns:
+        The number of ancestors of `node`: its `depth` hint if it has one.
+    """
+    hint = getattr(node, "depth", None)
+    if isinstance(hint, int):
+        return hint
+    d = 0
+    parent = node.parent
+    while parent is not None:
+        d += 1
+        parent = parent.parent
+    return d
+
+
+def siblings(node: Any) -> List[Any]:
+    """
+    Args:
+        node: A node.
+
+    Returns:
+        The other children of the parent of `node`, left to right.
+    """
+    index = getattr(node, "tree_index", None)
+    if index is not None:
+        return index.siblings(node)
+    parent = node.parent
+    if parent is None:
+        return []
+    nodes = list(parent.children)
+    nodes.remove(node)
+    return nodes
+
+
+def ancestors(node: Any) -> List[Any]:
+    """
+    Args:
+        node: A node.
+
+    Returns:
+        The ancestors of `node`, from its parent up to the root.
+    """
+    index = getattr(node, "tree_index", None)
+    if index is not None:
+        return list(index.ancestors(node))
+    nodes = []
+    parent = node.parent
+    while parent is not None:
+        nodes.append(parent)
+        parent = parent.parent
+    return nodes
+
+
+def descendants(node: Any) -> List[Any]:
+    """
+    Args:
+        node: A node.
+
+    Returns:
+        The descendants of `node`, in preorder.
+    """
+    index = getattr(node, "tree_index", None)
+    if index is not None:
+        return list(index.descendants(node))
+    nodes = []
+    stack = list(reversed(node.children))
+    while stack:
+        child = stack.pop()
+        nodes.append(child)
+        stack.extend(reversed(child.children))
+    return nodes
+
+
+class JsonNode:
+    """
+    View of a value nested in dicts and lists (such as parsed JSON) as a
+    node.
+
+    By default every entry of a dict or list is a child, named by its key or
+    position, whose payload is the entry's value; scalars are leaves. With
+    `children_key`, the data is a tree of records instead (the format of
+    `TreeNode.to_dict`): the children of a record are the records listed
+    under `children_key`, and its name and payload are read from
+    `name_key` and `payload_key`.
+
+    A node is identified by the container holding its value and its key in
+    it, so views of the same entry are equal.
+
+    Use `JsonNode.tree` to make the root.
+    """
+    __slots__ = ("value", "key", "container", "parent", "depth", "root", "schema")
+
+    def __init__(self, value: Any, key: Any, container: Any, parent: Optional["JsonNode"],
+                 depth: int, root: Optional["JsonNode"], schema: Optional[tuple]):
+        self.value = value
+        self.key = key
+        self.container = container
+        self.parent = parent
+        self.depth = depth
+        self.root = root if root is not None else self
+        self.schema = schema
+
+    @classmethod
+    def tree(cls, data: Any, children_key: Optional[str] = None, name_key: str = "name",
+             payload_key: str = "payload") -> "JsonNode":
+        """
+        Args:
+            data: The nested dicts and lists.
+            children_key: Key of the children of a record, or None if every
+                entry is a child.
+            name_key: Key of the name of a record.
+            payload_key: Key of the payload of a record.
+
+        Returns:
+            The root node.
+        """
+        schema = (children_key, name_key, payload_key) if children_key is not None else None
+        return cls(data, None, None, None, 0, None, schema)
+
+    @property
+    def children(self) -> List["JsonNode"]:
+        value = self.value
+        if self.schema is not None:
+            items = value.get(self.schema[0], ()) if isinstance(value, dict) else ()
+            pairs = enumerate(items)
+        elif isinstance(value, dict):
+            items, pairs = value, value.items()
+        elif isinstance(value, list):
+            items, pairs = value, enumerate(value)
+        else:
+            return []
+        depth, root, schema = self.depth + 1, self.root, self.schema
+        return [JsonNode(v, k, items, self, depth, root, schema) for k, v in pairs]
+
+    @property
+    def name(self) -> Any:
+        if self.schema is not None:
+            return self.value.get(self.schema[1]) if isinstance(self.value, dict) else None
+        return self.key
+
+    @property
+    def payload(self) -> Any:
+        if self.schema is not None:
+            return self.value.get(self.schema[2]) if isinstance(self.value, dict) else None
+        return self.value
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, JsonNode):
+            return False
+        if self.container is None:
+            return other.container is None and other.value is self.value
+        return other.container is self.container and other.key == self.key
+
+    def __hash__(self) -> int:
+        if self.container is None:
+            return id(self.value)
+        return hash((id(self.container), self.key))
+
+    def __repr__(self) -> str:
+        return f"JsonNode({self.key!r})"
+
+
+class XmlNode:
+    """
+    View of an `xml.etree.ElementTree` element as a node: its children are
+    its subelements, its name is its tag and its payload is its `attrib`
+    dict. Views of the same element are equal.
+
+    Use `XmlNode.tree` to make the root.
+    """
+    __slots__ = ("element", "parent", "depth", "root")
+
+    def __init__(self, element: ET.Element, parent: Optional["XmlNode"], depth: int,
+                 root: Optional["XmlNode"]):
+        self.element = element
+        self.parent = parent
+        self.depth = depth
+        self.root = root if root is not None else self
+
+    @classmethod
+    def tree(cls, element: Any) -> "XmlNode":
+        """
+        Args:
+            element: An element, or an `ElementTree`.
+
+        Returns:
+            The root node.
+        """
+        if isinstance(element, ET.ElementTree):
+            element = element.getroot()
+        return cls(element, None, 0, None)
+
+    @property
+    def children(self) -> List["XmlNode"]:
+        depth, root = self.depth + 1, self.root
+        return [XmlNode(child, self, depth, root) for child in self.element]
+
+    @property
+    def name(self) -> str:
+        return self.element.tag
+
+    @property
+    def payload(self) -> dict:
+        return self.element.attrib
+
+    @property
+    def text(self) -> Optional[str]:
+        return self.element.text
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, XmlNode) and other.element is self.element
+
+    def __hash__(self) -> int:
+        return id(self.element)
+
+    def __repr__(self) -> str:
+        return f"XmlNode({self.element.tag!r})"
+
+
+class FileNode:
+    """
+    View of a directory tree as a node: a directory's children are its
+    entries, sorted by name, and files are leaves. The name is the entry's
+    name and the payload a `FileStat` of it. Symbolic links are not
+    followed into, and directories that cannot be read have no children.
+
+    A directory is listed (with `os.scandir`) the first time its children
+    are read, and its child views are kept, so every node is listed at most
+    once per tree. Views of the same path are equal.
+
+    Use `FileNode.tree` to make the root.
+    """
+    __slots__ = ("path", "entry", "parent", "depth", "root", "_children")
+
+    def __init__(self, path: str, entry: Optional[os.DirEntry], parent: Optional["FileNode"],
+                 depth: int, root: Optional["FileNode"]):
+        self.path = path
+        self.entry = entry
+        self.parent = parent
+        self.depth = depth
+        self.root = root if root is not None else self
+        self._children: Optional[List[FileNode]] = None
+
+    @classmethod
+    def tree(cls, path: str) -> "FileNode":
+        """
+        Args:
+            path: Path of the root directory.
+
+        Returns:
+            The root node.
+        """
+        return cls(os.path.abspath(path), None, None, 0, None)
+
+    @property
+    def is_dir(self) -> bool:
+        if self.entry is None:
+            return os.path.isdir(self.path)
+        return self.entry.is_dir(follow_symlinks=False)
+
+    @property
+    def children(self) -> List["FileNode"]:
+        if self._children is None:
+            children = []
+            if self.is_dir:
+                try:
+                    with os.scandir(self.path) as entries:
+                        found = sorted(entries, key=lambda entry: entry.name)
+                except OSError:
+                    found = []
+                depth, root = self.depth + 1, self.root
+                children = [FileNode(entry.path, entry, self, depth, root) for entry in found]
+            self._children = children
+        return self._children
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path) or self.path
+
+    @property
+    def payload(self) -> "FileStat":
+        return FileStat(self)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, FileNode) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    def __repr__(self) -> str:
+        return f"FileNode({self.path!r})"
+
+
+class FileStat(Mapping):
+    """
+    Read-only mapping of a file's `path`, `is_dir`, `size` and `mtime`. The
+    file is only stat-ed when `size` or `mtime` is read (`os.DirEntry`
+    caches the result).
+    """
+    __slots__ = ("node",)
+
+    KEYS = ("path", "is_dir", "size", "mtime")
+
+    def __init__(self, node: FileNode):
+        self.node = node
+
+    def __getitem__(self, key: str) -> Any:
+        node = self.node
+        if key == "path":
+            return node.path
+        if key == "is_dir":
+            return node.is_dir
+        if key not in self.KEYS:
+            raise KeyError(key)
+        try:
+            stat = node.entry.stat(follow_symlinks=False) if node.entry is not None else os.lstat(node.path)
+        except OSError:
+            return None
+        return stat.st_size if key == "size" else stat.st_mtime
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.KEYS)
+
+    def __len__(self) -> int:
+        return len(self.KEYS)
+
+    def __repr__(self) -> str:
+        return f"FileStat({self.node.path!r})"
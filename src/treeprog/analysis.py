@@ -0,0 +1,251 @@
+import json
+from typing import Any, Dict, Iterator, List, Set
+
+# selectors, select-orders and follow directions whose output depends on a
+# random number generator
+NONDETERMINISTIC = {"shuffle", "sample", "rand", "weighted-sample"}
+
+# selectors taking a sort key -> position of the key among their arguments
+KEYED_SELECTORS = {"smallest": 1, "largest": 1, "weighted-sample": 1}
+
+# follow directions taking a weight key -> position of the key among their
+# arguments
+KEYED_DIRECTIONS = {"weighted-sample": 1}
+
+
+def walk_actions(order: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Yield every action of an order, including the actions nested in the
+    orders of `cond` cases, in document order.
+
+    Args:
+        order: A traversal order.
+    """
+    for action in order:
+        yield action
+        if "cond" in action:
+            for case in action["cond"]:
+                yield from walk_actions(case.get("order", []))
+
+
+def action_types(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of action types (`visit`, `follow`, ...) used anywhere in
+        `order`.
+    """
+    return {next(iter(action)) for action in walk_actions(order)}
+
+
+def _spec_name(spec: Any) -> Any:
+    return spec.get("name") if isinstance(spec, dict) else spec
+
+
+def uses_randomness(order: List[Dict[str, Any]]) -> bool:
+    """
+    Return True if any follow direction, selector or select-order of `order`
+    draws random numbers.
+
+    Args:
+        order: A traversal order.
+    """
+    for action in walk_actions(order):
+        if "follow" in action:
+            names = {action["follow"],
+                     _spec_name(action.get("select")),
+                     _spec_name(action.get("select-order"))}
+            if names & NONDETERMINISTIC:
+                return True
+    return False
+
+
+def normalize_order(order: List[Dict[str, Any]]) -> str:
+    """
+    Canonical text form of an order: two orders that differ only in key order
+    or whitespace normalize to the same string.
+
+    Args:
+        order: A traversal order.
+    """
+    return json.dumps(order, sort_keys=True, separators=(",", ":"), default=repr)
+
+
+def follow_directions(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of follow directions used anywhere in `order`.
+    """
+    return {action["follow"] for action in walk_actions(order) if "follow" in action}
+
+
+def rest_directions(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of follow directions whose nodes are selected with `rest`
+        anywhere in `order`.
+    """
+    return {action["follow"] for action in walk_actions(order)
+            if "follow" in action and _spec_name(action.get("select")) == "rest"}
+
+
+def _refs(value: Any, found: Set[str]) -> None:
+    if isinstance(value, str):
+        if value.startswith("$"):
+            found.add(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _refs(v, found)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _refs(v, found)
+
+
+def env_vars(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of `$` environment variables referenced anywhere in `order`.
+    """
+    found: Set[str] = set()
+    for action in walk_actions(order):
+        _action_refs(action, found)
+    return found
+
+
+def _action_refs(action: Dict[str, Any], found: Set[str]) -> None:
+    # the nested orders of a `cond` are walked on their own
+    if "cond" in action:
+        for case in action["cond"]:
+            _refs([case.get("args", []), case.get("kwargs", {}), case["pred"]], found)
+    else:
+        _refs(action, found)
+
+
+def payload_read_after_map(order: List[Dict[str, Any]]) -> bool:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        True if an action that comes after a `payload-map` action in
+        document order references `$payload`.
+    """
+    mapped = False
+    for action in walk_actions(order):
+        if mapped:
+            found: Set[str] = set()
+            _action_refs(action, found)
+            if "$payload" in found:
+                return True
+        mapped = mapped or "payload-map" in action
+    return False
+
+
+def bound_vars(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of variables bound by `set!` actions anywhere in `order`.
+    """
+    return {key for action in walk_actions(order) if "set!" in action
+            for key in action["set!"]}
+
+
+def fold_vars(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of `$fold.<name>` variables the `fold` actions of `order`
+        provide.
+    """
+    return {"$fold." + action["result-name"] for action in walk_actions(order) if "fold" in action}
+
+
+def selectors(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of selectors of the follow actions anywhere in `order`
+        (`all` for follows without one).
+    """
+    return {_spec_name(action.get("select", "all")) for action in walk_actions(order) if "follow" in action}
+
+
+def select_orders(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of select-orders of the follow actions anywhere in `order`.
+    """
+    return {_spec_name(action["select-order"]) for action in walk_actions(order)
+            if "follow" in action and "select-order" in action}
+
+
+def sort_keys(order: List[Dict[str, Any]]) -> Set[Any]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of keys (`payload`, `name`, ...) the `KEYED_SELECTORS` of
+        the follow actions anywhere in `order` order or weigh nodes by.
+    """
+    found = set()
+    for action in walk_actions(order):
+        select = action.get("select") if "follow" in action else None
+        if not isinstance(select, dict) or select.get("name") not in KEYED_SELECTORS:
+            continue
+        args = select.get("args", [])
+        position = KEYED_SELECTORS[select["name"]]
+        if "key" in select.get("kwargs", {}):
+            found.add(select["kwargs"]["key"])
+        elif len(args) > position:
+            found.add(args[position])
+    return found
+
+
+def predicates(order: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        The set of predicates tested by `visit` actions and `cond` cases
+        anywhere in `order`, including the operands of composite predicates.
+    """
+    found: Set[str] = set()
+    for action in walk_actions(order):
+        if "visit" in action:
+            _pred_names(action["visit"], found)
+        elif "cond" in action:
+            for case in action["cond"]:
+                _pred_names(case["pred"], found)
+    return found
+
+
+def _pred_names(pred: Any, found: Set[str]) -> None:
+    if isinstance(pred, dict):
+        for operands in pred.values():
+            for operand in operands:
+                _pred_names(operand["pred"], found)
+    else:
+        found.add(pred)
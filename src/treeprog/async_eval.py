@@ -0,0 +1,363 @@
+import asyncio
+import inspect
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+from . import analysis
+from . import fold
+from . import payload_map
+from . import predicates
+from . import sampling
+from .environment import Environment
+from .run import Run, RunState
+from .utt_eval import UttEval
+
+# follow directions that need only the fetched children and parent links; the
+# other inherited directions walk the tree through a `TreeIndex`, which reads
+# `node.children`, so they are only available on in-memory trees
+LAZY_DIRS = {"none", "up", "parent", "down", "children"}
+
+
+async def _maybe_await(value: Any) -> Any:
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AsyncUttEval(UttEval):
+    """
+    Evaluator for trees whose children are fetched lazily, e.g. from a
+    database or over the network.
+
+    Children are obtained with `await node.fetch_children()` when the node
+    provides it, and read from `node.children` otherwise. Follow directions,
+    predicates and select-orders may be plain functions or coroutine
+    functions. Results and their order are the same as `UttEval` on an
+    equivalent in-memory tree.
+
+    On trees whose nodes provide `fetch_children`, only the `LAZY_DIRS` can
+    be followed; the other directions of `UttEval` need the whole tree in
+    memory and raise ValueError there.
+
+    Fetches overlap: as soon as a follow has selected the nodes it will
+    visit, the children of each of them are requested in the background (the
+    next frontier), so by the time the traversal reaches a node its children
+    have usually arrived.
+    At most `concurrency` fetches are in flight at once, which makes the
+    latency of a traversal over a remote-backed tree governed by
+    `concurrency` rather than by the sum of the round-trips.
+
+    The environment holds `$node`, `$payload`, `$children`, `$num_children`,
+    `$is_leaf`, `$parent`, `$depth`, `$root`, `$order`, `$results`,
+    `$visited` and `$followed`. Nodes may provide a `depth` attribute;
+    otherwise the depth is found by walking `parent` links.
+
+    Args:
+        concurrency: Maximum number of child fetches in flight.
+        prefetch: Fetch the children of followed nodes ahead of time.
+    """
+    _semaphore = RunState()
+    _fetches = RunState()
+
+    def __init__(self, debug=False, seed=None, concurrency: int = 16, prefetch: bool = True):
+        super().__init__(debug=debug, seed=seed)
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._fetches: Dict[Any, asyncio.Task] = {}
+
+        self.dispatch_table: Dict[str, Callable] = {
+            "visit": self._visit,
+            "follow": self._follow,
+            "cond": self._cond,
+            "payload-map": self._payload_map_async,
+            "set!": self._set_async,
+            "aggregate": self._aggregate_async,
+            "fold": self._fold_async,
+        }
+        self.follow_dirs["down"] = self._children
+        self.follow_dirs["children"] = self._children
+        self.pred_fns["is-leaf?"] = self._is_leaf
+        self.env_vars = {"$node", "$payload", "$children", "$num_children", "$is_leaf",
+                         "$parent", "$depth", "$root", "$order", "$results",
+                         "$visited", "$followed"}
+
+    async def _fetch(self, node: Any) -> List[Any]:
+        async with self._semaphore:
+            fetch = getattr(node, "fetch_children", None)
+            if fetch is None:
+                return list(node.children)
+            return list(await _maybe_await(fetch()))
+
+    def _request(self, node: Any) -> asyncio.Task:
+        task = self._fetches.get(node)
+        if task is None:
+            task = self._fetches[node] = asyncio.ensure_future(self._fetch(node))
+        return task
+
+    async def _children(self, node: Any) -> List[Any]:
+        return await self._request(node)
+
+    async def _is_leaf(self, node: Any) -> bool:
+        return len(await self._children(node)) == 0
+
+    @staticmethod
+    def _depth(node: Any) -> int:
+        depth = getattr(node, "depth", None)
+        if depth is not None:
+            return depth
+        depth = 0
+        while node.parent is not None:
+            node = node.parent
+            depth += 1
+        return depth
+
+    async def _create_env_async(self, node: Any, order: List[Dict[str, Any]],
+                                visited: Set[Any], followed: Set[Any]) -> Environment:
+        scope = self.scope
+        children = await self._children(node)
+        root = node
+        while root.parent is not None:
+            root = root.parent
+        env = Environment({
+            "$node": node,
+            "$num_children": len(children),
+            "$parent": node.parent,
+            "$root": root,
+            "$depth": self._depth(node),
+            "$is_leaf": len(children) == 0,
+            "$order": order,
+            "$results": self.results,
+            "$visited": visited,
+            "$followed": followed,
+            "$payload": node.payload,
+            "$children": children,
+        }, scope)
+        self._add_folds(node, env)
+        return env
+
+    async def eval(self, node: Any, order: List[Dict[str, Any]], visited: Set[Any], followed: Set[Any]) -> None:
+        env = await self._create_env_async(node, order, visited, followed)
+
+        if self.debug:
+            print(f"Node: {node}")
+            print(f"Env: {env}")
+
+        try:
+            for action in order:
+                action_type = next(iter(action))
+                await self.dispatch_table[action_type](action, env)
+        finally:
+            # the node's children are not needed once it is done
+            self._fetches.pop(node, None)
+
+    async def _pred(self, pred: Any, spec: Dict[str, Any], env: Dict[str, Any]) -> bool:
+        if predicates.is_composite(pred):
+            return await self._composite(pred, env)
+        args, kwargs = self.binders[id(spec)](env)
+        return await _maybe_await(self.pred_fns[pred](*args, **kwargs))
+
+    async def _composite(self, pred: Dict[str, Any], env: Dict[str, Any]) -> bool:
+        # `PredicateOrder.test`, awaiting the operands
+        order = self.pred_order
+        composite = order.composite(pred)
+        conjunction = composite.conjunction
+        measure = order.adaptive and not composite.fixed
+        outcome = conjunction
+        measured = []
+        for i in composite.order:
+            operand = composite.operands[i]
+            start = time.perf_counter()
+            passed = bool(await self._pred(operand['pred'], operand, env))
+            if measure:
+                measured.append((i, passed, time.perf_counter() - start))
+            if passed is not conjunction:
+                outcome = not conjunction
+                break
+        if measure:
+            order.record(composite, measured)
+        return outcome
+
+    async def _visit(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        node = env['$node']
+        if node in env['$visited']:
+            return
+        env['$visited'].add(node)
+        result_name = action.get('result-name')
+        if await self._pred(action['visit'], action, env):
+            if result_name:
+                self._emit(result_name, node)
+
+    async def _follow(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        dir = action['follow']
+        self.rng = self._site_rng(action, env['$order'])
+        args, kwargs = self.binders[id(action)](env)
+        nodes = await _maybe_await(self.follow_dirs[dir](env['$node'], *args, **kwargs))
+
+        select_spec = action.get('select', 'all')
+        select_order_spec = action.get('select-order', 'id')
+
+        sel_nodes = self._apply_select(select_spec, nodes, env, self._cursor(env, dir, nodes, args, kwargs))
+        ordered_nodes = await _maybe_await(self._apply_select_order(select_order_spec, sel_nodes))
+        if self.prefetch:
+            for node in ordered_nodes:
+                if node not in env['$followed']:
+                    self._request(node)
+
+        scope = env.extend()
+        for node in ordered_nodes:
+            if node not in env['$followed']:
+                env['$followed'].add(node)
+                self.scope = scope
+                await self.eval(node, env['$order'], env['$visited'], env['$followed'])
+
+    async def _cond(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        for case in action['cond']:
+            if await self._pred(case['pred'], case, env):
+                for action in case['order']:
+                    action_type = next(iter(action))
+                    await self.dispatch_table[action_type](action, env)
+                break
+
+    async def _payload_map_async(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        self._payload_map(action, env)
+
+    async def _set_async(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        self._set(action, env)
+
+    async def _aggregate_async(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        self._aggregate(action, env)
+
+    async def _fold_async(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        name = action['result-name']
+        init, step = self.combiners[action['fold']]
+        env["$fold." + name] = await fold.afold(env['$node'], init, step, self._fold_value(action),
+                                                self.folds.setdefault(name, {}), self._children)
+
+    async def run(self, node: Any, order: List[Dict[str, Any]]) -> Run:
+        run = self._begin()
+        await self._evaluate(node, order)
+        return run
+
+    async def __call__(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        return (await self.run(node, order)).results
+
+    async def _evaluate(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        if getattr(node, "fetch_children", None) is not None:
+            eager = analysis.follow_directions(order) - LAZY_DIRS
+            if eager:
+                raise ValueError(f"Invalid follow direction for a lazily fetched tree: {', '.join(sorted(eager))}")
+        self.results = {}
+        self.streams = sampling.RandomStreams(self.seed)
+        self.rng = self.streams.get("")
+        self.sites = {}
+        self.samplers = {}
+        self.index = None
+        self.scope = None
+        self.binders = self._compile(order)
+        self.stage = payload_map.PayloadMapStage(self.payload_fns, self.payload_columns)
+        self.aggregates = {}
+        self.folds = {}
+        self.rest_dirs = analysis.rest_directions(order)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._fetches = {}
+        try:
+            await self.eval(node, order, set(), set())
+        finally:
+            for task in self._fetches.values():
+                task.cancel()
+            self._fetches = {}
+        # children are fetched lazily, so there is no index to map columns over
+        self.payloads = self.stage.run(None, order) if self.stage.pending else None
+        self.stage = None
+        return self.results
+
+
+class SqliteNode:
+    """
+    Node of a `SqliteTree`. Its children are loaded from the database by
+    `fetch_children`.
+    """
+    __slots__ = ("tree", "id", "parent", "payload", "depth")
+
+    def __init__(self, tree: "SqliteTree", id: int, parent: Optional["SqliteNode"], payload: Any, depth: int):
+        self.tree = tree
+        self.id = id
+        self.parent = parent
+        self.payload = payload
+        self.depth = depth
+
+    async def fetch_children(self) -> List["SqliteNode"]:
+        rows = await asyncio.get_running_loop().run_in_executor(None, self.tree.child_rows, self.id)
+        return [SqliteNode(self.tree, id, self, json.loads(payload), self.depth + 1)
+                for id, payload in rows]
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, SqliteNode) and self.tree is other.tree and self.id == other.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __repr__(self) -> str:
+        return f"SqliteNode(id={self.id}, payload={self.payload!r})"
+
+
+class SqliteTree:
+    """
+    Tree stored in an SQLite table, one row per node, standing in for a
+    storage-backed tree. `latency` adds an artificial delay to every child
+    query to emulate a remote store.
+
+    Args:
+        path: Database file, or ":memory:".
+        latency: Seconds to sleep in every child query.
+    """
+    def __init__(self, path: str = ":memory:", latency: float = 0.0):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                           "id INTEGER PRIMARY KEY, parent INTEGER, "
+                           "position INTEGER, payload TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent, position)")
+
+    @classmethod
+    def from_tree(cls, root: Any, path: str = ":memory:", latency: float = 0.0) -> "SqliteTree":
+        """
+        Copy an in-memory tree into a new `SqliteTree`.
+
+        Args:
+            root: Root of the tree to copy. Payloads must be JSON serializable.
+            path: Database file, or ":memory:".
+            latency: Seconds to sleep in every child query.
+        """
+        tree = cls(path, latency)
+        rows = []
+        stack = [(root, None, 0)]
+        while stack:
+            node, parent, position = stack.pop()
+            id = len(rows)
+            rows.append((id, parent, position, json.dumps(node.payload)))
+            stack.extend((child, id, i) for i, child in enumerate(node.children))
+        with tree._lock, tree._conn:
+            tree._conn.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?)", rows)
+        return tree
+
+    def child_rows(self, id: int) -> List[Any]:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            return self._conn.execute("SELECT id, payload FROM nodes WHERE parent = ? "
+                                      "ORDER BY position", (id,)).fetchall()
+
+    def root(self) -> SqliteNode:
+        """
+        Returns:
+            The root node (the node without a parent).
+        """
+        with self._lock:
+            id, payload = self._conn.execute(
+                "SELECT id, payload FROM nodes WHERE parent IS NULL").fetchone()
+        return SqliteNode(self, id, None, json.loads(payload), 0)
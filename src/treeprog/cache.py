@@ -0,0 +1,222 @@
+import functools
+import hashlib
+import os
+import tempfile
+from typing import Any, Callable, Dict, List, Optional
+from . import analysis
+from .hashing import TreeHasher
+from .index import TreeIndex
+from .result_io import load_results, save_results
+
+# actions whose output is not in the results: a hit could not restore it
+UNCACHEABLE_ACTIONS = {"aggregate", "payload-map", "fold"}
+
+# dispatch tables of an evaluator whose functions are part of the cache key
+KEYED_TABLES = ("pred_fns", "follow_dirs", "selectors", "select_orders", "sort_keys")
+
+
+class ResultCache:
+    """
+    On-disk store of traversal results with size-bounded LRU eviction.
+
+    Each entry is one file in `directory` written by `result_io.save_results`.
+    A file's modification time is its last use: hits touch the file, and
+    `put` evicts the least recently used files until the store fits in
+    `max_bytes`.
+
+    Args:
+        directory: Directory holding the cache files. Created if missing.
+        max_bytes: Maximum total size of the cache files.
+    """
+    SUFFIX = ".npz"
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key: str, index: TreeIndex) -> Optional[Dict[str, List[Any]]]:
+        """
+        Args:
+            key: Cache key.
+            index: Index of the tree the results were computed on.
+
+        Returns:
+            The cached results mapped onto `index`, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            stored = load_results(path)
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            return None
+        os.utime(path)
+        view = stored.view(index)
+        return {name: list(nodes) for name, nodes in view.items()}
+
+    def put(self, key: str, results: Dict[str, List[Any]], index: TreeIndex) -> None:
+        """
+        Store `results` under `key`, then evict old entries if the store is
+        over budget.
+
+        Args:
+            key: Cache key.
+            results: Result dictionary as returned by an evaluator.
+            index: Index of the tree the results were computed on.
+        """
+        # write to a temporary file first so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            save_results(f, results, index)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Delete least recently used entries until the store fits in `max_bytes`.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        """
+        Delete every entry.
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                os.remove(entry.path)
+
+
+class CachedUttEval:
+    """
+    Wraps an evaluator so that repeated runs of the same order on an unchanged
+    tree are answered from a `ResultCache`.
+
+    Entries are keyed by the Merkle fingerprint of the tree (shape, payloads
+    and names), the position of the start node, the normalized order, the
+    evaluator class, its seed and the functions of its dispatch tables
+    (`KEYED_TABLES`), so replacing a predicate or sort key does not return
+    results computed with the old one. Functions are identified by their
+    name and code; closures over different values are not told apart.
+
+    Orders that draw random numbers bypass the cache unless the evaluator was
+    constructed with a fixed seed, and so do orders with `aggregate`,
+    `payload-map` or `fold` actions, whose output is not in the results. A
+    hit only returns the results: the evaluator's other attributes are not
+    updated.
+
+    Tree fingerprints are cached as well. After mutating a tree (including
+    renaming a node), call `invalidate(node)` on each changed node; only the
+    changed paths are then rehashed on the next call.
+
+    Args:
+        evaluator: The evaluator to wrap, e.g. `utt_eval.UttEval(seed=1)`.
+        cache: Where to store results.
+    """
+    def __init__(self, evaluator: Any, cache: ResultCache):
+        self.evaluator = evaluator
+        self.cache = cache
+        self.hasher = TreeHasher(names=True)
+        self.indexes: Dict[bytes, TreeIndex] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, order: List[Dict[str, Any]]) -> bool:
+        """
+        Return True if results of `order` may be cached.
+
+        Args:
+            order: A traversal order.
+        """
+        if analysis.action_types(order) & UNCACHEABLE_ACTIONS:
+            return False
+        return (getattr(self.evaluator, "seed", None) is not None
+                or not analysis.uses_randomness(order))
+
+    def invalidate(self, node: Any) -> None:
+        """
+        Declare that the name, payload or children of `node` changed.
+
+        Args:
+            node: The node that changed.
+        """
+        self.hasher.invalidate(node)
+
+    def _index(self, root: Any, digest: bytes) -> TreeIndex:
+        index = self.indexes.get(digest)
+        if index is None:
+            # one index per tree version; older versions are dropped
+            self.indexes = {digest: TreeIndex(root)}
+            index = self.indexes[digest]
+        return index
+
+    def key(self, node: Any, order: List[Dict[str, Any]]) -> str:
+        """
+        Args:
+            node: Start node of the traversal.
+            order: A traversal order.
+
+        Returns:
+            The cache key of running `order` from `node`.
+        """
+        root = node.root
+        digest = self.hasher.digest(root)
+        index = self._index(root, digest)
+        cls = type(self.evaluator)
+        h = hashlib.sha256(digest)
+        for part in (str(index.id(node)), analysis.normalize_order(order),
+                     f"{cls.__module__}.{cls.__qualname__}",
+                     repr(getattr(self.evaluator, "seed", None))):
+            h.update(b"\0" + part.encode())
+        for table in KEYED_TABLES:
+            for name, fn in sorted(getattr(self.evaluator, table, {}).items()):
+                h.update(b"\0" + f"{table}:{name}:{_callable_key(fn)}".encode())
+        return h.hexdigest()
+
+    def __call__(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        if not self.cacheable(order):
+            return self.evaluator(node, order)
+
+        key = self.key(node, order)
+        index = self._index(node.root, self.hasher.digest(node.root))
+        results = self.cache.get(key, index)
+        if results is not None:
+            self.hits += 1
+            return results
+
+        self.misses += 1
+        results = self.evaluator(node, order)
+        self.cache.put(key, results, index)
+        return results
+
+
+def _callable_key(fn: Callable) -> str:
+    # stable across processes: qualified name, and the code of functions
+    if isinstance(fn, functools.partial):
+        return f"partial({_callable_key(fn.func)}, {fn.args!r}, {fn.keywords!r})"
+    name = f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', type(fn).__qualname__)}"
+    code = getattr(fn, "__code__", None)
+    return name if code is None else f"{name}:{_code_digest(code)}"
+
+
+def _code_digest(code: Any) -> str:
+    h = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        # nested functions are code objects, whose repr holds an address
+        h.update((_code_digest(const) if hasattr(const, "co_code") else repr(const)).encode())
+    h.update(repr(code.co_names).encode())
+    return h.hexdigest()
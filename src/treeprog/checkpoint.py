@@ -0,0 +1,246 @@
+import io
+import os
+import pickle
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from .environment import Frame
+from .index import TreeIndex
+
+FORMAT_VERSION = 1
+
+# seconds between checkpoints
+CHECKPOINT_INTERVAL = 60.0
+
+# largest fraction of the traversal time spent writing checkpoints: after a
+# checkpoint that took s seconds, the next one waits at least s / MAX_OVERHEAD
+MAX_OVERHEAD = 0.02
+
+# nodes evaluated between two looks at the clock
+CHECK_EVERY = 1024
+
+# types whose values are never nodes, skipped without a lookup when pickling
+_PLAIN = {str, int, float, bool, bytes, type(None), tuple, list, dict, set, frozenset}
+
+
+class _Pickler(pickle.Pickler):
+    # pickles the nodes of the tree by id, so that the checkpoint holds
+    # neither the tree nor copies of its nodes
+    def __init__(self, file: Any, index: TreeIndex):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.ids = index.ids
+
+    def persistent_id(self, obj: Any) -> Optional[int]:
+        if type(obj) in _PLAIN:
+            return None
+        try:
+            return self.ids.get(obj)
+        except TypeError:
+            return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file: Any, index: TreeIndex):
+        super().__init__(file)
+        self.nodes = index.nodes
+
+    def persistent_load(self, pid: int) -> Any:
+        return self.nodes[pid]
+
+
+def dumps(state: Dict[str, Any], index: TreeIndex) -> bytes:
+    """
+    Args:
+        state: Traversal state; any node of the tree of `index` in it, at any
+            depth, is stored as its id.
+        index: Index of the traversed tree.
+
+    Returns:
+        The pickled state.
+    """
+    buffer = io.BytesIO()
+    _Pickler(buffer, index).dump(state)
+    return buffer.getvalue()
+
+
+def loads(data: bytes, index: TreeIndex) -> Dict[str, Any]:
+    """
+    Inverse of `dumps`, on an index of the same tree.
+    """
+    return _Unpickler(io.BytesIO(data), index).load()
+
+
+def pack_ids(ids: Iterable[int], size: int) -> np.ndarray:
+    """
+    Args:
+        ids: Node ids.
+        size: Number of nodes of the tree.
+
+    Returns:
+        The ids as a bitset, packed eight to a byte.
+    """
+    bits = np.zeros(size, dtype=bool)
+    bits[np.fromiter(ids, dtype=np.int64)] = True
+    return np.packbits(bits)
+
+
+def unpack_ids(packed: np.ndarray, size: int) -> np.ndarray:
+    """
+    Inverse of `pack_ids`.
+
+    Returns:
+        The flags of the `size` nodes, one byte each.
+    """
+    return np.unpackbits(packed, count=size)
+
+
+def pack_frames(scopes: Iterable[Optional[Frame]]) -> Tuple[List[Tuple[int, Dict[str, Any], bool]], np.ndarray]:
+    """
+    Flatten the `set!` bindings of the nodes of a frontier into a table, so
+    that frames shared by several nodes are stored once and long chains do
+    not recurse when pickled. Lookup caches are left out.
+
+    Args:
+        scopes: The frame of every node, or None.
+
+    Returns:
+        The frames, parents first, each as the position of its parent (-1
+        for none), its bindings and whether it is frozen; and the position
+        of every node's frame (-1 for None).
+    """
+    numbers: Dict[int, int] = {}
+    table: List[Tuple[int, Dict[str, Any], bool]] = []
+    refs = []
+    for scope in scopes:
+        if scope is None:
+            refs.append(-1)
+            continue
+        chain = []
+        frame = scope
+        while frame is not None and id(frame) not in numbers:
+            chain.append(frame)
+            frame = frame.parent
+        for frame in reversed(chain):
+            numbers[id(frame)] = len(table)
+            parent = numbers[id(frame.parent)] if frame.parent is not None else -1
+            table.append((parent, frame.vars, frame.frozen))
+        refs.append(numbers[id(scope)])
+    return table, np.asarray(refs, dtype=np.int64)
+
+
+def unpack_frames(table: List[Tuple[int, Dict[str, Any], bool]]) -> List[Frame]:
+    """
+    Inverse of `pack_frames`.
+
+    Returns:
+        The frames, in table order.
+    """
+    frames: List[Frame] = []
+    for parent, bindings, frozen in table:
+        frame = Frame(frames[parent] if parent >= 0 else None)
+        frame.vars = bindings
+        frame.frozen = frozen
+        frames.append(frame)
+    return frames
+
+
+class Checkpointer:
+    """
+    Writes the state of a traversal to a file at intervals, so that the
+    traversal can be resumed after a crash or a deadline (see
+    `treeprog.UttEval.resume`).
+
+    A checkpoint is written every `interval` seconds, and never more often
+    than keeps the time spent writing under `max_overhead` of the traversal
+    time. It replaces the previous one atomically, so the file always holds
+    a complete checkpoint. The file is removed once the traversal is done,
+    unless `keep`.
+
+    Args:
+        path: Path of the checkpoint file.
+        interval: Seconds between checkpoints.
+        max_overhead: Largest fraction of the time spent writing
+            checkpoints.
+        keep: Keep the file of the last checkpoint when the traversal is
+            done.
+    """
+    def __init__(self, path: str, interval: float = CHECKPOINT_INTERVAL,
+                 max_overhead: float = MAX_OVERHEAD, keep: bool = False):
+        self.path = path
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.keep = keep
+        # checkpoints written, and the seconds spent writing them
+        self.saved = 0
+        self.seconds = 0.0
+        self._next = 0.0
+
+    def start(self) -> None:
+        """
+        Start timing a traversal: the first checkpoint is due in `interval`
+        seconds.
+        """
+        self._next = time.monotonic() + self.interval
+
+    def due(self) -> bool:
+        """
+        Return True if a checkpoint should be written now.
+        """
+        return time.monotonic() >= self._next
+
+    def save(self, state: Dict[str, Any], index: TreeIndex, started: Optional[float] = None) -> None:
+        """
+        Write a checkpoint.
+
+        Args:
+            state: Traversal state, see `dumps`.
+            index: Index of the traversed tree.
+            started: `time.monotonic()` when gathering the state began, so
+                that it counts towards the overhead.
+        """
+        start = started if started is not None else time.monotonic()
+        data = dumps(dict(state, version=FORMAT_VERSION), index)
+        temp = self.path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        now = time.monotonic()
+        cost = now - start
+        self.saved += 1
+        self.seconds += cost
+        self._next = now + max(self.interval, cost / self.max_overhead if self.max_overhead > 0 else 0.0)
+
+    def load(self, index: TreeIndex) -> Dict[str, Any]:
+        """
+        Args:
+            index: Index of the traversed tree.
+
+        Returns:
+            The state of the last checkpoint.
+
+        Raises:
+            FileNotFoundError: If there is no checkpoint.
+            ValueError: If the file was written by another format version.
+        """
+        with open(self.path, "rb") as f:
+            state = loads(f.read(), index)
+        if state.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Invalid checkpoint version: {state.get('version')}")
+        return state
+
+    def exists(self) -> bool:
+        """
+        Return True if there is a checkpoint to resume from.
+        """
+        return os.path.exists(self.path)
+
+    def finish(self) -> None:
+        """
+        The traversal is done: remove the checkpoint file, unless `keep`.
+        """
+        if not self.keep:
+            for path in (self.path, self.path + ".tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
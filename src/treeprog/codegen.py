@@ -0,0 +1,468 @@
+import hashlib
+import math
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+from . import adapters
+from . import analysis
+from . import predicates
+from . import sampling
+from .utt_eval import UttEval
+
+# actions the generated code carries out; orders with others are interpreted
+CODEGEN_ACTIONS = {"visit", "cond", "follow"}
+
+# variable -> expression computing it from `node`, evaluated once per node
+NODE_VARS = {
+    "$node": "node",
+    "$payload": "node.payload",
+    "$depth": "depth_of(node)",
+    "$num_children": "len(node.children)",
+    "$is_leaf": "len(node.children) == 0",
+    "$parent": "node.parent",
+    "$root": "node.root",
+    "$children": "node.children",
+}
+
+# variables that are arguments of the generated function
+RUN_VARS = {"$visited": "visited", "$followed": "followed", "$results": "results"}
+
+# built-in predicates inlined as expressions: name -> (arity, template). A
+# predicate is only inlined while the evaluator's table holds the built-in.
+INLINE_PREDS = {
+    "eq?": (2, "({0} == {1})"),
+    "less?": (2, "({0} < {1})"),
+    "is-leaf?": (1, "(len({0}.children) == 0)"),
+    "true": (0, "True"),
+    "false": (0, "False"),
+}
+
+# built-in follow directions inlined as expressions, likewise
+INLINE_DIRS = {
+    "down": "node.children",
+    "children": "node.children",
+    "up": "([node.parent] if node.parent is not None else [])",
+    "parent": "([node.parent] if node.parent is not None else [])",
+}
+
+# literal argument types written into the source as they are
+LITERAL_TYPES = (str, int, float, bool, type(None))
+
+# generated traversals kept, the least recently added dropped first
+MAX_CACHED = 256
+
+# dispatch table of each kind of inlined built-in
+TABLES = {"pred": "pred_fns", "dir": "follow_dirs", "select": "selectors",
+          "select-order": "select_orders"}
+
+# (order hash, inlined built-ins) -> Traversal, or None if the order has no
+# generated code
+_cache: Dict[Tuple[str, FrozenSet[str]], Optional["Traversal"]] = {}
+
+
+class _Unsupported(Exception):
+    # raised while generating code for an order the generator cannot translate
+    pass
+
+
+class Traversal:
+    """
+    Generated traversal function of one order: its `source`, the compiled
+    `code` and the `function` defined by it, and the names it looks up in
+    each dispatch table of the evaluator (`requires`).
+    """
+    def __init__(self, source: str, code: Any, function: Callable, requires: Dict[str, Set[str]]):
+        self.source = source
+        self.code = code
+        self.function = function
+        self.requires = requires
+
+
+def order_hash(order: List[Dict[str, Any]]) -> str:
+    """
+    Args:
+        order: A traversal order.
+
+    Returns:
+        Digest of the normalized text of `order` (see
+        `analysis.normalize_order`).
+    """
+    return hashlib.blake2b(analysis.normalize_order(order).encode(), digest_size=16).hexdigest()
+
+
+def supports(order: List[Dict[str, Any]]) -> bool:
+    """
+    Return True if code can be generated for `order`: it has `visit`,
+    `cond` and `follow` actions only, draws no random numbers, reads only
+    the variables of `NODE_VARS` and `RUN_VARS`, and its arguments are
+    plain literals (strings, numbers, booleans, None, and lists and dicts
+    of them).
+
+    Args:
+        order: A traversal order.
+    """
+    return traversal(order) is not None
+
+
+def traversal(order: List[Dict[str, Any]], inline: FrozenSet[str] = frozenset()) -> Optional[Traversal]:
+    """
+    Generate, compile and cache the traversal function of `order`. Code is
+    cached by the hash of the normalized order, so equal orders share it.
+
+    The function takes the start node, the visited and followed sets, the
+    results dict and the evaluator's `pred_fns`, `follow_dirs`, `selectors`
+    and `select_orders`, and adds the result nodes to the results dict.
+
+    Args:
+        order: A traversal order.
+        inline: The built-ins written into the code rather than looked up
+            in the tables: `"pred:<name>"` for the `INLINE_PREDS`,
+            `"dir:<name>"` for the `INLINE_DIRS`, `"select:all"` and
+            `"select-order:id"`.
+
+    Returns:
+        The traversal, or None if code cannot be generated for `order`.
+    """
+    key = (order_hash(order), inline)
+    if key in _cache:
+        return _cache[key]
+    generator = _Generator(inline)
+    try:
+        source = generator.generate(order)
+    except _Unsupported:
+        found = None
+    else:
+        code = compile(source, f"<treeprog order {key[0][:12]}>", "exec")
+        namespace = {"depth_of": adapters.depth}
+        exec(code, namespace)
+        found = Traversal(source, code, namespace["traverse"], generator.requires)
+    if len(_cache) >= MAX_CACHED:
+        del _cache[next(iter(_cache))]
+    _cache[key] = found
+    return found
+
+
+def clear_cache() -> None:
+    """
+    Drop every cached traversal.
+    """
+    _cache.clear()
+
+
+class CodegenUttEval(UttEval):
+    """
+    Evaluator that runs orders as generated Python code.
+
+    An order is translated into the source of one function (see
+    `traversal`): the actions are unrolled into straight-line blocks, the
+    built-in predicates `eq?`, `less?`, `is-leaf?`, `true` and `false` and
+    the `down`/`up` directions are inlined as expressions, other predicates,
+    directions, selectors and select-orders are looked up once per call,
+    and the nodes waiting to be resumed are kept on an explicit stack
+    rather than in Python frames. Results come in the same order as with
+    `UttEval`, and the depth of the tree is not limited by the recursion
+    limit.
+
+    Compiled functions are cached by the hash of the order, and shared by
+    all evaluators. A built-in is only inlined while the evaluator's table
+    still holds it, so replacing e.g. `pred_fns["eq?"]` takes effect.
+
+    Orders code cannot be generated for (see `supports`), and orders with
+    composite predicates whose operands are not tested in declared order
+    (see `predicates.PredicateOrder`), are evaluated by `UttEval`, as is
+    every order in debug mode.
+    """
+    def __init__(self, debug=False, seed=None):
+        super().__init__(debug=debug, seed=seed)
+        # the built-ins that may be inlined, as constructed
+        self.builtins: Dict[str, Callable] = {}
+        for kind, names in (("pred", INLINE_PREDS), ("dir", INLINE_DIRS),
+                            ("select", ["all"]), ("select-order", ["id"])):
+            table = getattr(self, TABLES[kind])
+            self.builtins.update((f"{kind}:{name}", table[name]) for name in names)
+
+    def _inline(self) -> FrozenSet[str]:
+        found = set()
+        for key, fn in self.builtins.items():
+            kind, name = key.split(":", 1)
+            if getattr(self, TABLES[kind]).get(name) is fn:
+                found.add(key)
+        return frozenset(found)
+
+    def traversal(self, order: List[Dict[str, Any]]) -> Optional[Traversal]:
+        """
+        Args:
+            order: A traversal order.
+
+        Returns:
+            The generated traversal this evaluator runs `order` with, or
+            None if it interprets `order`.
+        """
+        if self.debug:
+            return None
+        if not self.pred_order.declared and _has_composite(order):
+            return None
+        found = traversal(order, self._inline())
+        if found is None:
+            return None
+        for table, names in found.requires.items():
+            if not names <= getattr(self, table).keys():
+                # interpreted, so that a missing name fails where it is used
+                return None
+        return found
+
+    def _evaluate(self, node, order):
+        found = self.traversal(order)
+        if found is None:
+            return super()._evaluate(node, order)
+        self.results = {}
+        self.streams = sampling.RandomStreams(self.seed)
+        self.rng = self.streams.get("")
+        self.sites = {}
+        self.index = None
+        self.scope = None
+        self.binders = {}
+        self.stage = None
+        self.payloads = None
+        self.aggregates = {}
+        self.folds = {}
+        found.function(node, set(), set(), self.results, self.pred_fns, self.follow_dirs,
+                       self.selectors, self.select_orders)
+        return self.results
+
+
+def _has_composite(order: List[Dict[str, Any]]) -> bool:
+    for action in analysis.walk_actions(order):
+        if "visit" in action and predicates.is_composite(action["visit"]):
+            return True
+        if "cond" in action and any(predicates.is_composite(case["pred"]) for case in action["cond"]):
+            return True
+    return False
+
+
+class _Generator:
+    # Writes the source of one traversal function.
+    #
+    # The function walks the tree with an explicit stack of frames. A frame
+    # is the node, the position (`pc`) of the action to resume at, the
+    # iterator of the follow in progress and the node's variables. Every
+    # action is a block guarded by `if pc == <position>:`, and blocks are
+    # laid out in document order, so a block passes control on by setting
+    # `pc` and falling through; a cond skips the cases it does not take the
+    # same way. A follow pushes the current frame and restarts the loop at
+    # the child, and the frame is popped when the child's actions are done,
+    # so actions run in the same order as with the recursive evaluator.
+    def __init__(self, inline: FrozenSet[str]):
+        self.inline = inline
+        # source lines, and (indent, label) for jumps to positions not known
+        # when they are written
+        self.lines: List[Any] = []
+        self.labels: List[Optional[int]] = []
+        self.pcs = 1
+        self.frame = ""
+        # hoisted table lookups: (table, name) -> local name
+        self.hoisted: Dict[Tuple[str, str], str] = {}
+        self.result_names: Dict[str, str] = {}
+        self.requires: Dict[str, Set[str]] = {"pred_fns": set(), "follow_dirs": set(),
+                                              "selectors": set(), "select_orders": set()}
+
+    def generate(self, order: List[Dict[str, Any]]) -> str:
+        if not analysis.action_types(order) <= CODEGEN_ACTIONS:
+            raise _Unsupported("actions")
+        if analysis.uses_randomness(order):
+            raise _Unsupported("randomness")
+        used = analysis.env_vars(order)
+        if not used <= set(NODE_VARS) | set(RUN_VARS):
+            raise _Unsupported("variables")
+        node_vars = sorted(var for var in used if var in NODE_VARS and var != "$node")
+        self.frame = ", ".join(["node", "pc", "it"] + [self._var(var) for var in node_vars])
+
+        end = self._label()
+        self._order(order, end)
+        self._bind(end, self.pcs)
+
+        lines = ["def traverse(root, visited, followed, results, pred_fns, follow_dirs, selectors, select_orders):"]
+        lines.extend(f"    {local} = {table}[{name!r}]" for (table, name), local in self.hoisted.items())
+        lines.extend(f"    {local} = None" for local in self.result_names.values())
+        lines.extend(["    stack = []",
+                      "    push = stack.append",
+                      "    pop = stack.pop",
+                      "    node = root",
+                      "    pc = 0",
+                      "    it = None",
+                      "    while True:",
+                      "        if pc == 0:"])
+        lines.extend(f"            {self._var(var)} = {NODE_VARS[var]}" for var in node_vars)
+        lines.append("            pc = 1")
+        for line in self.lines:
+            if isinstance(line, tuple):
+                indent, label = line
+                line = "    " * indent + f"pc = {self.labels[label]}"
+            lines.append(line)
+        lines.extend(["        if not stack:",
+                      "            return",
+                      f"        {self.frame} = pop()"])
+        return "\n".join(lines) + "\n"
+
+    def _label(self) -> int:
+        self.labels.append(None)
+        return len(self.labels) - 1
+
+    def _bind(self, label: int, pc: int) -> None:
+        self.labels[label] = pc
+
+    def _emit(self, indent: int, line: str) -> None:
+        self.lines.append("    " * indent + line)
+
+    def _jump(self, indent: int, label: int) -> None:
+        self.lines.append((indent, label))
+
+    def _order(self, order: List[Dict[str, Any]], end: int) -> None:
+        # blocks of `order` from position `self.pcs` on, passing control to
+        # label `end` after the last
+        for i, action in enumerate(order):
+            nxt = end if i == len(order) - 1 else self._label()
+            pc = self.pcs
+            self.pcs += 1
+            if "cond" in action:
+                self._cond(action, pc, nxt)
+            elif "visit" in action:
+                self._visit(action, pc, nxt)
+            else:
+                self._follow(action, pc, nxt)
+            if nxt != end:
+                self._bind(nxt, self.pcs)
+
+    def _cond(self, action: Dict[str, Any], pc: int, nxt: int) -> None:
+        # the test jumps to the first block of the passing case; the cases'
+        # blocks follow the test, and each jumps past the others when done
+        cases = action["cond"]
+        starts = [self._label() if case.get("order") else nxt for case in cases]
+        self._emit(2, f"if pc == {pc}:")
+        for i, case in enumerate(cases):
+            self._emit(3, f"{'if' if i == 0 else 'elif'} {self._pred(case['pred'], case)}:")
+            self._jump(4, starts[i])
+        self._emit(3, "else:")
+        self._jump(4, nxt)
+        for case, start in zip(cases, starts):
+            if case.get("order"):
+                self._bind(start, self.pcs)
+                self._order(case["order"], nxt)
+
+    def _visit(self, action: Dict[str, Any], pc: int, nxt: int) -> None:
+        test = self._pred(action["visit"], action)
+        self._emit(2, f"if pc == {pc}:")
+        self._emit(3, "if node not in visited:")
+        self._emit(4, "visited.add(node)")
+        result_name = action.get("result-name")
+        if result_name:
+            local = self._result(result_name)
+            self._emit(4, f"if {test}:")
+            self._emit(5, f"if {local} is None:")
+            self._emit(6, f"{local} = results[{result_name!r}] = []")
+            self._emit(5, f"{local}.append(node)")
+        else:
+            self._emit(4, test)
+        self._jump(3, nxt)
+
+    def _follow(self, action: Dict[str, Any], pc: int, nxt: int) -> None:
+        direction = action["follow"]
+        args = self._args(action.get("args", []), action.get("kwargs", {}))
+        if f"dir:{direction}" in self.inline and not args:
+            nodes = INLINE_DIRS[direction]
+        else:
+            nodes = f"{self._hoist('follow_dirs', direction)}({_join('node', args)})"
+
+        name, select_args = self._spec(action.get("select", "all"), resolve=True)
+        if name != "all" or "select:all" not in self.inline:
+            nodes = f"{self._hoist('selectors', name)}({_join(nodes, 'visited, followed', select_args)})"
+
+        # like the interpreter, select-order arguments are not resolved
+        name, order_args = self._spec(action.get("select-order", "id"), resolve=False)
+        if name != "id" or "select-order:id" not in self.inline:
+            nodes = f"{self._hoist('select_orders', name)}({_join(nodes, order_args)})"
+
+        self._emit(2, f"if pc == {pc}:")
+        self._emit(3, "if it is None:")
+        self._emit(4, f"it = iter({nodes})")
+        self._emit(3, "for child in it:")
+        self._emit(4, "if child not in followed:")
+        self._emit(5, "followed.add(child)")
+        self._emit(5, f"push(({self.frame}))")
+        self._emit(5, "node = child")
+        self._emit(5, "pc = 0")
+        self._emit(5, "it = None")
+        self._emit(5, "break")
+        self._emit(3, "else:")
+        self._emit(4, "it = None")
+        self._jump(4, nxt)
+        self._emit(3, "if pc == 0:")
+        self._emit(4, "continue")
+
+    def _spec(self, spec: Any, resolve: bool) -> Tuple[str, str]:
+        if isinstance(spec, str):
+            return spec, ""
+        if isinstance(spec, dict):
+            return spec["name"], self._args(spec.get("args", []), spec.get("kwargs", {}), resolve)
+        raise _Unsupported("spec")
+
+    def _pred(self, pred: Any, spec: Dict[str, Any]) -> str:
+        # expression testing `pred` with the arguments of `spec`
+        if predicates.is_composite(pred):
+            op = predicates.operator(pred)
+            tests = [self._pred(operand["pred"], operand) for operand in pred[op]]
+            return "(" + f" {op} ".join(tests) + ")"
+        args = spec.get("args", [])
+        kwargs = spec.get("kwargs", {})
+        if f"pred:{pred}" in self.inline and not kwargs and len(args) == INLINE_PREDS[pred][0]:
+            return INLINE_PREDS[pred][1].format(*(self._arg(arg, True) for arg in args))
+        return f"{self._hoist('pred_fns', pred)}({self._args(args, kwargs)})"
+
+    def _args(self, args: List[Any], kwargs: Dict[str, Any], resolve: bool = True) -> str:
+        parts = [self._arg(arg, resolve) for arg in args]
+        if kwargs:
+            parts.append("**{" + ", ".join(f"{key!r}: {self._arg(arg, resolve)}"
+                                           for key, arg in kwargs.items()) + "}")
+        return ", ".join(parts)
+
+    def _arg(self, arg: Any, resolve: bool) -> str:
+        if resolve and isinstance(arg, str) and arg.startswith("$"):
+            return self._var(arg)
+        if not _literal(arg):
+            raise _Unsupported("argument")
+        return repr(arg)
+
+    def _var(self, var: str) -> str:
+        if var in RUN_VARS:
+            return RUN_VARS[var]
+        if var == "$node":
+            return "node"
+        return "v_" + var[1:]
+
+    def _hoist(self, table: str, name: str) -> str:
+        local = self.hoisted.get((table, name))
+        if local is None:
+            local = self.hoisted[(table, name)] = f"{table[0]}{len(self.hoisted)}"
+            self.requires[table].add(name)
+        return local
+
+    def _result(self, name: str) -> str:
+        local = self.result_names.get(name)
+        if local is None:
+            local = self.result_names[name] = f"r{len(self.result_names)}"
+        return local
+
+
+def _join(*parts: str) -> str:
+    return ", ".join(part for part in parts if part)
+
+
+def _literal(value: Any) -> bool:
+    # values whose repr is Python source for an equal value
+    if isinstance(value, float):
+        return math.isfinite(value)
+    if isinstance(value, LITERAL_TYPES):
+        return True
+    if isinstance(value, list):
+        return all(_literal(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and _literal(item) for key, item in value.items())
+    return False
@@ -0,0 +1,249 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from . import analysis
+from . import predicates
+from .environment import UNSET
+from .fold import FOLD_VARS
+
+# node environment -> (positional arguments, keyword arguments)
+Binder = Callable[[Dict[str, Any]], Tuple[List[Any], Dict[str, Any]]]
+
+# orders whose binders a `BinderCache` keeps
+MAX_ORDERS = 1024
+
+
+def is_ref(arg: Any) -> bool:
+    """
+    Return True if `arg` is a `$` reference to an environment variable.
+    """
+    return isinstance(arg, str) and arg.startswith("$")
+
+
+class Layout:
+    """
+    Slot numbers of the variables the actions of one order reference.
+
+    Every node environment of a traversal keeps the values of these
+    variables in a list (`environment.Environment.slots`), filled on first
+    use, so a compiled reference reads its variable by position rather than
+    by name.
+    """
+    __slots__ = ("names", "index")
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.index: Dict[str, int] = {}
+
+    def slot(self, name: str) -> int:
+        """
+        Returns:
+            The slot of the variable `name`, assigned on first request.
+        """
+        slot = self.index.get(name)
+        if slot is None:
+            slot = self.index[name] = len(self.names)
+            self.names.append(name)
+        return slot
+
+
+def compile_args(args: List[Any], kwargs: Dict[str, Any], known: Iterable[str],
+                 layout: Optional[Layout] = None) -> Binder:
+    """
+    Compile the arguments of one action into a function that resolves them
+    in a node environment.
+
+    Which arguments are `$` references is decided once, here, rather than at
+    every node: literal arguments are bound as they are, and each reference
+    becomes a slot of `layout`, read from the environment's slots.
+    Arguments without references are resolved once and for all.
+
+    Args:
+        args: Positional arguments of the action.
+        kwargs: Keyword arguments of the action.
+        known: Names of the variables that may be referenced.
+        layout: Slots of the order's variables, extended with the variables
+            referenced here. Without one, references are looked up by name,
+            in environments that are plain dicts.
+
+    Returns:
+        Function mapping a node environment to the resolved positional and
+        keyword arguments.
+
+    Raises:
+        ValueError: If an argument references a variable not in `known`.
+    """
+    known = set(known)
+    for arg in list(args) + list(kwargs.values()):
+        if is_ref(arg) and arg not in known:
+            raise ValueError(f"Unknown variable: {arg}")
+
+    refs = [(i, arg) for i, arg in enumerate(args) if is_ref(arg)]
+    keyword_refs = [(key, arg) for key, arg in kwargs.items() if is_ref(arg)]
+    if not refs and not keyword_refs:
+        bound = (list(args), dict(kwargs))
+        return lambda env: bound
+
+    if layout is None:
+        def bind_names(env: Dict[str, Any]) -> Tuple[List[Any], Dict[str, Any]]:
+            resolved, keywords = list(args), dict(kwargs)
+            for i, name in refs:
+                resolved[i] = env.get(name)
+            for key, name in keyword_refs:
+                keywords[key] = env.get(name)
+            return resolved, keywords
+        return bind_names
+
+    template = list(args)
+    positional = [(i, layout.slot(name)) for i, name in refs]
+    keywords = [(key, layout.slot(name)) for key, name in keyword_refs]
+
+    def bind(env: Any) -> Tuple[List[Any], Dict[str, Any]]:
+        slots = env.slots
+        if env.layout is not layout:
+            slots = env.use(layout)
+        resolved = template[:]
+        for i, slot in positional:
+            value = slots[slot]
+            resolved[i] = env.fill(slot) if value is UNSET else value
+        if not keywords:
+            return resolved, kwargs
+        bound = dict(kwargs)
+        for key, slot in keywords:
+            value = slots[slot]
+            bound[key] = env.fill(slot) if value is UNSET else value
+        return resolved, bound
+    return bind
+
+
+def compile_order(order: List[Dict[str, Any]], env_vars: Iterable[str]) -> Dict[int, Binder]:
+    """
+    Compile the arguments of every action of `order`, including the cases
+    of `cond` actions, the operands of composite predicates, the values of
+    `set!` actions, the group keys of `aggregate` actions and `select`
+    specs.
+
+    Args:
+        order: A traversal order.
+        env_vars: Names of the variables every node environment holds.
+            Variables bound by a `set!` and the `$fold.<name>` variables of
+            the `fold` actions anywhere in `order` are known too. The
+            arguments of a `fold` may only reference `fold.FOLD_VARS`.
+            The keys of the `analysis.KEYED_SELECTORS` and
+            `analysis.KEYED_DIRECTIONS` are names, never resolved.
+
+    Returns:
+        Binders keyed by the `id()` of the action, case, operand or select
+        spec whose arguments they resolve.
+
+    Raises:
+        ValueError: If an argument references an unknown variable, or if
+            `$payload` is referenced after a `payload-map` action: maps are
+            applied when the traversal is done (see
+            `payload_map.PayloadMapStage`), so it would not be the mapped
+            payload.
+    """
+    if analysis.payload_read_after_map(order):
+        raise ValueError("Invalid order: $payload referenced after a payload-map action")
+    known = set(env_vars) | analysis.bound_vars(order) | analysis.fold_vars(order)
+    layout = Layout()
+    binders: Dict[int, Binder] = {}
+    for action in analysis.walk_actions(order):
+        if "cond" in action:
+            for case in action["cond"]:
+                binders[id(case)] = compile_args(case.get("args", []), case.get("kwargs", {}), known, layout)
+                _compile_operands(case["pred"], known, binders, layout)
+        elif "set!" in action:
+            binders[id(action)] = compile_args([], action["set!"], known, layout)
+        elif "fold" in action:
+            # fold values are computed at nodes the traversal may not reach,
+            # in the plain dicts of `fold.fold_env`
+            binders[id(action)] = compile_args(action.get("args", []), {}, FOLD_VARS)
+        elif "aggregate" in action:
+            # the group key resolves as the keyword argument "by"
+            by = {"by": action["by"]} if "by" in action else {}
+            binders[id(action)] = compile_args(action.get("args", []), by, known, layout)
+        elif action.get("follow") in analysis.KEYED_DIRECTIONS:
+            binders[id(action)] = _compile_keyed(action.get("args", []), action.get("kwargs", {}),
+                                                 analysis.KEYED_DIRECTIONS[action["follow"]], known, layout)
+        else:
+            binders[id(action)] = compile_args(action.get("args", []), action.get("kwargs", {}), known, layout)
+            if "visit" in action:
+                _compile_operands(action["visit"], known, binders, layout)
+        select = action.get("select") if "follow" in action else None
+        if isinstance(select, dict):
+            if select.get("name") in analysis.KEYED_SELECTORS:
+                binders[id(select)] = _compile_keyed(select.get("args", []), select.get("kwargs", {}),
+                                                     analysis.KEYED_SELECTORS[select["name"]], known, layout)
+            else:
+                binders[id(select)] = compile_args(select.get("args", []), select.get("kwargs", {}), known, layout)
+    return binders
+
+
+def _compile_keyed(args: List[Any], kwargs: Dict[str, Any], position: int, known: Iterable[str],
+                   layout: Layout) -> Binder:
+    # the key (the argument at `position`, or the keyword argument "key")
+    # names a sort key, a node variable or a payload key of every candidate:
+    # it is passed on as it is rather than resolved at the current node
+    args, kwargs = list(args), dict(kwargs)
+    if "key" in kwargs:
+        key = kwargs.pop("key")
+        bind = compile_args(args, kwargs, known, layout)
+
+        def bind_keyword(env: Dict[str, Any]) -> Tuple[List[Any], Dict[str, Any]]:
+            resolved, keywords = bind(env)
+            return resolved, dict(keywords, key=key)
+        return bind_keyword
+    if len(args) <= position:
+        return compile_args(args, kwargs, known, layout)
+    key = args.pop(position)
+    bind = compile_args(args, kwargs, known, layout)
+
+    def bind_positional(env: Dict[str, Any]) -> Tuple[List[Any], Dict[str, Any]]:
+        resolved, keywords = bind(env)
+        return resolved[:position] + [key] + resolved[position:], keywords
+    return bind_positional
+
+
+def _compile_operands(pred: Any, known: Iterable[str], binders: Dict[int, Binder], layout: Layout) -> None:
+    for operand in predicates.leaf_operands(pred):
+        binders[id(operand)] = compile_args(operand.get("args", []), operand.get("kwargs", {}), known, layout)
+
+
+class BinderCache:
+    """
+    Compiled binders of the orders evaluated last, so that evaluating the
+    same order again does not compile it again.
+
+    An order is looked up by identity. Its entry holds on to the order, so
+    that its id is not reused, and to its normalized text and the variables
+    it was compiled for, so that an order changed in place (or an evaluator
+    given new variables) is compiled again.
+
+    Args:
+        max_orders: Maximum number of orders kept.
+    """
+    def __init__(self, max_orders: int = MAX_ORDERS):
+        self.max_orders = max_orders
+        # id(order) -> (order, text, variables, binders)
+        self.plans: Dict[int, Tuple[List[Dict[str, Any]], str, frozenset, Dict[int, Binder]]] = {}
+
+    def get(self, order: List[Dict[str, Any]], env_vars: Iterable[str]) -> Dict[int, Binder]:
+        """
+        Returns:
+            The binders of `order`, as `compile_order` returns them.
+
+        Raises:
+            ValueError: If an argument references an unknown variable.
+        """
+        text = analysis.normalize_order(order)
+        variables = frozenset(env_vars)
+        plan = self.plans.get(id(order))
+        if plan is not None and plan[0] is order and plan[1] == text and plan[2] == variables:
+            return plan[3]
+        binders = compile_order(order, variables)
+        plans = self.plans
+        if len(plans) >= self.max_orders:
+            # replaced rather than cleared: runs in other threads may be
+            # reading the old one
+            plans = self.plans = {}
+        plans[id(order)] = (order, text, variables, binders)
+        return binders
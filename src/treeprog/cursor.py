@@ -0,0 +1,125 @@
+from collections.abc import Sequence
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from .index import NodeRange
+
+# selector name -> function mapping the number of candidates (and the
+# selector's arguments) to the positions it selects, for the selectors whose
+# choice depends on positions only
+POSITIONS: Dict[str, Callable] = {
+    "all": lambda size: range(size),
+    "none": lambda size: (),
+    "first": lambda size: (0,) if size else (),
+    "last": lambda size: (size - 1,) if size else (),
+    "nth": lambda size, n: (n % size,) if -size <= n < size else (),
+}
+
+
+class Cursor:
+    """
+    Which positions of the nodes of one follow direction have already been
+    selected at one node, so that a later `rest` selector only looks at the
+    others.
+
+    Taken positions are flagged in a bytearray, and `next` is the lowest
+    position not taken yet: runs of taken positions are skipped with
+    `bytearray.find`, so `rest` takes time proportional to the number of
+    nodes it returns rather than to the number of candidates.
+
+    Args:
+        nodes: The candidate nodes of the direction at the node.
+    """
+    __slots__ = ("nodes", "taken", "next", "_positions")
+
+    def __init__(self, nodes: Sequence):
+        self.nodes = nodes
+        self.taken = bytearray(len(nodes))
+        self.next = 0
+        # node -> position, built on first use
+        self._positions: Optional[Dict[Any, int]] = None
+
+    def take(self, positions: Iterable[int]) -> None:
+        """
+        Flag `positions` as selected.
+        """
+        taken = self.taken
+        for position in positions:
+            taken[position] = 1
+        if self.next < len(taken) and taken[self.next]:
+            next = taken.find(0, self.next)
+            self.next = next if next >= 0 else len(taken)
+
+    def take_nodes(self, nodes: Iterable[Any]) -> None:
+        """
+        Flag the positions of `nodes` as selected. Nodes that are not
+        candidates are ignored.
+        """
+        self.take(p for p in map(self.position, nodes) if p is not None)
+
+    def record(self, name: str, selected: Iterable[Any], *args: Any, **kwargs: Any) -> None:
+        """
+        Flag the positions chosen by a selector as selected.
+
+        Args:
+            name: Name of the selector.
+            selected: The nodes it selected.
+            args: Its positional arguments.
+            kwargs: Its keyword arguments.
+        """
+        positions = POSITIONS.get(name)
+        if positions is not None:
+            self.take(positions(len(self.taken), *args, **kwargs))
+        else:
+            self.take_nodes(selected)
+
+    def position(self, node: Any) -> Optional[int]:
+        """
+        Returns:
+            The position of `node` among the candidates, or None.
+        """
+        if isinstance(self.nodes, NodeRange):
+            i = self.nodes.index.ids.get(node)
+            return self.nodes.ids.index(i) if i is not None and i in self.nodes.ids else None
+        if self._positions is None:
+            self._positions = {n: p for p, n in enumerate(self.nodes)}
+        return self._positions.get(node)
+
+    def rest(self) -> List[int]:
+        """
+        Returns:
+            The positions not selected yet, in increasing order.
+        """
+        taken = self.taken
+        size = len(taken)
+        free = []
+        position = self.next
+        while position < size:
+            # skip a run of taken positions, then keep the run of free ones
+            position = taken.find(0, position)
+            if position < 0:
+                break
+            end = taken.find(1, position)
+            if end < 0:
+                end = size
+            free.extend(range(position, end))
+            position = end
+        return free
+
+
+def rest_sel(cursor: Cursor, nodes: Sequence, visited: Any, followed: Any) -> List[Any]:
+    """
+    `utils.rest_sel` through a cursor: the nodes of `nodes` whose positions
+    were not selected yet and that have not been visited or followed. The
+    returned positions are flagged as selected.
+
+    Args:
+        cursor: Cursor of the follow direction at the current node.
+        nodes: The candidate nodes.
+        visited: Set of nodes that have been visited.
+        followed: Set of nodes that have been followed.
+
+    Returns:
+        List of nodes.
+    """
+    positions = cursor.rest()
+    cursor.take(positions)
+    return [n for n in map(nodes.__getitem__, positions) if n not in followed and n not in visited]
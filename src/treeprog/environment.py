@@ -0,0 +1,168 @@
+from typing import Any, Dict, Iterable, List, Optional
+
+_MISSING = object()
+_ABSENT = object()
+# a slot (see `Environment.use`) whose variable has not been looked up yet
+UNSET = object()
+
+
+class Frame:
+    """
+    One link of a chain of `set!` bindings.
+
+    A frame is frozen as soon as another environment starts inheriting from
+    it, after which its bindings never change: a later `set!` in the owning
+    environment starts a new frame on top of it instead (copy-on-write).
+    Because every frame above a frozen one is frozen too, the result of a
+    lookup that had to walk up the chain is cached in each frame on the way
+    (path compression), so repeated lookups are O(1) however long the chain.
+
+    Args:
+        parent: The frame this one extends, or None.
+    """
+    __slots__ = ("vars", "parent", "frozen", "_cache")
+
+    def __init__(self, parent: Optional["Frame"] = None):
+        self.vars: Dict[str, Any] = {}
+        self.parent = parent
+        self.frozen = False
+        # bindings (or their absence) found in the frozen ancestors
+        self._cache: Dict[str, Any] = {}
+
+    def lookup(self, key: str, default: Any = _MISSING) -> Any:
+        """
+        Args:
+            key: Name of the variable.
+            default: Value returned if `key` is not bound. If not given, a
+                KeyError is raised instead.
+
+        Returns:
+            The innermost binding of `key`.
+        """
+        value = self.vars.get(key, _MISSING)
+        if value is _MISSING:
+            cache = self._cache
+            value = cache[key] if key in cache else self._find(key)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+    def _find(self, key: str) -> Any:
+        path = [self]
+        frame = self.parent
+        value = _MISSING
+        while frame is not None:
+            value = frame.vars.get(key, _MISSING)
+            if value is not _MISSING:
+                break
+            if key in frame._cache:
+                value = frame._cache[key]
+                break
+            path.append(frame)
+            frame = frame.parent
+        for frame in path:
+            frame._cache[key] = value
+        return value
+
+
+class Environment(dict):
+    """
+    Variables visible at one node.
+
+    The dictionary itself holds the node's own variables (`$node`,
+    `$payload`, ...), which are computed for every node. Variables bound with
+    `set!` live in a chain of `Frame`s instead, so a followed node inherits
+    every binding of the node that led to it in O(1), without copying: its
+    environment starts on the (now frozen) frame of its parent.
+
+    It also carries the selection state of the node's `follow` actions
+    (`cursors`, by direction), which lives exactly as long as the node's
+    evaluation, and the `slots` of the variables the compiled actions of
+    the order reference (see `compiler.Layout`), each looked up by name at
+    most once per node.
+
+    Args:
+        values: The node's own variables.
+        frame: Bindings inherited from the parent node, or None.
+    """
+    __slots__ = ("frame", "cursors", "slots", "layout")
+
+    def __init__(self, values: Iterable = (), frame: Optional[Frame] = None):
+        super().__init__(values)
+        self.frame = frame if frame is not None else Frame()
+        self.cursors: Optional[Dict[str, Any]] = None
+        self.slots: Optional[List[Any]] = None
+        self.layout: Any = None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        dict.__setitem__(self, key, value)
+        if self.layout is not None:
+            self._store(key, value)
+
+    def __missing__(self, key: str) -> Any:
+        return self.frame.lookup(key)
+
+    def __contains__(self, key: Any) -> bool:
+        return dict.__contains__(self, key) or self.frame.lookup(key, _ABSENT) is not _ABSENT
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.frame.lookup(key, default)
+
+    def bind(self, key: str, value: Any) -> None:
+        """
+        Bind `key` to `value` here and in every node followed from now on.
+
+        Args:
+            key: Name of the variable.
+            value: Its value.
+        """
+        if self.frame.frozen:
+            self.frame = Frame(self.frame)
+        self.frame.vars[key] = value
+        # shadows a node variable of the same name in this node as well
+        if dict.__contains__(self, key):
+            dict.__setitem__(self, key, value)
+        if self.layout is not None:
+            self._store(key, value)
+
+    def use(self, layout: Any) -> List[Any]:
+        """
+        Start reading the variables of `layout` by slot.
+
+        Args:
+            layout: A `compiler.Layout`.
+
+        Returns:
+            The slots, none of them looked up yet.
+        """
+        self.layout = layout
+        self.slots = [UNSET] * len(layout.names)
+        return self.slots
+
+    def fill(self, slot: int) -> Any:
+        """
+        Look up the variable of `slot` and keep its value there.
+
+        Returns:
+            The value of the variable, None if it is not bound.
+        """
+        value = self.slots[slot] = self.get(self.layout.names[slot])
+        return value
+
+    def _store(self, key: str, value: Any) -> None:
+        slot = self.layout.index.get(key)
+        if slot is not None:
+            self.slots[slot] = value
+
+    def extend(self) -> Frame:
+        """
+        Returns:
+            The bindings for a node followed from this one. Bindings made
+            here afterwards are not visible through it.
+        """
+        self.frame.frozen = True
+        return self.frame
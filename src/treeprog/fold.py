@@ -0,0 +1,103 @@
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+# variables the value of a `fold` may be computed from: the fold visits
+# nodes the traversal may never reach, so only these are available
+FOLD_VARS = {"$node", "$payload", "$num_children", "$is_leaf"}
+
+# combiner name -> (init, step): a node's folded value starts as
+# init(value of the node) and takes in the folded value of each child, left
+# to right, as acc = step(acc, child's folded value)
+COMBINERS: Dict[str, Tuple[Callable, Callable]] = {
+    "sum": (lambda v: v, lambda acc, c: acc + c),
+    "count": (lambda v: 1, lambda acc, c: acc + c),
+    "height": (lambda v: 0, lambda acc, c: max(acc, c + 1)),
+    "max": (lambda v: v, lambda acc, c: c if c > acc else acc),
+    "min": (lambda v: v, lambda acc, c: c if c < acc else acc),
+    "all": (lambda v: bool(v), lambda acc, c: acc and c),
+    "any": (lambda v: bool(v), lambda acc, c: acc or c),
+}
+
+
+def fold_env(node: Any, children: List[Any]) -> Dict[str, Any]:
+    """
+    Args:
+        node: A node.
+        children: Its children.
+
+    Returns:
+        The variables of `node` a fold value may be computed from.
+    """
+    return {
+        "$node": node,
+        "$payload": node.payload,
+        "$num_children": len(children),
+        "$is_leaf": len(children) == 0,
+    }
+
+
+def fold(root: Any, init: Callable, step: Callable, value: Callable[[Any, List[Any]], Any],
+         cache: Dict[Any, Any]) -> Any:
+    """
+    Fold the subtree of `root` bottom-up in one post-order pass.
+
+    Only the path from `root` to the current node is kept, with one
+    accumulator per node on it, so the live state is O(depth). The folded
+    value of every node of the subtree is stored in `cache`, and subtrees
+    already in `cache` are not visited again.
+
+    Args:
+        root: Root of the subtree.
+        init: Function mapping the value of a node to its initial accumulator.
+        step: Function combining an accumulator with the folded value of a
+            child.
+        value: Function mapping a node and its children to its value.
+        cache: Folded values by node; read and updated.
+
+    Returns:
+        The folded value of `root`.
+    """
+    if root in cache:
+        return cache[root]
+    children = root.children
+    stack = [[root, iter(children), init(value(root, children))]]
+    while stack:
+        top = stack[-1]
+        for child in top[1]:
+            if child in cache:
+                top[2] = step(top[2], cache[child])
+                continue
+            grandchildren = child.children
+            stack.append([child, iter(grandchildren), init(value(child, grandchildren))])
+            break
+        else:
+            stack.pop()
+            cache[top[0]] = top[2]
+            if stack:
+                stack[-1][2] = step(stack[-1][2], top[2])
+    return cache[root]
+
+
+async def afold(root: Any, init: Callable, step: Callable, value: Callable[[Any, List[Any]], Any],
+                cache: Dict[Any, Any], children: Callable[[Any], Awaitable[List[Any]]]) -> Any:
+    """
+    `fold` for trees whose children are fetched with `await children(node)`.
+    """
+    if root in cache:
+        return cache[root]
+    kids = await children(root)
+    stack = [[root, iter(kids), init(value(root, kids))]]
+    while stack:
+        top = stack[-1]
+        for child in top[1]:
+            if child in cache:
+                top[2] = step(top[2], cache[child])
+                continue
+            kids = await children(child)
+            stack.append([child, iter(kids), init(value(child, kids))])
+            break
+        else:
+            stack.pop()
+            cache[top[0]] = top[2]
+            if stack:
+                stack[-1][2] = step(stack[-1][2], top[2])
+    return cache[root]
@@ -0,0 +1,105 @@
+from collections import deque
+from typing import Any, Dict, Iterable, Optional, Tuple
+from .index import NodeRange, TreeIndex
+
+
+class Frontier:
+    """
+    Stack of the nodes an iterative traversal still has to evaluate, each
+    with the `set!` bindings it inherits.
+
+    A node is pushed at most once per traversal: nodes that were pushed
+    before, whether or not they have been evaluated since, are dropped at
+    push time. The frontier therefore never holds more entries than the tree
+    has nodes, however the follow directions of an order revisit them.
+
+    Pushed nodes are remembered in a bytearray indexed by node id when the
+    traversal has a `TreeIndex`, and in a set otherwise.
+
+    Args:
+        index: Index of the traversed tree, or None.
+    """
+    def __init__(self, index: Optional[TreeIndex] = None):
+        self.index = index
+        self.stack: deque = deque()
+        self.seen: Any = bytearray(len(index)) if index is not None else set()
+        self.pushed = 0
+        self.duplicates = 0
+        self.popped = 0
+        self.max_size = 0
+
+    def __len__(self) -> int:
+        return len(self.stack)
+
+    def push(self, nodes: Iterable[Any], scope: Any) -> None:
+        """
+        Push the nodes of `nodes` that were never pushed before, in order.
+
+        Args:
+            nodes: The nodes.
+            scope: The `set!` bindings they inherit.
+        """
+        stack = self.stack
+        before = len(stack)
+        offered = 0
+        if self.index is None:
+            seen = self.seen
+            for node in nodes:
+                offered += 1
+                if node not in seen:
+                    seen.add(node)
+                    stack.append((node, scope))
+        elif isinstance(nodes, NodeRange) and nodes.index is self.index:
+            # the ids are known without looking the nodes up
+            marks, lookup = self.seen, self.index.nodes
+            offered = len(nodes)
+            for i in nodes.ids:
+                if not marks[i]:
+                    marks[i] = 1
+                    stack.append((lookup[i], scope))
+        else:
+            marks, ids = self.seen, self.index.ids
+            for node in nodes:
+                offered += 1
+                i = ids[node]
+                if not marks[i]:
+                    marks[i] = 1
+                    stack.append((node, scope))
+        added = len(stack) - before
+        self.pushed += added
+        self.duplicates += offered - added
+        if len(stack) > self.max_size:
+            self.max_size = len(stack)
+
+    def use_index(self, index: TreeIndex) -> None:
+        """
+        Remember pushed nodes by their id in `index` from now on, including
+        the nodes pushed so far.
+
+        Args:
+            index: Index of the traversed tree.
+        """
+        if self.index is None:
+            marks, ids = bytearray(len(index)), index.ids
+            for node in self.seen:
+                marks[ids[node]] = 1
+            self.index, self.seen = index, marks
+
+    def pop(self) -> Tuple[Any, Any]:
+        """
+        Returns:
+            The last pushed node that is still on the frontier, and its
+            bindings.
+        """
+        self.popped += 1
+        return self.stack.pop()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Frontier metrics of the traversal so far: the number of nodes
+            pushed and popped, the number of pushes dropped as duplicates,
+            and the largest frontier size.
+        """
+        return {"pushed": self.pushed, "popped": self.popped,
+                "duplicates": self.duplicates, "max_size": self.max_size}
@@ -0,0 +1,120 @@
+import dataclasses
+import hashlib
+import json
+from collections.abc import Mapping
+from typing import Any, Dict
+
+DIGEST_SIZE = 16
+
+
+def payload_digest(payload: Any) -> bytes:
+    """
+    Digest of a node payload. Payloads are hashed through their canonical
+    JSON form. Values JSON cannot encode are hashed through a stable form
+    of their content:
+
+    - the value returned by their `__digest__()` method, if they have one;
+    - the fields of a dataclass;
+    - the items of any other mapping (e.g. `adapters.FileStat`);
+    - the elements of a set, in a canonical order;
+    - the attributes of any other object that has them;
+
+    along with their type name. Only values with none of these are hashed
+    through their `repr`.
+
+    Args:
+        payload: Node payload.
+    """
+    data = json.dumps(payload, sort_keys=True, default=_stable).encode()
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def _stable(value: Any) -> Any:
+    # a JSON-encodable form of `value` that changes when its content does
+    kind = f"{type(value).__module__}.{type(value).__qualname__}"
+    digest = getattr(type(value), "__digest__", None)
+    if digest is not None:
+        return {"type": kind, "digest": digest(value)}
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {"type": kind, "fields": {f.name: getattr(value, f.name) for f in dataclasses.fields(value)}}
+    if isinstance(value, Mapping):
+        return {"type": kind, "items": [[key, item] for key, item in value.items()]}
+    if isinstance(value, (set, frozenset)):
+        return {"type": kind, "elements": sorted(json.dumps(element, sort_keys=True, default=_stable)
+                                                 for element in value)}
+    if hasattr(value, "__dict__"):
+        return {"type": kind, "attributes": vars(value)}
+    return repr(value)
+
+
+class TreeHasher:
+    """
+    Merkle hashes of subtrees. The digest of a node covers its payload and,
+    in order, the digests of its children, so two subtrees have the same
+    digest exactly when they have the same shape and the same payloads.
+
+    With `names`, the digest covers the names of the nodes as well.
+
+    Digests are cached per node. After a node's payload or name changes or
+    its children are replaced, call `invalidate` on it; the next `digest`
+    call only rehashes the invalidated path instead of the whole tree.
+
+    Args:
+        names: Hash node names along with payloads.
+    """
+    def __init__(self, names: bool = False):
+        self.names = names
+        self.digests: Dict[Any, bytes] = {}
+
+    def digest(self, node: Any) -> bytes:
+        """
+        Args:
+            node: Root of the subtree to hash.
+
+        Returns:
+            The Merkle digest of the subtree rooted at `node`.
+        """
+        digests = self.digests
+        if node in digests:
+            return digests[node]
+
+        # iterative post-order so that deep trees do not hit the recursion limit
+        stack = [(node, False)]
+        while stack:
+            n, expanded = stack.pop()
+            if n in digests:
+                continue
+            children = n.children
+            if expanded:
+                h = hashlib.blake2b(payload_digest(n.payload), digest_size=DIGEST_SIZE)
+                if self.names:
+                    h.update(payload_digest(n.name))
+                for child in children:
+                    h.update(digests[child])
+                digests[n] = h.digest()
+            else:
+                stack.append((n, True))
+                stack.extend((c, False) for c in children if c not in digests)
+        return digests[node]
+
+    def fingerprint(self, node: Any) -> str:
+        """
+        Args:
+            node: Root of the subtree to fingerprint.
+
+        Returns:
+            Hex form of `digest(node)`.
+        """
+        return self.digest(node).hex()
+
+    def invalidate(self, node: Any) -> None:
+        """
+        Forget the cached digests of `node` and its ancestors. Call this after
+        changing the payload, the name or the children of `node`.
+
+        Args:
+            node: The node that changed.
+        """
+        while node is not None:
+            self.digests.pop(node, None)
+            node = node.parent
@@ -0,0 +1,357 @@
+from typing import Any, Callable, Dict, List, Optional, Set
+from . import adapters
+from . import analysis
+from .environment import Environment
+from .run import RunState
+from .utt_eval import UttEval
+
+# directions under which every node is reached from its parent only, so the
+# evaluation of a node is a self-contained fragment of the results
+INCREMENTAL_DIRS = {"down", "children"}
+
+# actions whose effects are not recorded in the result lists
+UNPATCHABLE_ACTIONS = {"payload-map", "aggregate", "fold"}
+
+# variables whose value lives outside the traversal state
+UNTRACKABLE_VARS = {"$results", "$visited", "$followed"}
+
+# reading one of these makes a node depend on nodes outside its subtree
+PINNING_VARS = {"$parent", "$siblings", "$root", "$ancestors"}
+
+# ... and these pin every ancestor of the reading node as well
+ESCAPING_VARS = {"$root", "$ancestors"}
+
+LAZY_VARS: Dict[str, Callable] = {
+    "$parent": lambda node: node.parent,
+    "$root": lambda node: node.root,
+    "$depth": lambda node: adapters.depth(node),
+    "$siblings": lambda node: adapters.siblings(node),
+    "$ancestors": lambda node: adapters.ancestors(node),
+    "$descendants": lambda node: adapters.descendants(node),
+}
+
+
+class _TracingEnv(Environment):
+    """
+    Node environment that computes the expensive variables on first use and
+    records which variables were read, and whether any of them was inherited
+    from the nodes that led to this one.
+    """
+    def __init__(self, node: Any, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.node = node
+        self.reads: Set[str] = set()
+        self.inherited = False
+
+    def __missing__(self, key: str) -> Any:
+        if key not in LAZY_VARS:
+            value = super().__missing__(key)
+            self.inherited = True
+            return value
+        value = self[key] = LAZY_VARS[key](self.node)
+        return value
+
+    def __getitem__(self, key: str) -> Any:
+        self.reads.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self or key in LAZY_VARS:
+            return self[key]
+        self.reads.add(key)
+        # an ancestor's `set!` could bind it later
+        self.inherited = True
+        return default
+
+
+class _Frame:
+    """
+    Record of evaluating the order at one node: the results it emitted and
+    the frames of the nodes it followed, in evaluation order.
+    """
+    __slots__ = ("node", "tokens", "counts", "pinned", "escapes", "depth", "old")
+
+    def __init__(self, node: Any, old: Optional["_Frame"] = None):
+        self.node = node
+        # (result_name, node) tuples and child frames
+        self.tokens: List[Any] = []
+        # number of results per name in this frame and all frames below it
+        self.counts: Dict[str, int] = {}
+        # the frame read state outside its subtree and is never reused
+        self.pinned = False
+        # some frame in this subtree read $root or $ancestors
+        self.escapes = False
+        # depth of the node if the subtree read $depth, else None
+        self.depth: Optional[int] = None
+        # frame this one replaces during an update
+        self.old = old
+
+    def finish(self, reads: Set[str], inherited: bool = False) -> None:
+        counts: Dict[str, int] = {}
+        pinned = inherited or bool(reads & PINNING_VARS)
+        escapes = bool(reads & ESCAPING_VARS)
+        uses_depth = "$depth" in reads
+        for tok in self.tokens:
+            if isinstance(tok, _Frame):
+                for name, c in tok.counts.items():
+                    counts[name] = counts.get(name, 0) + c
+                pinned = pinned or tok.escapes
+                escapes = escapes or tok.escapes
+                uses_depth = uses_depth or tok.depth is not None
+            else:
+                counts[tok[0]] = counts.get(tok[0], 0) + 1
+        self.counts = counts
+        self.pinned = pinned
+        self.escapes = escapes
+        self.depth = adapters.depth(self.node) if uses_depth else None
+
+
+class IncrementalUttEval(UttEval):
+    """
+    Evaluator that keeps a record of how each node contributed to the results,
+    so that after the tree changes only the affected nodes are evaluated again
+    and the result lists are patched in place.
+
+    Usage::
+
+        inc = IncrementalUttEval()
+        results = inc(root, order)
+        node.payload = new_payload
+        inc.changed(node)
+        results = inc.update()
+
+    Call `changed(node)` after changing the payload of `node` or its list of
+    children (grafting or pruning a subtree below it). `update()` then
+    re-evaluates the changed nodes and their ancestors, reusing the recorded
+    fragment of every other node whose inputs are unchanged. A node's inputs
+    are its subtree and the environment variables it read; reading `$depth`
+    makes the fragment depend on the depth of the node, reading `$parent`,
+    `$siblings`, `$root`, `$ancestors` or a variable bound with `set!` means
+    it is always evaluated again.
+
+    Incremental updates need every node to be reached from its parent only,
+    so they apply to orders that follow `down`/`children` exclusively, draw no
+    random numbers, have no `payload-map`, `aggregate` or `fold` actions and
+    do not read `$results`, `$visited` or `$followed`. For other orders
+    `update()` re-runs the whole order. Custom predicates must make their
+    decisions from their arguments; state they look up on the nodes
+    themselves is not tracked.
+
+    The record belongs to the run of the call, so `changed` and `update`
+    apply to the last call made by the calling thread.
+    """
+    incremental = RunState()
+    _start = RunState()
+    _order = RunState()
+    _root_frame = RunState()
+    _frame = RunState()
+    _old_children = RunState()
+    _dirty = RunState()
+    _fresh = RunState()
+    _updating = RunState()
+
+    def __init__(self, debug=False, seed=None):
+        super().__init__(debug=debug, seed=seed)
+        self.incremental = False
+        self._start: Any = None
+        self._order: Optional[List[Dict[str, Any]]] = None
+        self._root_frame: Optional[_Frame] = None
+        self._frame: Optional[_Frame] = None
+        # old frames of the children of the frame being evaluated, by node
+        self._old_children: Dict[Any, _Frame] = {}
+        self._dirty: Set[Any] = set()
+        self._fresh: List[_Frame] = []
+        self._updating = False
+
+    @staticmethod
+    def supports(order: List[Dict[str, Any]]) -> bool:
+        """
+        Return True if `order` can be re-evaluated incrementally.
+
+        Args:
+            order: A traversal order.
+        """
+        return (analysis.follow_directions(order) <= INCREMENTAL_DIRS
+                and not analysis.uses_randomness(order)
+                and not analysis.action_types(order) & UNPATCHABLE_ACTIONS
+                and not analysis.env_vars(order) & UNTRACKABLE_VARS)
+
+    def _create_env(self, node, order, visited, followed):
+        if not self.incremental:
+            return super()._create_env(node, order, visited, followed)
+        children = node.children
+        return _TracingEnv(node, {
+            "$node": node,
+            "$num_children": len(children),
+            "$is_leaf": len(children) == 0,
+            "$order": order,
+            "$results": self.results,
+            "$visited": visited,
+            "$followed": followed,
+            "$payload": node.payload,
+            "$children": children,
+        }, self.scope)
+
+    def _reusable(self, old: _Frame) -> bool:
+        if old.pinned or old.node in self._dirty:
+            return False
+        return old.depth is None or old.depth == adapters.depth(old.node)
+
+    def eval(self, node, order, visited, followed):
+        if not self.incremental:
+            return super().eval(node, order, visited, followed)
+
+        parent = self._frame
+        old = self._old_children.get(node)
+        if old is not None and self._reusable(old):
+            if parent is None:
+                self._root_frame = old
+            else:
+                parent.tokens.append(old)
+            return
+
+        frame = _Frame(node, old)
+        if parent is None:
+            self._root_frame = frame
+        else:
+            parent.tokens.append(frame)
+        if self._updating:
+            self._fresh.append(frame)
+
+        old_children = self._old_children
+        self._frame = frame
+        self._old_children = ({tok.node: tok for tok in old.tokens if isinstance(tok, _Frame)}
+                              if old is not None else {})
+        try:
+            # every node is reached from its parent only, so the visited and
+            # followed sets never need to be shared between nodes
+            env = self._create_env(node, order, set(), set())
+            for action in order:
+                action_type = next(iter(action))
+                self.dispatch_table[action_type](action, env)
+            frame.finish(env.reads, env.inherited)
+        finally:
+            self._frame = parent
+            self._old_children = old_children
+
+    def _emit(self, result_name, node):
+        if self.incremental:
+            self._frame.tokens.append((result_name, node))
+        if not self._updating:
+            super()._emit(result_name, node)
+
+    def _evaluate(self, node, order):
+        self._start = node
+        self._order = order
+        self.incremental = self.supports(order)
+        self._root_frame = None
+        self._frame = None
+        self._old_children = {}
+        self._dirty = set()
+        return super()._evaluate(node, order)
+
+    def changed(self, node: Any) -> None:
+        """
+        Declare that the payload or the children of `node` changed.
+
+        Args:
+            node: The node that changed.
+        """
+        self.invalidate(node)
+        while node is not None and node not in self._dirty:
+            self._dirty.add(node)
+            node = node.parent
+
+    def update(self) -> Dict[str, List[Any]]:
+        """
+        Bring the results up to date with the changes declared since the last
+        call or update.
+
+        Returns:
+            The patched result dictionary.
+        """
+        if not self._dirty:
+            return self.results
+        if not self.incremental:
+            return self(self._start, self._order)
+
+        old_root = self._root_frame
+        self._updating = True
+        self._fresh = []
+        self._old_children = {self._start: old_root}
+        self.scope = None
+        try:
+            self.eval(self._start, self._order, set(), set())
+        finally:
+            self._updating = False
+            self._old_children = {}
+        self._patch(old_root, self._root_frame, {})
+
+        for name in [name for name, nodes in self.results.items() if not nodes]:
+            del self.results[name]
+        for frame in self._fresh:
+            frame.old = None
+        self._fresh = []
+        self._dirty = set()
+        return self.results
+
+    @staticmethod
+    def _aligned(old: _Frame, new: _Frame) -> bool:
+        if len(old.tokens) != len(new.tokens):
+            return False
+        for o, n in zip(old.tokens, new.tokens):
+            if isinstance(n, _Frame):
+                if not isinstance(o, _Frame) or o.node != n.node:
+                    return False
+            elif isinstance(o, _Frame) or o != n:
+                return False
+        return True
+
+    def _patch(self, old: _Frame, new: _Frame, pos: Dict[str, int]) -> None:
+        # `pos` holds, per result name, the position of the old fragment in the
+        # current result lists; it is advanced past the fragment on return
+        if old is new:
+            for name, c in old.counts.items():
+                pos[name] = pos.get(name, 0) + c
+            return
+
+        if self._aligned(old, new):
+            for o, n in zip(old.tokens, new.tokens):
+                if isinstance(n, _Frame):
+                    self._patch(o, n, pos)
+                else:
+                    pos[n[0]] = pos.get(n[0], 0) + 1
+            return
+
+        for name in set(old.counts) | set(new.counts):
+            nodes = self.results.setdefault(name, [])
+            start = pos.get(name, 0)
+            out: List[Any] = []
+            self._flatten(new, name, start, nodes, out)
+            nodes[start:start + old.counts.get(name, 0)] = out
+            pos[name] = start + len(out)
+
+    def _flatten(self, new: _Frame, name: str, old_start: Optional[int],
+                 nodes: List[Any], out: List[Any]) -> None:
+        # old_start is the position of new.old's fragment in `nodes`; reused
+        # frames below it are copied from there rather than walked
+        starts: Dict[int, int] = {}
+        if new.old is not None and old_start is not None:
+            p = old_start
+            for tok in new.old.tokens:
+                if isinstance(tok, _Frame):
+                    starts[id(tok)] = p
+                    p += tok.counts.get(name, 0)
+                elif tok[0] == name:
+                    p += 1
+
+        for tok in new.tokens:
+            if isinstance(tok, _Frame):
+                s = starts.get(id(tok))
+                if s is not None:
+                    out.extend(nodes[s:s + tok.counts.get(name, 0)])
+                else:
+                    old = starts.get(id(tok.old)) if tok.old is not None else None
+                    self._flatten(tok, name, old, nodes, out)
+            elif tok[0] == name:
+                out.append(tok[1])
@@ -0,0 +1,338 @@
+from collections.abc import Sequence
+from typing import Any, Dict, Iterator, List, Tuple
+import numpy as np
+
+# trees whose indexes an evaluator keeps between runs
+MAX_TREES = 64
+
+
+class TreeIndex:
+    """
+    Array-backed structural index of a tree.
+
+    Every node reachable from `root` gets an integer id equal to its position
+    in a preorder walk, so a subtree always occupies a contiguous id range and
+    the root has id 0. The index keeps a reference to every node, which lets
+    results stored as ids be mapped back onto the source tree without copying
+    nodes or payloads.
+
+    Besides the preorder node list the index holds, as numpy arrays indexed
+    by id, each node's parent, depth, number of children and position among
+    its siblings, the size of its subtree, links to the first child and the
+    next/previous sibling, and a per-depth ("level order") arrangement of all
+    ids, so structural navigation is O(1) array lookups instead of list
+    rebuilding.
+
+    Args:
+        root: Root node of the tree. Nodes must expose `children`.
+    """
+    def __init__(self, root: Any):
+        self.root = root
+        self.nodes: List[Any] = []
+        parent: List[int] = []
+        child_index: List[int] = []
+        num_children: List[int] = []
+        depth: List[int] = []
+
+        stack = [(root, -1, 0, 0)]
+        while stack:
+            node, parent_id, position, node_depth = stack.pop()
+            parent.append(parent_id)
+            child_index.append(position)
+            depth.append(node_depth)
+            node_id = len(self.nodes)
+            self.nodes.append(node)
+            children = node.children
+            num_children.append(len(children))
+            # reversed so that the first child is popped (and numbered) first
+            stack.extend((children[i], node_id, i, node_depth + 1)
+                         for i in range(len(children) - 1, -1, -1))
+
+        n = len(self.nodes)
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.child_index = np.asarray(child_index, dtype=np.int64)
+        self.num_children = np.asarray(num_children, dtype=np.int64)
+        self.ids: Dict[Any, int] = {node: i for i, node in enumerate(self.nodes)}
+
+        self.depth = depth = np.asarray(depth, dtype=np.int64)
+
+        # children of a node appear in increasing id order, so sorting ids by
+        # parent (stably) lists every sibling group left to right
+        by_parent = np.argsort(self.parent, kind="stable")
+        grouped = self.parent[by_parent]
+        same = grouped[1:] == grouped[:-1]
+        self.next_sibling = np.full(n, -1, dtype=np.int64)
+        self.prev_sibling = np.full(n, -1, dtype=np.int64)
+        self.next_sibling[by_parent[:-1][same]] = by_parent[1:][same]
+        self.prev_sibling[by_parent[1:][same]] = by_parent[:-1][same]
+        self.first_child = np.full(n, -1, dtype=np.int64)
+        has_children = self.num_children > 0
+        # the first child of node i is i + 1 in preorder
+        self.first_child[has_children] = np.flatnonzero(has_children) + 1
+
+        # level order: ids sorted by depth, left to right within a depth
+        self.level_order = np.argsort(depth, kind="stable")
+        self.level_offsets = np.searchsorted(depth[self.level_order],
+                                             np.arange(int(depth.max(initial=0)) + 2))
+        self.level_pos = np.empty(n, dtype=np.int64)
+        self.level_pos[self.level_order] = np.arange(n) - self.level_offsets[depth[self.level_order]]
+
+        # subtree sizes, accumulated one level at a time from the deepest up
+        self.subtree_size = np.ones(n, dtype=np.int64)
+        for d in range(len(self.level_offsets) - 2, 0, -1):
+            ids = self.level_ids(d)
+            np.add.at(self.subtree_size, self.parent[ids], self.subtree_size[ids])
+
+    @staticmethod
+    def of(node: Any) -> "TreeIndex":
+        """
+        Args:
+            node: A node.
+
+        Returns:
+            The index of the tree of `node`: the one it is a view of, for
+            nodes of an array-backed tree (see `shared.ArrayNode`), or a new
+            index of its root.
+        """
+        index = getattr(node, "tree_index", None)
+        return index if index is not None else TreeIndex(node.root)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.nodes)
+
+    def __contains__(self, node: Any) -> bool:
+        return node in self.ids
+
+    def id(self, node: Any) -> int:
+        """
+        Args:
+            node: A node of the indexed tree.
+
+        Returns:
+            The preorder id of `node`.
+        """
+        return self.ids[node]
+
+    def node(self, node_id: int) -> Any:
+        """
+        Args:
+            node_id: A preorder id.
+
+        Returns:
+            The node with preorder id `node_id`.
+        """
+        return self.nodes[node_id]
+
+    def children_ids(self, node_id: int) -> List[int]:
+        """
+        Args:
+            node_id: A preorder id.
+
+        Returns:
+            The ids of the children of `node_id`, left to right.
+        """
+        ids = []
+        child = self.first_child[node_id]
+        while child != -1:
+            ids.append(int(child))
+            child = self.next_sibling[child]
+        return ids
+
+    def siblings(self, node: Any) -> List[Any]:
+        """
+        Args:
+            node: A node of the indexed tree.
+
+        Returns:
+            The other children of the parent of `node`, left to right.
+        """
+        node_id = self.ids[node]
+        parent = self.parent[node_id]
+        if parent == -1:
+            return []
+        return [self.nodes[i] for i in self.children_ids(parent) if i != node_id]
+
+    def next_sibling_of(self, node: Any) -> List[Any]:
+        """
+        Args:
+            node: A node of the indexed tree.
+
+        Returns:
+            A list holding the next sibling of `node`, or an empty list.
+        """
+        i = self.next_sibling[self.ids[node]]
+        return [self.nodes[i]] if i != -1 else []
+
+    def prev_sibling_of(self, node: Any) -> List[Any]:
+        """
+        Args:
+            node: A node of the indexed tree.
+
+        Returns:
+            A list holding the previous sibling of `node`, or an empty list.
+        """
+        i = self.prev_sibling[self.ids[node]]
+        return [self.nodes[i]] if i != -1 else []
+
+    def level_ids(self, depth: int) -> np.ndarray:
+        """
+        Args:
+            depth: A depth.
+
+        Returns:
+            The ids of all nodes at `depth`, left to right.
+        """
+        if depth < 0 or depth + 1 >= len(self.level_offsets):
+            return self.level_order[:0]
+        return self.level_order[self.level_offsets[depth]:self.level_offsets[depth + 1]]
+
+    def level(self, node: Any) -> List[Any]:
+        """
+        Args:
+            node: A node of the indexed tree.
+
+        Returns:
+            The other nodes at the depth of `node`, left to right.
+        """
+        node_id = self.ids[node]
+        nodes = self.nodes
+        return [nodes[i] for i in self.level_ids(int(self.depth[node_id])).tolist() if i != node_id]
+
+    def level_neighbor(self, node: Any, step: int) -> List[Any]:
+        """
+        Args:
+            node: A node of the indexed tree.
+            step: 1 for the next node on the same level, -1 for the previous.
+
+        Returns:
+            A list holding the neighbour of `node` on its level (which may
+            have a different parent), or an empty list.
+        """
+        node_id = self.ids[node]
+        level = self.level_ids(int(self.depth[node_id]))
+        pos = int(self.level_pos[node_id]) + step
+        return [self.nodes[level[pos]]] if 0 <= pos < len(level) else []
+
+    def descendants(self, node: Any) -> "NodeRange":
+        """
+        Args:
+            node: A node of the indexed tree.
+
+        Returns:
+            The descendants of `node` in preorder, as the contiguous range of
+            ids that follows it.
+        """
+        node_id = self.ids[node]
+        return NodeRange(self, range(node_id + 1, node_id + int(self.subtree_size[node_id])))
+
+    def ancestors(self, node: Any) -> Iterator[Any]:
+        """
+        Args:
+            node: A node of the indexed tree.
+
+        Returns:
+            An iterator over the ancestors of `node`, from its parent up to
+            the root, following the parent array as it is consumed.
+        """
+        parent = self.parent
+        nodes = self.nodes
+        i = parent[self.ids[node]]
+        while i != -1:
+            yield nodes[i]
+            i = parent[i]
+
+    def all_nodes(self) -> "NodeRange":
+        """
+        Returns:
+            Every node of the indexed tree, in preorder.
+        """
+        return NodeRange(self, range(len(self.nodes)))
+
+
+class IndexCache:
+    """
+    Indexes of the trees evaluated last, by root, so that evaluating another
+    order on the same tree does not index it again.
+
+    A tree is looked up by the identity of its root. Its entry holds on to
+    the root, so that its id is not reused. Changes to a tree are not
+    detected: call `invalidate` after changing one.
+
+    Args:
+        max_trees: Maximum number of trees kept.
+    """
+    def __init__(self, max_trees: int = MAX_TREES):
+        self.max_trees = max_trees
+        # id(root) -> (root, index)
+        self.indexes: Dict[int, Tuple[Any, TreeIndex]] = {}
+
+    def get(self, node: Any) -> TreeIndex:
+        """
+        Args:
+            node: A node.
+
+        Returns:
+            The index of the tree of `node`, as `TreeIndex.of` returns it.
+        """
+        index = getattr(node, "tree_index", None)
+        if index is not None:
+            return index
+        root = node.root
+        entry = self.indexes.get(id(root))
+        if entry is not None and entry[0] is root:
+            return entry[1]
+        index = TreeIndex(root)
+        indexes = self.indexes
+        if len(indexes) >= self.max_trees:
+            # replaced rather than cleared: runs in other threads may be
+            # reading the old one
+            indexes = self.indexes = {}
+        indexes[id(root)] = (root, index)
+        return index
+
+    def invalidate(self, node: Any) -> None:
+        """
+        Forget the index of the tree of `node`.
+
+        Args:
+            node: A node of the tree that changed.
+        """
+        self.indexes.pop(id(node.root), None)
+
+
+class NodeRange(Sequence):
+    """
+    Read-only sequence of the nodes of an index whose ids are in a range,
+    such as the descendants of a node. No list of nodes is built: nodes are
+    looked up by id as they are accessed.
+
+    Args:
+        index: The index.
+        ids: The range of ids.
+    """
+    __slots__ = ("index", "ids")
+
+    def __init__(self, index: TreeIndex, ids: range):
+        self.index = index
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: Any) -> Any:
+        if isinstance(i, slice):
+            return NodeRange(self.index, self.ids[i])
+        return self.index.nodes[self.ids[i]]
+
+    def __iter__(self) -> Iterator[Any]:
+        return map(self.index.nodes.__getitem__, self.ids)
+
+    def __contains__(self, node: Any) -> bool:
+        i = self.index.ids.get(node)
+        return i is not None and i in self.ids
+
+    def __repr__(self) -> str:
+        return f"NodeRange({self.ids.start}, {self.ids.stop})"
@@ -0,0 +1,141 @@
+from collections import Counter
+from typing import Any, Dict, List, Optional
+from . import analysis
+from .hashing import TreeHasher
+from .index import TreeIndex
+from .run import RunState
+from .utt_eval import UttEval
+
+MEMO_DIRS = {"down", "children"}
+
+# actions with effects other than emitting result nodes
+UNMEMOIZABLE_ACTIONS = {"set!", "payload-map", "aggregate", "fold"}
+
+# variables whose value depends only on the node and its subtree
+SUBTREE_LOCAL_VARS = {"$node", "$payload", "$num_children", "$is_leaf",
+                      "$children", "$descendants"}
+
+# select-orders and sort keys that order the candidates of a `down` follow
+# the same way in identical subtrees; names are not part of the digest, so
+# `name` is not one of them
+SUBTREE_LOCAL_ORDERS = {"id", "reverse", "payload", "depth", "num_children",
+                        "num_descendants", "num_ancestors", "num_siblings"}
+
+
+class MemoUttEval(UttEval):
+    """
+    Evaluator that memoizes the results of identical subtrees.
+
+    A hash-consing pass gives every subtree its Merkle digest (shape plus
+    payloads, see `hashing.TreeHasher`). When the order's decisions depend
+    only on subtree-local state, evaluating the order at a node produces the
+    same results, relative to the node's position, at every occurrence of an
+    identical subtree. The first occurrence is evaluated and its results are
+    stored as preorder offsets; every later occurrence is answered by shifting
+    the offsets to its own position in the tree.
+
+    An order qualifies when it follows `down`/`children` only, draws no random
+    numbers, has no `set!`, `payload-map`, `aggregate` or `fold` actions,
+    reads no variables besides `$node`, `$payload`, `$num_children`,
+    `$is_leaf`, `$children` and `$descendants`, and orders nodes by none of
+    their names (only by the `SUBTREE_LOCAL_ORDERS`). Other orders are
+    evaluated normally.
+    Custom predicates must depend only on their arguments and the payloads
+    and shape of the subtree they are given.
+
+    Memoized fragments are kept per order across calls. After changing a
+    tree, call `invalidate(node)` on each changed node so its digest, and the
+    digests of its ancestors, are recomputed.
+
+    Args:
+        min_occurrences: Only subtrees that occur at least this many times in
+            the traversed tree are memoized.
+    """
+    subtree_index = RunState()
+    hits = RunState()
+    _fragments = RunState()
+    _shared = RunState()
+
+    def __init__(self, debug=False, seed=None, min_occurrences: int = 2):
+        super().__init__(debug=debug, seed=seed)
+        self.min_occurrences = min_occurrences
+        self.hasher = TreeHasher()
+        self.subtree_index: Optional[TreeIndex] = None
+        # subtrees answered from a memoized fragment in the run
+        self.hits = 0
+        self._memo: Dict[str, Dict[bytes, Dict[str, List[int]]]] = {}
+        self._fragments: Optional[Dict[bytes, Dict[str, List[int]]]] = None
+        self._shared: Dict[bytes, int] = {}
+
+    @staticmethod
+    def supports(order: List[Dict[str, Any]]) -> bool:
+        """
+        Return True if results of `order` can be memoized per subtree.
+
+        Args:
+            order: A traversal order.
+        """
+        return (analysis.follow_directions(order) <= MEMO_DIRS
+                and not analysis.uses_randomness(order)
+                and not analysis.action_types(order) & UNMEMOIZABLE_ACTIONS
+                and analysis.env_vars(order) <= SUBTREE_LOCAL_VARS
+                and analysis.select_orders(order) <= SUBTREE_LOCAL_ORDERS
+                and analysis.sort_keys(order) <= SUBTREE_LOCAL_ORDERS)
+
+    def invalidate(self, node: Any) -> None:
+        """
+        Declare that the payload or the children of `node` changed.
+
+        Args:
+            node: The node that changed.
+        """
+        super().invalidate(node)
+        self.hasher.invalidate(node)
+
+    def clear(self) -> None:
+        """
+        Drop every memoized fragment.
+        """
+        self._memo = {}
+
+    def eval(self, node, order, visited, followed):
+        if self._fragments is None:
+            return super().eval(node, order, visited, followed)
+
+        digest = self.hasher.digest(node)
+        fragment = self._fragments.get(digest)
+        base = self.subtree_index.id(node)
+        if fragment is not None:
+            self.hits += 1
+            nodes = self.subtree_index.nodes
+            for name, offsets in fragment.items():
+                self.results.setdefault(name, []).extend(nodes[base + i] for i in offsets)
+            return
+
+        memoize = self._shared.get(digest, 0) >= self.min_occurrences
+        if memoize:
+            before = {name: len(nodes) for name, nodes in self.results.items()}
+        # every node is reached from its parent only, so the visited and
+        # followed sets never need to be shared between nodes
+        super().eval(node, order, set(), set())
+        if memoize:
+            ids = self.subtree_index.ids
+            self._fragments[digest] = {
+                name: [ids[n] - base for n in nodes[before.get(name, 0):]]
+                for name, nodes in self.results.items()
+                if len(nodes) > before.get(name, 0)}
+
+    def _evaluate(self, node, order):
+        if not self.supports(order):
+            self._fragments = None
+            return super()._evaluate(node, order)
+
+        self.subtree_index = TreeIndex(node)
+        digest = self.hasher.digest
+        self._shared = Counter(digest(n) for n in self.subtree_index.nodes)
+        self._fragments = self._memo.setdefault(analysis.normalize_order(order), {})
+        try:
+            return super()._evaluate(node, order)
+        finally:
+            self._fragments = None
+            self._shared = {}
@@ -0,0 +1,280 @@
+from collections.abc import Mapping, Sequence
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from . import adapters
+import numpy as np
+from . import analysis
+from . import compiler
+from .index import TreeIndex
+
+
+def extend(payload: Any, **fields: Any) -> Any:
+    """
+    Args:
+        payload: A payload.
+        fields: Fields to add.
+
+    Returns:
+        A new dict payload with `fields` added. A payload that is not a dict
+        is kept under the key "payload".
+    """
+    if isinstance(payload, dict):
+        return {**payload, **fields}
+    return {"payload": payload, **fields}
+
+
+def _node_stats(node: Any) -> Dict[str, int]:
+    return {"num_children": len(node.children),
+            "depth": adapters.depth(node),
+            "num_descendants": len(adapters.descendants(node))}
+
+
+# node, payload, *args, **kwargs -> new payload
+FUNCTIONS: Dict[str, Callable] = {
+    "id": lambda node, payload: payload,
+    "proj": lambda node, payload, *keys: {k: payload[k] for k in keys if k in payload},
+    "rename": lambda node, payload, **names: {names.get(k, k): v for k, v in payload.items()},
+    "num-ancestors": lambda node, payload: extend(payload, num_ancestors=len(adapters.ancestors(node))),
+    "num-children": lambda node, payload: extend(payload, num_children=len(node.children)),
+    "num-descendants": lambda node, payload: extend(payload, num_descendants=len(adapters.descendants(node))),
+    "node-stats": lambda node, payload: extend(payload, **_node_stats(node)),
+}
+
+
+class PayloadFields(Sequence):
+    """
+    New payloads of some nodes, kept column by column: the payloads they
+    extend, and an array of values for each added field. A payload is only
+    built, as `extend` builds it, when it is read.
+
+    Args:
+        base: The payloads extended, one per node.
+        fields: Added fields, each an array with one value per node.
+    """
+    __slots__ = ("base", "fields")
+
+    def __init__(self, base: Sequence, fields: Dict[str, np.ndarray]):
+        self.base = base
+        self.fields = fields
+
+    def __getitem__(self, i: int) -> Any:
+        return extend(self.base[i], **{name: values[i].item() for name, values in self.fields.items()})
+
+    def __len__(self) -> int:
+        return len(self.base)
+
+
+def with_fields(payloads: Sequence, **fields: np.ndarray) -> PayloadFields:
+    """
+    The columnar form of `extend`.
+
+    Args:
+        payloads: Payloads, one per node.
+        fields: Fields to add, each an array with one value per node.
+
+    Returns:
+        The payloads with `fields` added. Fields added to a `PayloadFields`
+        are merged into it, so maps applied one after the other stay
+        columnar.
+    """
+    if isinstance(payloads, PayloadFields):
+        return PayloadFields(payloads.base, {**payloads.fields, **fields})
+    return PayloadFields(payloads, fields)
+
+
+# index, ids, payloads, *args, **kwargs -> new payloads, a sequence with one
+# per id: the columnar forms of FUNCTIONS, which add fields read from the
+# index arrays for all the mapped nodes at once. `proj` and `rename` rewrite
+# arbitrary dicts, and are applied node by node
+COLUMNS: Dict[str, Callable] = {
+    "id": lambda index, ids, payloads: payloads,
+    "num-ancestors": lambda index, ids, payloads: with_fields(payloads, num_ancestors=index.depth[ids]),
+    "num-children": lambda index, ids, payloads: with_fields(payloads, num_children=index.num_children[ids]),
+    "num-descendants": lambda index, ids, payloads: with_fields(
+        payloads, num_descendants=index.subtree_size[ids] - 1),
+    "node-stats": lambda index, ids, payloads: with_fields(
+        payloads, num_children=index.num_children[ids], depth=index.depth[ids],
+        num_descendants=index.subtree_size[ids] - 1),
+}
+
+
+class PayloadColumn(Mapping):
+    """
+    Payloads produced by a payload-map stage: a read-only mapping from each
+    mapped node to its new payload.
+
+    The new payloads are kept as the stage produced them, one sequence per
+    application of a map (a `PayloadFields`, for a columnar map), and built
+    when they are read. The tree itself is never modified and the column is
+    not changed after the stage, so it can be shared between threads.
+
+    Args:
+        ids: Number of every node that may be mapped.
+        nodes: The node of every number.
+        sequences: The new payloads of each application.
+        where: For each node number, the application that produced its new
+            payload, or -1 if it was not mapped.
+        position: For each mapped node number, the position of its new
+            payload in the sequence of that application.
+    """
+    def __init__(self, ids: Mapping, nodes: Sequence, sequences: List[Sequence],
+                 where: np.ndarray, position: np.ndarray):
+        self.ids = ids
+        self.nodes = nodes
+        self.sequences = sequences
+        self.where = where
+        self.position = position
+
+    def __getitem__(self, node: Any) -> Any:
+        i = self.ids[node] if node in self.ids else -1
+        if i < 0 or self.where[i] < 0:
+            raise KeyError(node)
+        return self.sequences[self.where[i]][int(self.position[i])]
+
+    def __iter__(self) -> Iterator[Any]:
+        return (self.nodes[i] for i in np.flatnonzero(self.where >= 0).tolist())
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.where >= 0))
+
+    def payload(self, node: Any) -> Any:
+        """
+        Args:
+            node: Any node of the tree.
+
+        Returns:
+            The new payload of `node`, or its original payload if it was not
+            mapped.
+        """
+        return self[node] if node in self else node.payload
+
+
+class _Payloads(Sequence):
+    # the payloads of `nodes` as mapped so far: the new payload in the
+    # sequence `where` at `position`, or the original one where it is -1
+    __slots__ = ("nodes", "sequences", "where", "position")
+
+    def __init__(self, nodes: List[Any], sequences: List[Sequence],
+                 where: Optional[np.ndarray] = None, position: Optional[np.ndarray] = None):
+        self.nodes = nodes
+        self.sequences = sequences
+        self.where = where
+        self.position = position
+
+    def __getitem__(self, i: int) -> Any:
+        node = self.nodes[i]
+        if self.where is None or self.where[i] < 0:
+            return node.payload
+        return self.sequences[self.where[i]][int(self.position[i])]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+class PayloadMapStage:
+    """
+    Applies the `payload-map` actions of one traversal in bulk.
+
+    During the traversal each `payload-map` action only records the node it
+    applies to (and its resolved arguments). `run` then applies every action
+    to all of its nodes at once, in the order the actions appear in the
+    traversal order: through the columnar form of the map function when
+    there is one and the action's arguments are literals, and node by node
+    otherwise. Each action maps the payloads the actions before it produced,
+    and a node one action applies to more than once is mapped again from
+    the payload it produced the time before.
+
+    The payloads the traversal reads are therefore always the original
+    ones, which is why orders that read `$payload` after a `payload-map`
+    are rejected (see `compiler.compile_order`).
+
+    Args:
+        functions: Map functions by name, see `FUNCTIONS`.
+        columns: Columnar map functions by name, see `COLUMNS`.
+    """
+    def __init__(self, functions: Dict[str, Callable], columns: Dict[str, Callable]):
+        self.functions = functions
+        self.columns = columns
+        # id(action) -> (action, nodes, args per node, kwargs per node)
+        self.pending: Dict[int, Tuple[Dict[str, Any], List[Any], List[Any], List[Any]]] = {}
+
+    def add(self, action: Dict[str, Any], node: Any, args: List[Any], kwargs: Dict[str, Any]) -> None:
+        """
+        Record that `action` applies to `node`.
+
+        Args:
+            action: A `payload-map` action.
+            node: The node it applies to.
+            args: Its resolved positional arguments at `node`.
+            kwargs: Its resolved keyword arguments at `node`.
+        """
+        entry = self.pending.get(id(action))
+        if entry is None:
+            entry = self.pending[id(action)] = (action, [], [], [])
+        entry[1].append(node)
+        entry[2].append(args)
+        entry[3].append(kwargs)
+
+    def run(self, index: Optional[TreeIndex], order: List[Dict[str, Any]]) -> PayloadColumn:
+        """
+        Args:
+            index: Index of the traversed tree, or None to apply every map
+                function node by node.
+            order: The traversal order.
+
+        Returns:
+            The new payloads.
+        """
+        position = {id(action): i for i, action in enumerate(analysis.walk_actions(order))}
+        if index is not None:
+            ids, nodes = index.ids, index.nodes
+        else:
+            nodes = list(dict.fromkeys(node for entry in self.pending.values() for node in entry[1]))
+            ids = {node: i for i, node in enumerate(nodes)}
+        sequences: List[Sequence] = []
+        where = np.full(len(ids), -1, dtype=np.int64)
+        at = np.zeros(len(ids), dtype=np.int64)
+        for key in sorted(self.pending, key=position.__getitem__):
+            action, targets, args, kwargs = self.pending[key]
+            column = self.columns.get(action["payload-map"]) if index is not None else None
+            if column is not None and (any(compiler.is_ref(arg) for arg in action.get("args", [])) or
+                                       any(compiler.is_ref(arg) for arg in action.get("kwargs", {}).values())):
+                column = None
+            numbers = np.fromiter(map(ids.__getitem__, targets), dtype=np.int64, count=len(targets))
+            if np.unique(numbers).size == numbers.size:
+                self._apply(action, column, index, targets, numbers, args, kwargs, sequences, where, at)
+                continue
+            # a node the action applies to more than once is mapped again,
+            # in a later round, from the payload the round before produced
+            for positions in _rounds(numbers):
+                self._apply(action, column, index, [targets[i] for i in positions], numbers[positions],
+                            [args[i] for i in positions], [kwargs[i] for i in positions], sequences, where, at)
+        return PayloadColumn(ids, nodes, sequences, where, at)
+
+    def _apply(self, action: Dict[str, Any], column: Optional[Callable], index: Optional[TreeIndex],
+               nodes: List[Any], numbers: np.ndarray, args: List[Any], kwargs: List[Any],
+               sequences: List[Sequence], where: np.ndarray, at: np.ndarray) -> None:
+        # map distinct `nodes` (numbered `numbers`) from the payloads they
+        # have so far, and make the new ones theirs
+        sources = where[numbers]
+        if (sources < 0).all():
+            payloads = _Payloads(nodes, sequences)
+        else:
+            payloads = _Payloads(nodes, sequences, sources, at[numbers])
+        if column is not None:
+            new = column(index, numbers, payloads, *args[0], **kwargs[0])
+        else:
+            fn = self.functions[action["payload-map"]]
+            new = [fn(node, payload, *a, **kw) for node, payload, a, kw in zip(nodes, payloads, args, kwargs)]
+        where[numbers] = len(sequences)
+        at[numbers] = np.arange(numbers.size)
+        sequences.append(new)
+
+
+def _rounds(numbers: np.ndarray) -> List[np.ndarray]:
+    # the positions of `numbers` split so that no number appears twice in a
+    # round, the k-th appearance of a number going to round k
+    order = np.argsort(numbers, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(numbers[order]) != 0])
+    rank = np.empty(numbers.size, dtype=np.int64)
+    rank[order] = np.arange(numbers.size) - np.repeat(starts, np.diff(np.r_[starts, numbers.size]))
+    return [np.flatnonzero(rank == k) for k in range(int(rank.max()) + 1)]
@@ -0,0 +1,328 @@
+import sys
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from . import analysis
+from . import treeprog
+from .async_eval import AsyncUttEval
+from .memo import MemoUttEval
+from .utt_eval import UttEval
+
+# Python frames the recursive evaluator uses per level of the tree, with a
+# `cond` between follows
+FRAMES_PER_LEVEL = 4
+# frames kept free for the caller and for predicates
+FRAME_MARGIN = 50
+
+# memoizing pays for hashing every subtree only on trees this large ...
+MEMO_MIN_NODES = 10000
+# ... whose leaf payloads repeat: at most this fraction of them is distinct
+MEMO_MAX_DISTINCT = 0.5
+
+# leaves whose payloads are sampled for `TreeStats.distinct_leaf_payloads`
+PAYLOAD_SAMPLE = 1000
+
+# selectors that may leave candidates out, so the traversal can stop short of
+# the whole tree
+LIMITING_SELECTORS = {"none", "first", "last", "nth", "slice", "sample", "rand",
+                      "weighted-sample", "smallest", "largest"}
+
+# variables whose value is a list built per node, O(size) each
+LIST_VARS = {"$siblings", "$ancestors", "$descendants"}
+
+# actions the iterative evaluator carries out (it has no dispatch table)
+ITERATIVE_ACTIONS = {"visit", "follow", "cond", "payload-map", "set!", "aggregate", "fold"}
+
+# name -> evaluator class; `Planner.plan` picks one of these
+ENGINES: Dict[str, Callable] = {
+    "recursive": UttEval,
+    "iterative": treeprog.UttEval,
+    "memo": MemoUttEval,
+    "async": AsyncUttEval,
+}
+
+
+class TreeStats:
+    """
+    Statistics of a tree that are cheap to gather in one pass: its size and
+    height, the distribution of the number of children, the types of the
+    payloads, and how often the payloads of (a sample of) its leaves repeat.
+
+    Args:
+        root: Root node of the tree.
+    """
+    def __init__(self, root: Any):
+        index = getattr(root, "tree_index", None)
+        types: Counter = Counter()
+        sample = []
+        if index is not None:
+            # structure from the index arrays, payloads from the nodes
+            fanout = Counter(dict(enumerate(np.bincount(index.num_children).tolist())))
+            max_depth = int(index.depth.max(initial=0))
+            node_count = len(index)
+            for node in index.nodes:
+                payload = node.payload
+                types[type(payload).__name__] += 1
+                if len(sample) < PAYLOAD_SAMPLE and not node.children:
+                    sample.append(payload)
+            fanout = +fanout
+        else:
+            fanout = Counter()
+            max_depth = 0
+            node_count = 0
+            stack = [(root, 0)]
+            while stack:
+                node, depth = stack.pop()
+                node_count += 1
+                if depth > max_depth:
+                    max_depth = depth
+                children = node.children
+                fanout[len(children)] += 1
+                payload = node.payload
+                types[type(payload).__name__] += 1
+                if not children and len(sample) < PAYLOAD_SAMPLE:
+                    sample.append(payload)
+                stack.extend((child, depth + 1) for child in children)
+        self.node_count = node_count
+        self.max_depth = max_depth
+        self.fanout: Dict[int, int] = dict(sorted(fanout.items()))
+        self.leaves = fanout.get(0, 0)
+        internal = node_count - self.leaves
+        self.mean_fanout = (node_count - 1) / internal if internal else 0.0
+        self.max_fanout = max(fanout)
+        self.payload_types: Dict[str, int] = dict(types.most_common())
+        self.distinct_leaf_payloads = _distinct_fraction(sample)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+    def __repr__(self) -> str:
+        return (f"TreeStats({self.node_count} nodes, depth {self.max_depth}, "
+                f"mean fan-out {self.mean_fanout:.1f})")
+
+
+def _distinct_fraction(values: List[Any]) -> float:
+    if not values:
+        return 1.0
+    keys = set()
+    for value in values:
+        try:
+            keys.add(value)
+        except TypeError:
+            keys.add(repr(value))
+    return len(keys) / len(values)
+
+
+class OrderShape:
+    """
+    What the planner needs to know about an order: the actions, variables,
+    predicates, follow directions, selectors and select-orders it uses,
+    whether it draws random numbers, and whether it can stop short of the
+    whole tree (`early_exits` lists why).
+
+    Args:
+        order: A traversal order.
+    """
+    def __init__(self, order: List[Dict[str, Any]]):
+        self.actions = analysis.action_types(order)
+        self.vars = (analysis.env_vars(order) - analysis.bound_vars(order)
+                     - analysis.fold_vars(order))
+        self.predicates = analysis.predicates(order)
+        self.directions = analysis.follow_directions(order)
+        self.selectors = analysis.selectors(order)
+        self.select_orders = analysis.select_orders(order)
+        self.nondeterministic = analysis.uses_randomness(order)
+        self.early_exits: List[str] = []
+        if "cond" in self.actions:
+            self.early_exits.append("cond cases guard actions")
+        if self.selectors & LIMITING_SELECTORS:
+            self.early_exits.append("selectors " + ", ".join(sorted(self.selectors & LIMITING_SELECTORS)))
+        if not self.directions - {"none"}:
+            self.early_exits.append("nothing is followed")
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: sorted(value) if isinstance(value, set) else value
+                for key, value in vars(self).items()}
+
+
+class Plan:
+    """
+    An engine chosen for an order on a tree, with the options to create it
+    with and the reasons for the choice.
+    """
+    def __init__(self, engine: str, options: Dict[str, Any], reasons: List[str],
+                 stats: Optional[TreeStats], shape: OrderShape):
+        self.engine = engine
+        self.options = options
+        self.reasons = reasons
+        self.stats = stats
+        self.shape = shape
+
+    def explain(self) -> str:
+        """
+        Returns:
+            The plan and the reasons for it, as text.
+        """
+        options = ", ".join(f"{k}={v!r}" for k, v in self.options.items())
+        lines = [f"engine: {self.engine}" + (f" ({options})" if options else "")]
+        stats = self.stats
+        if stats is not None:
+            lines.append(f"tree: {stats.node_count} nodes, {stats.leaves} leaves, "
+                         f"max depth {stats.max_depth}, mean fan-out {stats.mean_fanout:.2f}, "
+                         f"max fan-out {stats.max_fanout}")
+            lines.append("payloads: " + ", ".join(f"{k} {v}" for k, v in stats.payload_types.items()))
+        shape = self.shape
+        lines.append("order: reads " + (", ".join(sorted(shape.vars)) or "no variables")
+                     + ("; random" if shape.nondeterministic else "")
+                     + ("; may stop early (" + "; ".join(shape.early_exits) + ")"
+                        if shape.early_exits else "; traverses everything it reaches"))
+        lines.extend("- " + reason for reason in self.reasons)
+        return "\n".join(lines)
+
+    def __repr__(self) -> str:
+        return f"Plan({self.engine!r}, {self.options!r})"
+
+
+class Planner:
+    """
+    Chooses the evaluator for an order from the shape of the order and
+    statistics of the tree, and runs it.
+
+    - Trees whose nodes fetch their children lazily (`fetch_children`) use
+      the async evaluator.
+    - Orders the recursive evaluator could not finish within the recursion
+      limit use the iterative evaluator, if it supports them. It returns the
+      same nodes, in a different order.
+    - Large trees with repeated leaf payloads use the memoizing evaluator,
+      for orders it can memoize.
+    - Everything else uses the recursive evaluator, which supports every
+      action.
+
+    Tree statistics are cached per tree (by root). Call `invalidate` after
+    changing a tree.
+
+    Args:
+        max_trees: Number of trees whose statistics are kept.
+    """
+    def __init__(self, max_trees: int = 64):
+        self.max_trees = max_trees
+        self.engines: Dict[str, Callable] = dict(ENGINES)
+        # id(root) -> (root, stats); the root is kept so that its id is not reused
+        self._stats: Dict[int, Tuple[Any, TreeStats]] = {}
+        # engine name -> instance whose tables tell what it supports
+        self._prototypes: Dict[str, Any] = {}
+
+    def stats(self, node: Any) -> TreeStats:
+        """
+        Args:
+            node: A node.
+
+        Returns:
+            The statistics of the tree of `node`.
+        """
+        root = node.root
+        entry = self._stats.get(id(root))
+        if entry is None or entry[0] is not root:
+            if len(self._stats) >= self.max_trees:
+                del self._stats[next(iter(self._stats))]
+            entry = self._stats[id(root)] = (root, TreeStats(root))
+        return entry[1]
+
+    def invalidate(self, node: Any) -> None:
+        """
+        Forget the statistics of the tree of `node`.
+        """
+        self._stats.pop(id(node.root), None)
+
+    def plan(self, node: Any, order: List[Dict[str, Any]]) -> Plan:
+        """
+        Args:
+            node: Start node.
+            order: A traversal order.
+
+        Returns:
+            The plan for evaluating `order` from `node`.
+        """
+        shape = OrderShape(order)
+        reasons: List[str] = []
+
+        if getattr(node, "fetch_children", None) is not None:
+            # gathering statistics would fetch the whole tree
+            missing = self._unsupported("async", shape)
+            if not missing:
+                reasons.append("nodes fetch their children lazily: fetches overlap "
+                               "(tree statistics are not gathered)")
+                return Plan("async", {}, reasons, None, shape)
+            reasons.append("nodes fetch their children lazily, but the async evaluator lacks "
+                           + ", ".join(missing))
+
+        stats = self.stats(node)
+
+        if shape.vars & LIST_VARS:
+            reasons.append("reads " + ", ".join(sorted(shape.vars & LIST_VARS))
+                           + ": a list is built at every node")
+
+        frames = (stats.max_depth + 1) * FRAMES_PER_LEVEL + FRAME_MARGIN
+        if frames > sys.getrecursionlimit():
+            missing = self._unsupported("iterative", shape)
+            if not missing:
+                reasons.append(f"depth {stats.max_depth} needs about {frames} frames, over the "
+                               f"recursion limit of {sys.getrecursionlimit()}: evaluated iteratively "
+                               "(results come in a different order)")
+                return Plan("iterative", {}, reasons, stats, shape)
+            reasons.append(f"depth {stats.max_depth} may exceed the recursion limit, but the "
+                           "iterative evaluator lacks " + ", ".join(missing)
+                           + "; raise sys.setrecursionlimit if evaluation fails")
+
+        if stats.node_count >= MEMO_MIN_NODES and stats.distinct_leaf_payloads <= MEMO_MAX_DISTINCT:
+            if MemoUttEval.supports(order):
+                reasons.append(f"{stats.node_count} nodes and {stats.distinct_leaf_payloads:.0%} of "
+                               "sampled leaf payloads distinct: identical subtrees are likely, "
+                               "so their results are memoized")
+                return Plan("memo", {}, reasons, stats, shape)
+            reasons.append("identical subtrees are likely, but the order cannot be memoized")
+
+        reasons.append("the recursive evaluator supports every action")
+        return Plan("recursive", {}, reasons, stats, shape)
+
+    def explain(self, node: Any, order: List[Dict[str, Any]]) -> str:
+        """
+        Returns:
+            The plan for evaluating `order` from `node`, and why, as text.
+        """
+        return self.plan(node, order).explain()
+
+    def evaluator(self, plan: Plan, **kwargs: Any) -> Any:
+        """
+        Args:
+            plan: A plan.
+            kwargs: Further arguments of the evaluator (`seed`, ...).
+
+        Returns:
+            A new evaluator for the plan.
+        """
+        return self.engines[plan.engine](**plan.options, **kwargs)
+
+    def __call__(self, node: Any, order: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, List[Any]]:
+        """
+        Evaluate `order` from `node` with the planned evaluator. The async
+        evaluator returns a coroutine.
+        """
+        return self.evaluator(self.plan(node, order), **kwargs)(node, order)
+
+    def _unsupported(self, engine: str, shape: OrderShape) -> List[str]:
+        proto = self._prototypes.get(engine)
+        if proto is None:
+            proto = self._prototypes[engine] = self.engines[engine]()
+        missing = []
+        actions = getattr(proto, "dispatch_table", ITERATIVE_ACTIONS)
+        for kind, used, known in (("actions", shape.actions, actions),
+                                  ("predicates", shape.predicates, proto.pred_fns),
+                                  ("directions", shape.directions, proto.follow_dirs),
+                                  ("selectors", shape.selectors, proto.selectors),
+                                  ("select-orders", shape.select_orders, proto.select_orders),
+                                  ("variables", shape.vars, proto.env_vars)):
+            absent = used - set(known)
+            if absent:
+                missing.append(f"{kind} {', '.join(sorted(absent))}")
+        return missing
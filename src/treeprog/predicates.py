@@ -0,0 +1,296 @@
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+# composite predicate operator -> whether it is a conjunction
+OPERATORS = {"and": True, "or": False}
+
+# adaptive orderings are revised after this many tests of a composite
+REORDER_EVERY = 256
+
+# composites whose measurements are kept, the least recently added dropped first
+MAX_COMPOSITES = 4096
+
+
+def is_composite(pred: Any) -> bool:
+    """
+    Return True if `pred` is a composite predicate, `{"and": [...]}` or
+    `{"or": [...]}`, rather than the name of a predicate.
+    """
+    return isinstance(pred, dict)
+
+
+def operator(pred: Dict[str, Any]) -> str:
+    """
+    Args:
+        pred: A composite predicate.
+
+    Returns:
+        Its operator.
+
+    Raises:
+        ValueError: If `pred` is not a single `and` or `or`.
+    """
+    if len(pred) != 1 or next(iter(pred)) not in OPERATORS:
+        raise ValueError(f"Invalid composite predicate: {pred}")
+    return next(iter(pred))
+
+
+def leaf_operands(pred: Any) -> List[Dict[str, Any]]:
+    """
+    Args:
+        pred: A predicate name or composite predicate.
+
+    Returns:
+        The operands of `pred` that name a predicate, at any nesting depth.
+    """
+    if not is_composite(pred):
+        return []
+    found = []
+    for operand in pred[operator(pred)]:
+        if is_composite(operand["pred"]):
+            found.extend(leaf_operands(operand["pred"]))
+        else:
+            found.append(operand)
+    return found
+
+
+class Composite:
+    """
+    The order in which the operands of one composite predicate are tested,
+    and what was observed of them: per operand (by declared position) the
+    number of tests, how many passed and the time they took.
+
+    Args:
+        pred: The composite predicate.
+    """
+    __slots__ = ("pred", "conjunction", "operands", "order", "fixed", "tests",
+                 "calls", "passes", "seconds")
+
+    def __init__(self, pred: Dict[str, Any]):
+        self.pred = pred
+        op = operator(pred)
+        self.conjunction = OPERATORS[op]
+        self.operands: List[Dict[str, Any]] = pred[op]
+        n = len(self.operands)
+        self.order: List[int] = list(range(n))
+        self.fixed = False
+        self.tests = 0
+        self.calls = [0] * n
+        self.passes = [0] * n
+        self.seconds = [0.0] * n
+
+    def record(self, i: int, passed: bool, seconds: float) -> None:
+        """
+        Count a test of operand `i` (by declared position).
+        """
+        self.calls[i] += 1
+        self.passes[i] += passed
+        self.seconds[i] += seconds
+
+    def tested(self, every: int) -> None:
+        """
+        Count a test of the composite, and revise the order every `every`
+        tests.
+        """
+        self.tests += 1
+        if self.tests % every == 0:
+            self.reorder()
+
+    def reorder(self) -> None:
+        """
+        Order the operands by expected cost per decisive outcome: an
+        operand's mean time divided by the rate at which it ends the test
+        (fails, for `and`; passes, for `or`). Operands not tested yet go
+        first, so that they get measured; ties keep the declared order.
+        """
+        def rank(i):
+            calls = self.calls[i]
+            if not calls:
+                return (0, 0.0, i)
+            rate = self.passes[i] / calls
+            decisive = 1.0 - rate if self.conjunction else rate
+            cost = self.seconds[i] / calls
+            return (1, cost / decisive if decisive else float("inf"), i)
+        self.order = sorted(range(len(self.operands)), key=rank)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Returns:
+            For every operand in declared order: the operand, its number of
+            tests, pass rate and mean time in seconds.
+        """
+        return [{"operand": operand, "calls": calls,
+                 "pass_rate": passes / calls if calls else None,
+                 "mean_seconds": seconds / calls if calls else None}
+                for operand, calls, passes, seconds
+                in zip(self.operands, self.calls, self.passes, self.seconds)]
+
+
+class PredicateOrder:
+    """
+    Order in which the operands of the composite predicates (`and`, `or`) of
+    an evaluator are tested.
+
+    An `and` stops at its first failing operand and an `or` at its first
+    passing one, so the order of the operands does not change the outcome,
+    only how many are tested: operands must be free of side effects and
+    defined wherever the composite is tested. `cond` cases are never
+    reordered, since the first passing case wins.
+
+    By default operands are tested in declared order. With `adaptive`, the
+    cost and pass rate of every operand are measured, and the order is
+    revised every `every` tests so that cheap operands that decide the
+    outcome come first (see `Composite.reorder`); measurements carry over
+    from one call of the evaluator to the next. `plan` exports the current
+    orders, and `fix` pins orders (e.g. a plan exported before) so that
+    evaluation is deterministic.
+
+    The measurements are shared by every run of the evaluator, including
+    concurrent ones (`AsyncUttEval`, threaded server queries): they are
+    updated, and composites added and dropped, under a lock. Operands are
+    tested outside of it, in the order current when the test started.
+
+    Args:
+        adaptive: Measure operands and reorder them.
+        every: Number of tests of a composite between revisions.
+    """
+    def __init__(self, adaptive: bool = False, every: int = REORDER_EVERY):
+        self.adaptive = adaptive
+        self.every = every
+        # id(pred) -> Composite; each keeps its predicate, so ids are not reused
+        self._composites: Dict[int, Composite] = {}
+        # key -> pinned order, for composites not seen yet
+        self._fixed: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def declared(self) -> bool:
+        """
+        True if every composite is tested in declared order: not adaptive,
+        and no order pinned.
+        """
+        return not self.adaptive and not self._fixed
+
+    def composite(self, pred: Dict[str, Any]) -> Composite:
+        """
+        Returns:
+            The `Composite` of the composite predicate `pred`.
+        """
+        composite = self._composites.get(id(pred))
+        if composite is not None and composite.pred is pred:
+            return composite
+        with self._lock:
+            composite = self._composites.get(id(pred))
+            if composite is None or composite.pred is not pred:
+                if len(self._composites) >= MAX_COMPOSITES:
+                    del self._composites[next(iter(self._composites))]
+                composite = self._composites[id(pred)] = Composite(pred)
+                order = self._fixed.get(self.key(pred))
+                if order is not None:
+                    self._pin(composite, order)
+            return composite
+
+    def test(self, pred: Dict[str, Any], test: Callable[[Dict[str, Any]], Any]) -> bool:
+        """
+        Test the composite predicate `pred`.
+
+        Args:
+            pred: The composite predicate.
+            test: Function testing one operand.
+
+        Returns:
+            The outcome.
+        """
+        composite = self.composite(pred)
+        conjunction = composite.conjunction
+        operands = composite.operands
+        if not self.adaptive or composite.fixed:
+            for i in composite.order:
+                if bool(test(operands[i])) is not conjunction:
+                    return not conjunction
+            return conjunction
+        outcome = conjunction
+        measured = []
+        for i in composite.order:
+            start = time.perf_counter()
+            passed = bool(test(operands[i]))
+            measured.append((i, passed, time.perf_counter() - start))
+            if passed is not conjunction:
+                outcome = not conjunction
+                break
+        self.record(composite, measured)
+        return outcome
+
+    def record(self, composite: Composite, measured: List[Tuple[int, bool, float]]) -> None:
+        """
+        Count one adaptive test of `composite`.
+
+        Args:
+            composite: The composite tested.
+            measured: The operands tested, in order, as (declared position,
+                passed, seconds).
+        """
+        with self._lock:
+            for i, passed, seconds in measured:
+                composite.record(i, passed, seconds)
+            composite.tested(self.every)
+
+    @staticmethod
+    def key(pred: Dict[str, Any]) -> str:
+        """
+        Returns:
+            The canonical text of `pred`, which identifies it in plans.
+        """
+        return json.dumps(pred, sort_keys=True, separators=(",", ":"), default=repr)
+
+    def plan(self) -> Dict[str, List[int]]:
+        """
+        Returns:
+            The current operand order (declared positions) of every
+            composite tested so far, by `key`.
+        """
+        with self._lock:
+            plan = dict(self._fixed)
+            composites = list(self._composites.values())
+        plan.update((self.key(c.pred), list(c.order)) for c in composites)
+        return plan
+
+    def fix(self, plan: Dict[str, List[int]]) -> None:
+        """
+        Pin the operand orders of `plan`: the composites it names are tested
+        in these orders from now on, and never reordered.
+
+        Raises:
+            ValueError: If an order is not a permutation of the operands.
+        """
+        with self._lock:
+            self._fixed.update(plan)
+            for composite in self._composites.values():
+                order = plan.get(self.key(composite.pred))
+                if order is not None:
+                    self._pin(composite, order)
+
+    @staticmethod
+    def _pin(composite: Composite, order: List[int]) -> None:
+        if sorted(order) != list(range(len(composite.operands))):
+            raise ValueError(f"Invalid operand order: {order}")
+        composite.order = list(order)
+        composite.fixed = True
+
+    def composites(self) -> List[Composite]:
+        """
+        Returns:
+            The composites tested so far.
+        """
+        with self._lock:
+            return list(self._composites.values())
+
+    def reset(self) -> None:
+        """
+        Forget all measurements, orders and pinned plans.
+        """
+        with self._lock:
+            self._composites.clear()
+            self._fixed.clear()
@@ -0,0 +1,286 @@
+import time
+from collections.abc import Sized
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from . import predicates
+from .run import Run, RunState
+from .utt_eval import UttEval
+
+
+class ActionStats:
+    """
+    Counters of one action (or `cond` case) of an order over a traversal.
+
+    - `calls`: times the action was carried out.
+    - `seconds`: time spent in the action itself, not in the actions it led
+      to (the actions at the nodes a `follow` evaluates, the order of a
+      `cond` case). A `follow`'s time includes setting up the environments
+      of the nodes it evaluates.
+    - `tested` / `passed`: predicate tests, and how many passed, of a
+      `visit` or `cond` case. A `visit` of a node visited before is not
+      tested.
+    - `emitted`: results a `visit` produced.
+    - `candidates` / `selected` / `followed`: nodes a `follow` found in its
+      direction (when they could be counted), kept after its selector and
+      select-order, and evaluated (the others had been followed before).
+    """
+    __slots__ = ("calls", "seconds", "tested", "passed", "emitted", "candidates",
+                 "selected", "followed")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.tested = 0
+        self.passed = 0
+        self.emitted = 0
+        self.candidates = 0
+        self.selected = 0
+        self.followed = 0
+
+    @property
+    def pass_rate(self) -> Optional[float]:
+        return self.passed / self.tested if self.tested else None
+
+    @property
+    def selectivity(self) -> Optional[float]:
+        return self.selected / self.candidates if self.candidates else None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Profile:
+    """
+    Outcome of `explain_analyze`: the counters of every action of the order,
+    the number of nodes evaluated, the total time and the results.
+    """
+    def __init__(self, order: List[Dict[str, Any]], stats: Dict[int, ActionStats], nodes: int,
+                 seconds: float, results: Dict[str, List[Any]]):
+        self.order = order
+        self.stats = stats
+        self.nodes = nodes
+        self.seconds = seconds
+        self.results = results
+
+    def actions(self) -> Iterator[Tuple[Tuple[int, ...], Dict[str, Any], ActionStats]]:
+        """
+        Yields:
+            The path (positions of the action, and of the `cond` case and
+            action within it, ...), the action or case, and its counters,
+            for every action and `cond` case of the order, in document
+            order.
+        """
+        yield from self._walk(self.order, ())
+
+    def _walk(self, order, path):
+        for i, action in enumerate(order):
+            yield path + (i,), action, self.stats.get(id(action), ActionStats())
+            if "cond" in action:
+                for j, case in enumerate(action["cond"]):
+                    yield path + (i, j), case, self.stats.get(id(case), ActionStats())
+                    yield from self._walk(case.get("order", []), path + (i, j))
+
+    def selectivity(self) -> Dict[Tuple[int, ...], float]:
+        """
+        Returns:
+            The observed pass rate of every tested `visit` and `cond` case,
+            and the fraction of candidates kept by every `follow` whose
+            candidates were counted, by path.
+        """
+        rates = {}
+        for path, action, stats in self.actions():
+            rate = stats.selectivity if "follow" in action else stats.pass_rate
+            if rate is not None:
+                rates[path] = rate
+        return rates
+
+    def render(self) -> str:
+        """
+        Returns:
+            The order as an indented tree, each action annotated with its
+            counters.
+        """
+        counts = ", ".join(f"{name} {len(nodes)}" for name, nodes in self.results.items())
+        lines = [f"{self.nodes} nodes evaluated in {self.seconds * 1000:.2f} ms"
+                 + (f"; results: {counts}" if counts else "")]
+        rows = [("  " * (len(path) - 1) + _label(action), _annotation(action, stats))
+                for path, action, stats in self.actions()]
+        width = max((len(label) for label, _ in rows), default=0)
+        lines.extend(f"{label:<{width}}  {annotation}" for label, annotation in rows)
+        return "\n".join(lines)
+
+    def __str__(self) -> str:
+        return self.render()
+
+
+def _label(action: Dict[str, Any]) -> str:
+    if "pred" in action:
+        return "case " + _pred_label(action["pred"], action)
+    kind = next(iter(action))
+    if kind == "cond":
+        label = "cond"
+    elif kind == "visit":
+        label = "visit " + _pred_label(action["visit"], action)
+    else:
+        label = f"{kind} {action[kind]}"
+    for key in ("select", "select-order"):
+        if key in action:
+            spec = action[key]
+            label += f" {key}={spec['name'] if isinstance(spec, dict) else spec}"
+    if action.get("result-name"):
+        label += f" -> {action['result-name']}"
+    return label
+
+
+def _pred_label(pred: Any, spec: Dict[str, Any]) -> str:
+    if predicates.is_composite(pred):
+        op = predicates.operator(pred)
+        return f"{op}(" + ", ".join(_pred_label(operand["pred"], operand) for operand in pred[op]) + ")"
+    return " ".join([pred] + [str(arg) for arg in spec.get("args", [])])
+
+
+def _annotation(action: Dict[str, Any], stats: ActionStats) -> str:
+    if "pred" in action:
+        parts = [f"tested={stats.tested}", f"passed={stats.passed}" + _percent(stats.pass_rate)]
+    else:
+        parts = [f"calls={stats.calls}"]
+        if "visit" in action:
+            parts += [f"tested={stats.tested}", f"passed={stats.passed}" + _percent(stats.pass_rate),
+                      f"emitted={stats.emitted}"]
+        elif "follow" in action:
+            parts += [f"candidates={stats.candidates}",
+                      f"selected={stats.selected}" + _percent(stats.selectivity),
+                      f"followed={stats.followed}"]
+        parts.append(f"time={stats.seconds * 1000:.2f}ms")
+    return " ".join(parts)
+
+
+def _percent(rate: Optional[float]) -> str:
+    return f" ({rate:.1%})" if rate is not None else ""
+
+
+class ProfilingUttEval(UttEval):
+    """
+    `UttEval` that counts, for every action and `cond` case of the order,
+    its calls, predicate tests, emitted results, follow fan-out and time
+    (see `ActionStats`). The counters of a run are in its `profile`, by id
+    of the action or case.
+    """
+    profile = RunState()
+    _tests = RunState()
+    _site = RunState()
+    _nested = RunState()
+    _nodes = RunState()
+
+    def __init__(self, debug=False, seed=None):
+        super().__init__(debug=debug, seed=seed)
+        self.profile: Dict[int, ActionStats] = {}
+        # predicate outcomes of the action being carried out
+        self._tests: List[bool] = []
+        # counters of the follow whose nodes are being selected
+        self._site: Optional[ActionStats] = None
+        # time spent in the actions nested in the current one
+        self._nested = 0.0
+        self._nodes = 0
+        self.dispatch_table = {kind: self._timed(kind, fn) for kind, fn in self.dispatch_table.items()}
+
+    def _stats(self, action: Dict[str, Any]) -> ActionStats:
+        stats = self.profile.get(id(action))
+        if stats is None:
+            stats = self.profile[id(action)] = ActionStats()
+        return stats
+
+    def _pred(self, pred, spec, env):
+        # the operands of a composite predicate are not tests of the action
+        tests = self._tests
+        self._tests = []
+        try:
+            passed = super()._pred(pred, spec, env)
+        finally:
+            self._tests = tests
+        tests.append(bool(passed))
+        return passed
+
+    def _timed(self, kind: str, fn: Callable) -> Callable:
+        def timed(action, env):
+            stats = self._stats(action)
+            stats.calls += 1
+            tests, site, nested = self._tests, self._site, self._nested
+            self._tests = []
+            self._site = stats if kind == "follow" else None
+            self._nested = 0.0
+            if kind == "visit":
+                result_name = action.get("result-name")
+                before = len(self.results.get(result_name, ())) if result_name else 0
+            start = time.perf_counter()
+            try:
+                fn(action, env)
+            finally:
+                elapsed = time.perf_counter() - start
+                stats.seconds += elapsed - self._nested
+                if kind == "visit":
+                    stats.tested += len(self._tests)
+                    stats.passed += sum(self._tests)
+                    if result_name:
+                        stats.emitted += len(self.results.get(result_name, ())) - before
+                elif kind == "cond":
+                    # cases are tested in order until one passes
+                    for case, passed in zip(action["cond"], self._tests):
+                        case_stats = self._stats(case)
+                        case_stats.tested += 1
+                        case_stats.passed += passed
+                self._tests, self._site, self._nested = tests, site, nested + elapsed
+        return timed
+
+    def eval(self, node, order, visited, followed):
+        self._nodes += 1
+        site = self._site
+        if site is not None:
+            site.followed += 1
+        # actions at the followed node have their own counters
+        self._site = None
+        try:
+            super().eval(node, order, visited, followed)
+        finally:
+            self._site = site
+
+    def _apply_select(self, select_spec, nodes, env, cur=None):
+        if self._site is not None and isinstance(nodes, Sized):
+            self._site.candidates += len(nodes)
+        return super()._apply_select(select_spec, nodes, env, cur)
+
+    def _apply_select_order(self, select_order_spec, nodes):
+        ordered = super()._apply_select_order(select_order_spec, nodes)
+        if self._site is not None:
+            ordered = list(ordered)
+            self._site.selected += len(ordered)
+        return ordered
+
+    def _evaluate(self, node, order):
+        self.profile = {}
+        self._tests = []
+        self._site = None
+        self._nested = 0.0
+        self._nodes = 0
+        return super()._evaluate(node, order)
+
+
+def explain_analyze(node: Any, order: List[Dict[str, Any]],
+                    evaluator: Optional[ProfilingUttEval] = None) -> Profile:
+    """
+    Evaluate `order` from `node`, counting what every action does.
+
+    Args:
+        node: Start node.
+        order: A traversal order.
+        evaluator: The evaluator to run, e.g. with a `seed` or extra
+            predicates. A new `ProfilingUttEval` by default.
+
+    Returns:
+        The profile of the traversal; `str(profile)` renders the order
+        annotated with its counters.
+    """
+    evaluator = evaluator if evaluator is not None else ProfilingUttEval()
+    start = time.perf_counter()
+    run: Run = evaluator.run(node, order)
+    seconds = time.perf_counter() - start
+    return Profile(order, run.profile, run._nodes, seconds, run.results)
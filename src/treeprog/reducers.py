@@ -0,0 +1,393 @@
+import bisect
+import hashlib
+import heapq
+import json
+import math
+from collections import Counter
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+
+
+class Reducer:
+    """
+    Streaming summary of the values fed to an `aggregate` action.
+
+    Values are folded in one at a time with `add`, in O(1) or O(k) memory
+    per reducer. Two reducers of the same kind built from different parts
+    of a traversal (e.g. by parallel workers) combine with `merge` into the
+    reducer of the whole.
+    """
+    def add(self, value: Any, item: Any = None) -> None:
+        """
+        Args:
+            value: The value to fold in.
+            item: What the value describes (used by `top-k`), or None.
+        """
+        raise NotImplementedError
+
+    def merge(self, other: "Reducer") -> "Reducer":
+        """
+        Fold the values of `other`, a reducer of the same kind, into this one.
+
+        Returns:
+            This reducer.
+        """
+        raise NotImplementedError
+
+    def result(self) -> Any:
+        """
+        Returns:
+            The summary of the values folded in so far.
+        """
+        raise NotImplementedError
+
+
+class Count(Reducer):
+    """
+    Number of values.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value=None, item=None):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+        return self
+
+    def result(self):
+        return self.count
+
+
+class Sum(Reducer):
+    """
+    Sum of the values.
+    """
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value, item=None):
+        self.total += value
+
+    def merge(self, other):
+        self.total += other.total
+        return self
+
+    def result(self):
+        return self.total
+
+
+class Mean(Reducer):
+    """
+    Mean of the values, or None if there are none.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value, item=None):
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+
+class Min(Reducer):
+    """
+    Smallest value, or None if there are none.
+    """
+    def __init__(self):
+        self.value: Any = None
+
+    def add(self, value, item=None):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class Max(Reducer):
+    """
+    Largest value, or None if there are none.
+    """
+    def __init__(self):
+        self.value: Any = None
+
+    def add(self, value, item=None):
+        if self.value is None or value > self.value:
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+        return self
+
+    def result(self):
+        return self.value
+
+
+class Distinct(Reducer):
+    """
+    Approximate number of distinct values (HyperLogLog), in a fixed 2^p
+    bytes of memory with a relative error of about 1.04 / sqrt(2^p).
+
+    Values are told apart by their JSON form.
+
+    Args:
+        p: Number of index bits, 4 to 16.
+    """
+    def __init__(self, p: int = 12):
+        if not 4 <= p <= 16:
+            raise ValueError(f"Invalid precision: {p}")
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, value, item=None):
+        digest = hashlib.blake2b(json.dumps(value, sort_keys=True, default=repr).encode(),
+                                 digest_size=8).digest()
+        h = int.from_bytes(digest, "big")
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("Cannot merge Distinct reducers of different precision")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def result(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class Histogram(Reducer):
+    """
+    Histogram of the values. With `bins`, a list of increasing bin edges,
+    it counts the values in each bin [bins[i], bins[i+1]) in O(len(bins))
+    memory, and the values outside the edges in `under` and `over`. Without
+    `bins`, it counts every distinct value.
+
+    Args:
+        bins: Bin edges, or None.
+    """
+    def __init__(self, bins: Optional[List[float]] = None):
+        self.bins = list(bins) if bins is not None else None
+        self.counts: Any = [0] * (len(self.bins) - 1) if self.bins is not None else Counter()
+        self.under = 0
+        self.over = 0
+
+    def add(self, value, item=None):
+        if self.bins is None:
+            self.counts[value] += 1
+            return
+        i = bisect.bisect_right(self.bins, value) - 1
+        if i < 0:
+            self.under += 1
+        elif i >= len(self.counts):
+            self.over += 1
+        else:
+            self.counts[i] += 1
+
+    def merge(self, other):
+        if self.bins is None:
+            self.counts.update(other.counts)
+        else:
+            if other.bins != self.bins:
+                raise ValueError("Cannot merge histograms with different bins")
+            self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+            self.under += other.under
+            self.over += other.over
+        return self
+
+    def result(self):
+        if self.bins is None:
+            return dict(self.counts)
+        return {"bins": self.bins, "counts": list(self.counts),
+                "under": self.under, "over": self.over}
+
+
+class TopK(Reducer):
+    """
+    The `k` largest (or smallest) values, in O(k) memory. When an item is
+    given with each value, the items are kept instead of the values. Ties
+    keep the value added first.
+
+    Args:
+        k: Number of values to keep.
+        largest: Keep the largest values if True, the smallest otherwise.
+    """
+    def __init__(self, k: int, largest: bool = True):
+        self.k = k
+        self.largest = largest
+        self.seen = 0
+        # (key, -arrival, value or item); the root is the entry to evict
+        self.heap: List[Any] = []
+
+    def _push(self, key, seq, entry):
+        if self.k <= 0:
+            return
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (key, -seq, entry))
+        elif (key, -seq) > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, (key, -seq, entry))
+
+    def add(self, value, item=None):
+        # entries are compared by key and arrival only, never by item
+        key = value if self.largest else _Reversed(value)
+        self._push(key, self.seen, _Entry(item if item is not None else value))
+        self.seen += 1
+
+    def merge(self, other):
+        for key, seq, entry in other.heap:
+            self._push(key, self.seen - seq, entry)
+        self.seen += other.seen
+        return self
+
+    def result(self):
+        return [entry.value for _, _, entry in sorted(self.heap, reverse=True)]
+
+
+class _Reversed:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class _Entry:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return False
+
+
+class Grouped(Reducer):
+    """
+    One reducer per group key, created on first use.
+
+    Args:
+        factory: Function returning a new reducer.
+    """
+    def __init__(self, factory: Callable[[], Reducer]):
+        self.factory = factory
+        self.groups: Dict[Any, Reducer] = {}
+
+    def add(self, value, item=None, key=None):
+        reducer = self.groups.get(key)
+        if reducer is None:
+            reducer = self.groups[key] = self.factory()
+        reducer.add(value, item)
+
+    def merge(self, other):
+        for key, reducer in other.groups.items():
+            if key in self.groups:
+                self.groups[key].merge(reducer)
+            else:
+                self.groups[key] = reducer
+        return self
+
+    def result(self):
+        return {key: reducer.result() for key, reducer in self.groups.items()}
+
+
+# reducer name -> factory; the factory's arguments come from the action's
+# reducer spec, e.g. {"aggregate": {"name": "top-k", "args": [5]}, ...}
+REDUCERS: Dict[str, Callable[..., Reducer]] = {
+    "count": Count,
+    "sum": Sum,
+    "mean": Mean,
+    "min": Min,
+    "max": Max,
+    "distinct": Distinct,
+    "histogram": Histogram,
+    "top-k": TopK,
+}
+
+
+def make(spec: Any, registry: Dict[str, Callable[..., Reducer]], grouped: bool = False) -> Reducer:
+    """
+    Args:
+        spec: Reducer spec of an `aggregate` action: a reducer name, or a
+            dict with the name and the factory's `args` and `kwargs`.
+        registry: Reducer factories by name, see `REDUCERS`.
+        grouped: Return a `Grouped` reducer of such reducers.
+
+    Returns:
+        A new reducer.
+    """
+    # a partial rather than a closure keeps Grouped reducers picklable
+    if isinstance(spec, str):
+        factory = partial(registry[spec])
+    elif isinstance(spec, dict):
+        factory = partial(registry[spec['name']], *spec.get('args', []), **spec.get('kwargs', {}))
+    else:
+        raise ValueError(f"Invalid aggregate specification: {spec}")
+    return Grouped(factory) if grouped else factory()
+
+
+def results(aggregates: Dict[str, Reducer]) -> Dict[str, Any]:
+    """
+    Args:
+        aggregates: Reducers by result name.
+
+    Returns:
+        Their results by result name.
+    """
+    return {name: reducer.result() for name, reducer in aggregates.items()}
+
+
+def merge_all(parts: List[Dict[str, Reducer]]) -> Dict[str, Reducer]:
+    """
+    Merge the aggregates of several traversals (e.g. of parallel workers)
+    into one set of reducers.
+
+    Args:
+        parts: Reducers by result name, one dictionary per traversal. The
+            first dictionary's reducers are merged into in place.
+
+    Returns:
+        The merged reducers by result name.
+    """
+    merged: Dict[str, Reducer] = {}
+    for part in parts:
+        for name, reducer in part.items():
+            if name in merged:
+                merged[name].merge(reducer)
+            else:
+                merged[name] = reducer
+    return merged
@@ -0,0 +1,193 @@
+import json
+from collections.abc import Mapping, Sequence
+from typing import Any, Callable, Dict, List, Optional, Union
+import numpy as np
+from .index import TreeIndex
+
+FORMAT_VERSION = 1
+
+
+def delta_encode(ids: Any) -> np.ndarray:
+    """
+    Delta-encode a sequence of node ids using the smallest signed integer
+    dtype that holds every delta.
+
+    Args:
+        ids: Sequence of integer node ids.
+
+    Returns:
+        Array whose first element is the first id and whose remaining
+        elements are the differences between consecutive ids.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int8)
+    deltas = np.diff(ids, prepend=0)
+    lo, hi = int(deltas.min()), int(deltas.max())
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return deltas.astype(dtype)
+    return deltas
+
+
+def delta_decode(deltas: np.ndarray) -> np.ndarray:
+    """
+    Inverse of `delta_encode`.
+
+    Args:
+        deltas: Array produced by `delta_encode`.
+
+    Returns:
+        Array of node ids.
+    """
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+def encode_results(results: Dict[str, List[Any]], index: TreeIndex) -> Dict[str, np.ndarray]:
+    """
+    Replace the nodes of a result dictionary by their delta-encoded ids.
+
+    Args:
+        results: Result dictionary as returned by an evaluator.
+        index: Index of the tree the results were computed on.
+
+    Returns:
+        Dictionary mapping each result name to a delta-encoded id array.
+    """
+    return {name: delta_encode([index.id(node) for node in nodes])
+            for name, nodes in results.items()}
+
+
+def _projector(payload: Union[str, Callable, None]) -> Optional[Callable]:
+    if payload is None or callable(payload):
+        return payload
+    return lambda node: (node.payload.get(payload)
+                         if isinstance(node.payload, dict) else None)
+
+
+def save_results(file: Any, results: Dict[str, List[Any]], index: TreeIndex,
+                 payload: Union[str, Callable, None] = None) -> None:
+    """
+    Save results as compressed delta-encoded node ids.
+
+    Args:
+        file: Path or binary file object to write to.
+        results: Result dictionary as returned by an evaluator.
+        index: Index of the tree the results were computed on.
+        payload: Optional payload projection stored next to the ids. Either a
+            key looked up in dictionary payloads or a callable taking a node.
+            Projected values must be JSON serializable.
+    """
+    project = _projector(payload)
+    names = list(results)
+    arrays = {}
+    for i, (name, deltas) in enumerate(encode_results(results, index).items()):
+        arrays[f"ids_{i}"] = deltas
+        if project is not None:
+            values = json.dumps([project(node) for node in results[name]])
+            arrays[f"payload_{i}"] = np.frombuffer(values.encode(), dtype=np.uint8)
+    meta = {"version": FORMAT_VERSION, "size": len(index), "names": names,
+            "payload": project is not None}
+    arrays["meta"] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    np.savez_compressed(file, **arrays)
+
+
+class StoredResults(Mapping):
+    """
+    Results loaded by `load_results`: a mapping from result name to an array
+    of node ids, plus the optional payload projection.
+    """
+    def __init__(self, ids: Dict[str, np.ndarray], size: int,
+                 payloads: Optional[Dict[str, List[Any]]] = None):
+        self.ids = ids
+        self.size = size
+        self.payloads = payloads
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.ids[name]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def view(self, index: TreeIndex) -> "ResultView":
+        """
+        Map the stored ids back onto a tree without materializing node lists.
+
+        Args:
+            index: Index of the tree the results were computed on.
+
+        Returns:
+            A `ResultView` over `index`.
+        """
+        if len(index) != self.size:
+            raise ValueError(f"Results were saved for a tree of {self.size} nodes, "
+                             f"index has {len(index)}")
+        return ResultView(self.ids, index)
+
+
+def load_results(file: Any) -> StoredResults:
+    """
+    Load results written by `save_results`.
+
+    Args:
+        file: Path or binary file object to read from.
+
+    Returns:
+        The stored node ids (and payload projection, if one was saved).
+    """
+    with np.load(file) as data:
+        meta = json.loads(data["meta"].tobytes())
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported result format version: {meta['version']}")
+        ids = {name: delta_decode(data[f"ids_{i}"])
+               for i, name in enumerate(meta["names"])}
+        payloads = None
+        if meta["payload"]:
+            payloads = {name: json.loads(data[f"payload_{i}"].tobytes())
+                        for i, name in enumerate(meta["names"])}
+    return StoredResults(ids, meta["size"], payloads)
+
+
+class NodeList(Sequence):
+    """
+    Read-only sequence of nodes backed by an id array and a tree index.
+    Nodes are looked up on access; nothing is copied.
+    """
+    def __init__(self, ids: np.ndarray, index: TreeIndex):
+        self.ids = ids
+        self.index = index
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return NodeList(self.ids[i], self.index)
+        return self.index.nodes[self.ids[i]]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        nodes = self.index.nodes
+        return (nodes[i] for i in self.ids.tolist())
+
+
+class ResultView(Mapping):
+    """
+    Read-only result dictionary whose values are `NodeList` views onto the
+    indexed tree.
+    """
+    def __init__(self, ids: Dict[str, np.ndarray], index: TreeIndex):
+        self.ids = ids
+        self.index = index
+
+    def __getitem__(self, name: str) -> NodeList:
+        return NodeList(self.ids[name], self.index)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
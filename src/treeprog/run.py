@@ -0,0 +1,72 @@
+import contextvars
+import copy
+from typing import Any, Optional
+
+
+class Run:
+    """
+    State of one invocation of an evaluator: the traversal in progress and,
+    once it is done, what it produced (`results`, and `payloads`,
+    `aggregates` and `folds` for evaluators that support them).
+    """
+    def __repr__(self) -> str:
+        return f"Run({', '.join(sorted(vars(self)))})"
+
+
+class RunState:
+    """
+    Evaluator attribute that belongs to the current `Run` rather than to the
+    evaluator, so that concurrent invocations of one evaluator do not see
+    each other's state.
+    """
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+
+    def __get__(self, obj: Any, objtype: Optional[type] = None) -> Any:
+        if obj is None:
+            return self
+        try:
+            return obj._run().__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, obj: Any, value: Any) -> None:
+        vars(obj._run())[self.name] = value
+
+
+class Reentrant:
+    """
+    Base of evaluators that keep their per-invocation state in `Run`s.
+
+    Every invocation starts a new run, which becomes the current run of the
+    calling thread (or asyncio task) only: the `RunState` attributes of the
+    evaluator read and write it there. The evaluator itself, its dispatch
+    tables and its configuration, is never modified by an invocation, so one
+    instance can serve concurrent invocations from many threads.
+
+    A new run starts with (shallow copies of) the values the evaluator's
+    constructor gave its `RunState` attributes. Outside of any run of its
+    own, a thread sees the run started last.
+    """
+    def _run(self) -> Run:
+        try:
+            return self._runs.get(self._last)
+        except AttributeError:
+            # first use, while the evaluator is being constructed
+            self._runs = contextvars.ContextVar(f"treeprog-run-{id(self)}")
+            self._initial = self._last = Run()
+            return self._last
+
+    def _begin(self) -> Run:
+        """
+        Start a new run and make it the current run.
+
+        Returns:
+            The new run.
+        """
+        self._run()
+        run = Run()
+        vars(run).update((key, copy.copy(value)) for key, value in vars(self._initial).items())
+        self._last = run
+        self._runs.set(run)
+        return run
@@ -0,0 +1,168 @@
+import hashlib
+import heapq
+import math
+import random
+import sys
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import numpy as np
+from .index import TreeIndex
+
+_END = object()
+
+
+def _uniform(rng: random.Random) -> float:
+    # uniform on (0, 1): logarithms below must never see 0
+    return rng.random() or sys.float_info.min
+
+
+def reservoir_sample(items: Iterable[Any], k: int, rng: random.Random) -> List[Any]:
+    """
+    Sample without replacement up to `k` items from an iterable of unknown
+    length in one pass and O(k) memory (Li's Algorithm L, which draws
+    O(k log(n/k)) random numbers instead of one per item).
+
+    Args:
+        items: Items to sample from. Consumed once.
+        k: Maximum number of items to select.
+        rng: Random number generator to draw from.
+
+    Returns:
+        List of up to `k` items in random order.
+    """
+    if k <= 0:
+        return []
+    it = iter(items)
+    reservoir = list(islice(it, k))
+    if len(reservoir) == k:
+        w = math.exp(math.log(_uniform(rng)) / k)
+        while True:
+            skip = math.floor(math.log(_uniform(rng)) / math.log1p(-w))
+            item = next(islice(it, skip, None), _END)
+            if item is _END:
+                break
+            reservoir[rng.randrange(k)] = item
+            w *= math.exp(math.log(_uniform(rng)) / k)
+    rng.shuffle(reservoir)
+    return reservoir
+
+
+def weighted_sample(items: Iterable[Any], k: int, weight: Callable[[Any], float],
+                    rng: random.Random) -> List[Any]:
+    """
+    Weighted sampling without replacement in one pass and O(k) memory
+    (Efraimidis-Spirakis A-Res): each item draws the key u^(1/w) and the `k`
+    items with the largest keys are kept. Items with a non-positive weight
+    are never selected.
+
+    Args:
+        items: Items to sample from. Consumed once.
+        k: Maximum number of items to select.
+        weight: Function mapping an item to its weight.
+        rng: Random number generator to draw from.
+
+    Returns:
+        List of up to `k` items, in order of decreasing key.
+    """
+    if k <= 0:
+        return []
+    heap: List[Any] = []
+    for i, item in enumerate(items):
+        w = weight(item)
+        if not w > 0:
+            continue
+        # log(u) / w orders items exactly as u ** (1 / w) does
+        key = math.log(_uniform(rng)) / w
+        if len(heap) < k:
+            heapq.heappush(heap, (key, i, item))
+        elif key > heap[0][0]:
+            heapq.heapreplace(heap, (key, i, item))
+    return [item for _, _, item in sorted(heap, reverse=True)]
+
+
+def shuffled(items: Iterable[Any], rng: random.Random) -> List[Any]:
+    """
+    Args:
+        items: Items to shuffle. Not modified.
+        rng: Random number generator to draw from.
+
+    Returns:
+        A new list with the items in random order.
+    """
+    items = list(items)
+    rng.shuffle(items)
+    return items
+
+
+def sample_nodes(index: TreeIndex, k: int, rng: random.Random) -> List[Any]:
+    """
+    Uniformly sample up to `k` distinct nodes of an indexed tree in O(k).
+
+    Args:
+        index: Index of the tree.
+        k: Maximum number of nodes to select.
+        rng: Random number generator to draw from.
+    """
+    nodes = index.nodes
+    return [nodes[i] for i in rng.sample(range(len(nodes)), min(k, len(nodes)))]
+
+
+class WeightedNodeSampler:
+    """
+    Draws nodes of an indexed tree with probability proportional to a weight,
+    with replacement, in O(log n) per draw after an O(n) setup.
+
+    Args:
+        index: Index of the tree.
+        weight: Function mapping a node to its (non-negative) weight.
+    """
+    def __init__(self, index: TreeIndex, weight: Callable[[Any], float]):
+        self.index = index
+        weights = np.fromiter((weight(node) for node in index.nodes),
+                              dtype=np.float64, count=len(index))
+        self.cumulative = np.cumsum(np.clip(weights, 0, None))
+
+    def sample(self, k: int, rng: random.Random) -> List[Any]:
+        """
+        Args:
+            k: Number of nodes to draw.
+            rng: Random number generator to draw from.
+        """
+        total = self.cumulative[-1] if len(self.cumulative) else 0.0
+        if k <= 0 or total <= 0:
+            return []
+        u = np.array([rng.random() for _ in range(k)]) * total
+        ids = np.searchsorted(self.cumulative, u, side="right")
+        nodes = self.index.nodes
+        return [nodes[i] for i in ids.tolist()]
+
+
+class RandomStreams:
+    """
+    Independent, reproducible random number streams for one traversal.
+
+    Each stream is a `random.Random` seeded from the traversal seed and the
+    stream's key, so draws at one site (e.g. one `follow` action) never shift
+    the draws at another, and the same seed always reproduces the same
+    traversal. Without a seed, a fresh one is drawn from the system.
+
+    Args:
+        seed: Traversal seed, or None.
+    """
+    def __init__(self, seed: Optional[Any] = None):
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(64)
+        self.streams: Dict[str, random.Random] = {}
+
+    def get(self, key: str) -> random.Random:
+        """
+        Args:
+            key: Name of the stream.
+
+        Returns:
+            The stream named `key`, created on first use.
+        """
+        rng = self.streams.get(key)
+        if rng is None:
+            digest = hashlib.blake2b(f"{self.seed!r}\0{key}".encode(), digest_size=8).digest()
+            rng = self.streams[key] = random.Random(int.from_bytes(digest, "big"))
+        return rng
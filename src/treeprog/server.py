@@ -0,0 +1,483 @@
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import AlgoTree as at
+from . import analysis
+from .index import TreeIndex
+from .run import Run, RunState
+from .utt_eval import UttEval
+
+# result nodes per streamed message
+BATCH_SIZE = 1000
+# result nodes a query emits ahead of the client reading its reply; the
+# query waits beyond that
+MAX_PENDING = 10 * BATCH_SIZE
+# parsed orders kept resident
+MAX_PLANS = 1024
+
+_DONE = object()
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised inside a query that used up its budget.
+    """
+
+
+class QueryCancelled(Exception):
+    """
+    Raised inside a query whose reply is no longer read.
+    """
+
+
+class TreeRegistry:
+    """
+    Named trees kept resident, each with its structural index.
+
+    Registered trees must not be changed: queries run against them
+    concurrently and reuse their index.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trees: Dict[str, TreeIndex] = {}
+
+    def add(self, name: str, root: Any) -> TreeIndex:
+        """
+        Register the tree of `root` under `name`, replacing any tree of
+        that name.
+
+        Returns:
+            The index of the tree.
+        """
+        index = TreeIndex.of(root)
+        with self._lock:
+            self._trees[name] = index
+        return index
+
+    def load(self, name: str, path: str) -> TreeIndex:
+        """
+        Register the tree stored in the JSON file `path` (in the format of
+        `TreeNode.to_dict`) under `name`.
+
+        Returns:
+            The index of the tree.
+        """
+        with open(path) as f:
+            return self.add(name, at.TreeNode.from_dict(json.load(f)))
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self._trees.pop(name, None)
+
+    def get(self, name: str) -> TreeIndex:
+        """
+        Raises:
+            ValueError: If no tree is registered under `name`.
+        """
+        index = self._trees.get(name)
+        if index is None:
+            raise ValueError(f"Unknown tree: {name}")
+        return index
+
+    def names(self) -> Dict[str, int]:
+        """
+        Returns:
+            The number of nodes of every registered tree, by name.
+        """
+        return {name: len(index) for name, index in list(self._trees.items())}
+
+
+class ServerUttEval(UttEval):
+    """
+    Evaluator of a query server: one instance serves every query.
+
+    Orders are compiled once, by the server's order cache, and the index of
+    a registered tree is reused rather than rebuilt. Result nodes are passed
+    to the run's `sink` as they are emitted, and a run stops with
+    `BudgetExceeded` once it has evaluated `max_nodes` nodes or run for
+    `max_seconds`, and with `QueryCancelled` once its `cancelled` event is
+    set.
+    """
+    resident = RunState()
+    sink = RunState()
+    deadline = RunState()
+    remaining = RunState()
+    cancelled = RunState()
+
+    def __init__(self, debug=False, seed=None):
+        super().__init__(debug=debug, seed=seed)
+        self.resident = None
+        self.sink = None
+        self.deadline = None
+        self.remaining = None
+        self.cancelled = None
+
+    def query(self, index: TreeIndex, node: Any, order: List[Dict[str, Any]],
+              sink: Optional[Callable[[str, Any], None]] = None,
+              max_nodes: Optional[int] = None, max_seconds: Optional[float] = None,
+              cancelled: Optional[threading.Event] = None) -> Run:
+        """
+        Evaluate `order` from `node` of the resident tree `index`.
+
+        Args:
+            index: Index of the tree.
+            node: Start node.
+            order: A traversal order.
+            sink: Function called with the result name and node of every
+                result, as it is emitted.
+            max_nodes: Maximum number of nodes to evaluate, or None.
+            max_seconds: Maximum running time, or None.
+            cancelled: Event set to stop the query, or None.
+
+        Returns:
+            The run.
+
+        Raises:
+            BudgetExceeded: If the query used up its budget.
+            QueryCancelled: If `cancelled` was set.
+        """
+        run = self._begin()
+        self.resident = index
+        self.sink = sink
+        self.deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+        self.remaining = max_nodes
+        self.cancelled = cancelled
+        self._evaluate(node, order)
+        return run
+
+    def eval(self, node, order, visited, followed):
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                raise BudgetExceeded("Node budget exceeded")
+            self.remaining -= 1
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded("Time budget exceeded")
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise QueryCancelled("Query cancelled")
+        super().eval(node, order, visited, followed)
+
+    def _emit(self, result_name, node):
+        super()._emit(result_name, node)
+        if self.sink is not None:
+            self.sink(result_name, node)
+
+    def _tree_index(self, node):
+        if self.resident is not None and node in self.resident:
+            return self.resident
+        return super()._tree_index(node)
+
+
+class OrderCache:
+    """
+    Parsed orders by normalized text, so that every query with the same
+    order runs the same (compiled) order object.
+    """
+    def __init__(self, max_orders: int = MAX_PLANS):
+        self.max_orders = max_orders
+        self._orders: Dict[str, List[Dict[str, Any]]] = {}
+
+    def get(self, order: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        key = analysis.normalize_order(order)
+        cached = self._orders.get(key)
+        if cached is None:
+            if len(self._orders) >= self.max_orders:
+                self._orders.clear()
+            # the first order seen with this text; not the normalized text,
+            # whose sorted keys would change each action's type
+            cached = self._orders[key] = order
+        return cached
+
+
+class QueryServer:
+    """
+    Runs queries against resident trees on a pool of worker threads.
+
+    A query is a JSON object::
+
+        {"tree": "<name>", "order": [...], "start": <node id>,
+         "budget": {"max_nodes": <int>, "max_seconds": <float>}}
+
+    where `start` (default 0, the root) and `budget` are optional. Other
+    requests are `{"op": "trees"}`, `{"op": "load", "tree": "<name>",
+    "path": "<file>"}` and `{"op": "remove", "tree": "<name>"}`. `load`
+    only reads files under `root`, and is refused without one.
+
+    The reply is a stream of JSON messages: result batches
+    `{"result": "<name>", "ids": [...], "names": [...]}` as the query emits
+    them (ids are preorder ids in the tree), then `{"done": true,
+    "counts": {...}, "aggregates": {...}, "seconds": ...}`, or
+    `{"error": "..."}` if the request is invalid, or the query failed or
+    used up its budget. The replies to other requests are a single message,
+    and every reply ends with a message that has `done` or `error`: no
+    request, and no exception raised by a query, ends the stream otherwise.
+
+    A query emits at most `MAX_PENDING` results ahead of the reader of its
+    reply, and is cancelled when the reply is closed before its end (as the
+    socket and HTTP handlers do when the client goes away).
+
+    Args:
+        registry: The resident trees.
+        workers: Number of queries run at once.
+        max_nodes: Node budget of queries that do not set one, or None.
+        max_seconds: Time budget of queries that do not set one, or None.
+        root: Directory the `load` op reads trees from, or None to refuse
+            `load` requests.
+    """
+    def __init__(self, registry: TreeRegistry, workers: int = 4,
+                 max_nodes: Optional[int] = None, max_seconds: Optional[float] = None,
+                 root: Optional[str] = None):
+        self.registry = registry
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+        self.root = os.path.realpath(root) if root is not None else None
+        self.evaluator = ServerUttEval()
+        self.orders = OrderCache()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="treeprog-query")
+
+    def handle(self, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Args:
+            request: A request.
+
+        Returns:
+            The reply messages, produced as they become available.
+        """
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("Invalid request: not an object")
+            op = request.get("op", "query")
+            if op == "query":
+                yield from self._query(request)
+            elif op == "trees":
+                yield {"done": True, "trees": self.registry.names()}
+            elif op == "load":
+                index = self.registry.load(request["tree"], self._path(request["path"]))
+                yield {"done": True, "loaded": request["tree"], "nodes": len(index)}
+            elif op == "remove":
+                self.registry.remove(request["tree"])
+                yield {"done": True, "removed": request["tree"]}
+            else:
+                raise ValueError(f"Invalid op: {op}")
+        except KeyError as e:
+            yield {"error": f"Missing key: {e}"}
+        except (ValueError, TypeError, OSError, BudgetExceeded) as e:
+            yield {"error": str(e)}
+        except Exception as e:
+            # e.g. raised by a predicate of the order
+            yield {"error": f"{type(e).__name__}: {e}"}
+
+    def _path(self, path: Any) -> str:
+        # `path` resolved under the root, links included
+        if self.root is None:
+            raise ValueError("Invalid op: load is disabled")
+        if not isinstance(path, str):
+            raise ValueError(f"Invalid path: {path!r}")
+        full = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, full]) != self.root:
+            raise ValueError(f"Invalid path: {path} is outside the tree root")
+        return full
+
+    def _query(self, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        index = self.registry.get(request["tree"])
+        if not isinstance(request["order"], list) or not all(isinstance(a, dict) for a in request["order"]):
+            raise ValueError("Invalid order: not a list of actions")
+        order = self.orders.get(request["order"])
+        start = request.get("start", 0)
+        if type(start) is not int or start not in range(len(index)):
+            raise ValueError(f"Invalid start: {start!r}")
+        start = index.node(start)
+        budget = request.get("budget", {})
+        if not isinstance(budget, dict):
+            raise ValueError("Invalid budget: not an object")
+        max_nodes = budget.get("max_nodes", self.max_nodes)
+        max_seconds = budget.get("max_seconds", self.max_seconds)
+
+        emitted: "queue.Queue[Any]" = queue.Queue(MAX_PENDING)
+        cancelled = threading.Event()
+        began = time.monotonic()
+
+        def put(item: Any) -> None:
+            # wait for room, unless nobody reads any more
+            while not cancelled.is_set():
+                try:
+                    emitted.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise QueryCancelled("Query cancelled")
+
+        def job() -> Run:
+            try:
+                return self.evaluator.query(index, start, order, lambda name, node: put((name, node)),
+                                            max_nodes=max_nodes, max_seconds=max_seconds, cancelled=cancelled)
+            finally:
+                try:
+                    put(_DONE)
+                except QueryCancelled:
+                    pass
+        future = self.pool.submit(job)
+
+        batch: Dict[str, List[Any]] = {}
+        counts: Dict[str, int] = {}
+        try:
+            while True:
+                item = emitted.get()
+                if item is _DONE:
+                    break
+                name, node = item
+                nodes = batch.setdefault(name, [])
+                nodes.append(node)
+                counts[name] = counts.get(name, 0) + 1
+                # flush a full batch, or whatever arrived while the query is idle
+                if len(nodes) >= BATCH_SIZE or emitted.empty():
+                    yield self._batch(index, name, nodes)
+                    batch[name] = []
+            for name, nodes in batch.items():
+                if nodes:
+                    yield self._batch(index, name, nodes)
+        finally:
+            # the reply was closed before its end: stop the query
+            cancelled.set()
+
+        run = future.result()
+        aggregates = {name: reducer.result() for name, reducer in run.aggregates.items()}
+        yield {"done": True, "counts": counts, "aggregates": aggregates,
+               "seconds": time.monotonic() - began}
+
+    @staticmethod
+    def _batch(index: TreeIndex, name: str, nodes: List[Any]) -> Dict[str, Any]:
+        return {"result": name, "ids": [index.id(node) for node in nodes],
+                "names": [getattr(node, "name", None) for node in nodes]}
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+
+
+def _invalid(e: Exception) -> Iterator[Dict[str, Any]]:
+    yield {"error": f"Invalid request: {e}"}
+
+
+class _SocketHandler(socketserver.StreamRequestHandler):
+    # one request per line, each answered by one JSON message per line
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                replies = _invalid(e)
+            else:
+                replies = self.server.queries.handle(request)
+            # a failed write (the client went away) cancels the query
+            try:
+                for reply in replies:
+                    self.wfile.write(json.dumps(reply, default=repr).encode() + b"\n")
+                self.wfile.flush()
+            finally:
+                replies.close()
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    # POST a request as the body; the reply is streamed as JSON lines
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as e:
+            replies = _invalid(e)
+        else:
+            replies = self.server.queries.handle(request)
+        # a failed write (the client went away) cancels the query
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for reply in replies:
+                chunk = json.dumps(reply, default=repr).encode() + b"\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        finally:
+            replies.close()
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/trees":
+            self.send_error(404)
+            return
+        body = json.dumps({"trees": self.server.queries.registry.names()}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves a `QueryServer` on a Unix domain socket, one connection per
+    thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str, queries: QueryServer):
+        super().__init__(path, _SocketHandler)
+        self.queries = queries
+
+
+class HTTPServer(ThreadingHTTPServer):
+    """
+    Serves a `QueryServer` over HTTP on localhost: POST a request, or GET
+    /trees.
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int, queries: QueryServer, host: str = "127.0.0.1"):
+        super().__init__((host, port), _HTTPHandler)
+        self.queries = queries
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Command line entry point of `treeprog serve`.
+    """
+    parser = argparse.ArgumentParser(prog="treeprog serve",
+                                     description="Serve queries against resident trees.")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument("--socket", help="path of a Unix domain socket to listen on")
+    where.add_argument("--port", type=int, help="localhost HTTP port to listen on")
+    parser.add_argument("--tree", action="append", default=[], metavar="NAME=PATH",
+                        help="load the JSON tree at PATH as NAME (repeatable)")
+    parser.add_argument("--workers", type=int, default=4, help="number of queries run at once")
+    parser.add_argument("--max-nodes", type=int, help="default node budget of a query")
+    parser.add_argument("--max-seconds", type=float, help="default time budget of a query")
+    parser.add_argument("--root", help="directory the load op may read trees from (load is refused without)")
+    args = parser.parse_args(argv)
+
+    registry = TreeRegistry()
+    for spec in args.tree:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            parser.error(f"Invalid tree: {spec}")
+        registry.load(name, path)
+    queries = QueryServer(registry, workers=args.workers,
+                          max_nodes=args.max_nodes, max_seconds=args.max_seconds, root=args.root)
+    server = UnixSocketServer(args.socket, queries) if args.socket else HTTPServer(args.port, queries)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queries.close()
@@ -0,0 +1,317 @@
+import pickle
+from collections.abc import Mapping, Sequence
+from multiprocessing import shared_memory
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+from .index import TreeIndex
+
+# the structural arrays of a TreeIndex, all int64 and indexed by node id
+# except `level_offsets`
+ARRAYS = ("parent", "child_index", "num_children", "depth", "next_sibling", "prev_sibling",
+          "first_child", "level_order", "level_offsets", "level_pos", "subtree_size")
+
+# segments attached in this process, by segment name
+_attached: Dict[str, "SharedTree"] = {}
+
+
+class SharedTreeHandle:
+    """
+    Picklable reference to a published `SharedTree`: the name of its shared
+    memory segment and where each array lies in it. It is a few hundred
+    bytes whatever the size of the tree, so it is what gets sent to worker
+    processes.
+
+    Args:
+        segment: Name of the shared memory segment.
+        size: Number of nodes.
+        layout: Array name -> (offset, dtype, length) in the segment.
+        columns: Column name -> "numeric" or "pickled".
+    """
+    def __init__(self, segment: str, size: int, layout: Dict[str, Tuple[int, str, int]],
+                 columns: Dict[str, str]):
+        self.segment = segment
+        self.size = size
+        self.layout = layout
+        self.columns = columns
+
+    def attach(self) -> "SharedTree":
+        """
+        Returns:
+            The tree, mapped into this process without copying.
+        """
+        return SharedTree.attach(self)
+
+    def __repr__(self) -> str:
+        return f"SharedTreeHandle({self.segment!r}, {self.size} nodes)"
+
+
+class SharedTree(TreeIndex):
+    """
+    Read-only `TreeIndex` whose arrays, and the node names and payloads, live
+    in one `multiprocessing.shared_memory` segment.
+
+    `publish` copies an index into a new segment once. Any process can then
+    `attach` to it from its small `handle`, in time independent of the size
+    of the tree: the arrays are numpy views of the shared segment, and nodes
+    are `ArrayNode` views created on access. Evaluators traverse
+    `tree.root` like any other tree, and find the index through the nodes
+    instead of building one.
+
+    Numeric columns (every value of the same int or float type) are stored
+    as arrays. Other columns are pickled value by value, and a value is
+    unpickled when a node's attribute is read.
+
+    Pickling a `SharedTree` or an `ArrayNode` only pickles the handle (and
+    the node id), so results can be sent back from workers cheaply.
+
+    The publishing process owns the segment: call `close()` in every
+    process when done, and `unlink()` in the publisher to free it.
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, handle: SharedTreeHandle, owner: bool):
+        self.shm = shm
+        self.handle = handle
+        self.owner = owner
+        arrays = {}
+        for name, (offset, dtype, length) in handle.layout.items():
+            array = np.ndarray((length,), dtype=dtype, buffer=shm.buf, offset=offset)
+            array.flags.writeable = False
+            arrays[name] = array
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.columns: Dict[str, Tuple[np.ndarray, Optional[np.ndarray]]] = {
+            column: (arrays[column], arrays.get(column + ".offsets"))
+            for column in handle.columns}
+        self.nodes = _Nodes(self)
+        self.ids = _Ids(self)
+        self.root = self.nodes[0]
+
+    @classmethod
+    def publish(cls, index: TreeIndex, columns: Iterable[str] = ("name", "payload")) -> "SharedTree":
+        """
+        Copy `index` into a new shared memory segment.
+
+        Args:
+            index: Index of the tree.
+            columns: Node attributes to publish.
+
+        Returns:
+            The published tree, owned by this process.
+        """
+        n = len(index)
+        parts: Dict[str, np.ndarray] = {name: np.ascontiguousarray(getattr(index, name)) for name in ARRAYS}
+        kinds: Dict[str, str] = {}
+        for column in columns:
+            values = [getattr(node, column) for node in index.nodes]
+            numeric = _numeric(values)
+            if numeric is not None:
+                parts[column] = numeric
+                kinds[column] = "numeric"
+                continue
+            blobs = [pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL) for value in values]
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+            parts[column] = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+            parts[column + ".offsets"] = offsets
+            kinds[column] = "pickled"
+
+        layout: Dict[str, Tuple[int, str, int]] = {}
+        offset = 0
+        for name, array in parts.items():
+            offset = -(-offset // 8) * 8
+            layout[name] = (offset, array.dtype.str, len(array))
+            offset += array.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for name, array in parts.items():
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf, offset=layout[name][0])[:] = array
+
+        tree = cls(shm, SharedTreeHandle(shm.name, n, layout, kinds), owner=True)
+        _attached[shm.name] = tree
+        return tree
+
+    @classmethod
+    def attach(cls, handle: SharedTreeHandle) -> "SharedTree":
+        """
+        Args:
+            handle: Handle of a published tree.
+
+        Returns:
+            The tree. Attaching twice in one process returns the same tree.
+        """
+        tree = _attached.get(handle.segment)
+        if tree is None:
+            tree = _attached[handle.segment] = cls(_open(handle.segment), handle, owner=False)
+        return tree
+
+    def value(self, column: str, node_id: int) -> Any:
+        """
+        Args:
+            column: A published column.
+            node_id: A preorder id.
+
+        Returns:
+            The value of `column` for the node `node_id`.
+        """
+        data, offsets = self.columns[column]
+        if offsets is None:
+            return data[node_id].item()
+        return pickle.loads(data[offsets[node_id]:offsets[node_id + 1]])
+
+    def close(self) -> None:
+        """
+        Unmap the segment from this process. Nodes and arrays of the tree
+        must not be used afterwards.
+        """
+        _attached.pop(self.handle.segment, None)
+        for name in ARRAYS:
+            setattr(self, name, None)
+        self.columns = {}
+        self.shm.close()
+
+    def unlink(self) -> None:
+        """
+        Free the segment once every process has closed it. Only the
+        publisher may unlink.
+        """
+        if not self.owner:
+            raise ValueError("Only the publisher of a shared tree can unlink it")
+        self.shm.unlink()
+
+    def __enter__(self) -> "SharedTree":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+        if self.owner:
+            self.unlink()
+
+    def __reduce__(self):
+        return (SharedTree.attach, (self.handle,))
+
+
+def _open(segment: str) -> shared_memory.SharedMemory:
+    # the publisher owns the segment, so attaching must not register it with
+    # this process's resource tracker, which would unlink it on exit. Before
+    # Python 3.13 it always is; processes started by multiprocessing share
+    # the publisher's tracker, where that registration is a no-op
+    try:
+        return shared_memory.SharedMemory(name=segment, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=segment)
+
+
+def _numeric(values: List[Any]) -> Optional[np.ndarray]:
+    if not values:
+        return None
+    kind = type(values[0])
+    if kind not in (int, float) or any(type(value) is not kind for value in values):
+        return None
+    try:
+        return np.asarray(values, dtype=np.int64 if kind is int else np.float64)
+    except OverflowError:
+        return None
+
+
+class ArrayNode:
+    """
+    Node of a `SharedTree`: a view made of the tree and a node id, created
+    on access. It has the `children`, `parent`, `root`, `name` and `payload`
+    of an ordinary node; `name` and `payload` are read from the published
+    columns. It also gives its `depth` and `tree_index` (see `adapters`).
+    Two views of the same node are equal.
+    """
+    __slots__ = ("tree", "id")
+
+    def __init__(self, tree: SharedTree, id: int):
+        self.tree = tree
+        self.id = id
+
+    @property
+    def tree_index(self) -> SharedTree:
+        return self.tree
+
+    @property
+    def children(self) -> List["ArrayNode"]:
+        return [ArrayNode(self.tree, i) for i in self.tree.children_ids(self.id)]
+
+    @property
+    def parent(self) -> Optional["ArrayNode"]:
+        parent = int(self.tree.parent[self.id])
+        return ArrayNode(self.tree, parent) if parent >= 0 else None
+
+    @property
+    def root(self) -> "ArrayNode":
+        return ArrayNode(self.tree, 0)
+
+    @property
+    def depth(self) -> int:
+        return int(self.tree.depth[self.id])
+
+    @property
+    def name(self) -> Any:
+        return self.tree.value("name", self.id)
+
+    @property
+    def payload(self) -> Any:
+        return self.tree.value("payload", self.id)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, ArrayNode) and other.id == self.id and other.tree is self.tree
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __repr__(self) -> str:
+        return f"ArrayNode({self.id})"
+
+    def __reduce__(self):
+        return (_node, (self.tree.handle, self.id))
+
+
+def _node(handle: SharedTreeHandle, id: int) -> ArrayNode:
+    return ArrayNode(SharedTree.attach(handle), id)
+
+
+class _Nodes(Sequence):
+    # the node list of a SharedTree, as views
+    __slots__ = ("tree",)
+
+    def __init__(self, tree: SharedTree):
+        self.tree = tree
+
+    def __len__(self) -> int:
+        return self.tree.handle.size
+
+    def __getitem__(self, i: Any) -> Any:
+        if isinstance(i, slice):
+            return [ArrayNode(self.tree, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return ArrayNode(self.tree, int(i))
+
+    def __iter__(self) -> Iterator[ArrayNode]:
+        tree = self.tree
+        return (ArrayNode(tree, i) for i in range(len(self)))
+
+
+class _Ids(Mapping):
+    # node -> id for the nodes of a SharedTree, read off the views
+    __slots__ = ("tree",)
+
+    def __init__(self, tree: SharedTree):
+        self.tree = tree
+
+    def __getitem__(self, node: Any) -> int:
+        if isinstance(node, ArrayNode) and node.tree is self.tree:
+            return node.id
+        raise KeyError(node)
+
+    def __contains__(self, node: Any) -> bool:
+        return isinstance(node, ArrayNode) and node.tree is self.tree
+
+    def __iter__(self) -> Iterator[ArrayNode]:
+        return iter(self.tree.nodes)
+
+    def __len__(self) -> int:
+        return self.tree.handle.size
@@ -1,29 +1,84 @@
-import json
-from typing import Any, Dict, List, Callable, Set
-import AlgoTree as at
+from collections.abc import Sequence
+from typing import Any, Dict, List, Callable, Optional, Set
+from . import adapters
 from . import utils
+from . import sampling
+from . import compiler
+from . import payload_map
+from . import predicates
+from . import reducers
+from . import fold
+from . import analysis
+from . import checkpoint
+from . import cursor
+from .index import IndexCache, TreeIndex
+from .environment import Environment, Frame
+from .frontier import Frontier
+from .run import Reentrant, Run, RunState
+import numpy as np
 import random
-# import the lib for deque
-from collections import deque
-from pprint import pprint
+import time
 
-import random
+# follow directions that need no tree index; orders following any other
+# direction index the whole tree, and their frontier dedups by node id
+LOCAL_DIRS = {"up", "parent", "down", "children", "none"}
 
 def myrest(nodes, followed):
     return [n for n in nodes if n not in followed]
 
-def mysample(nodes, followed, n):
-    candidates = [node for node in nodes if node not in followed]
-    return random.sample(candidates, min(n, len(candidates)))
+def mysample(nodes, followed, n, rng=random):
+    candidates = (node for node in nodes if node not in followed)
+    return sampling.reservoir_sample(candidates, n, rng)
 
 def myslice(nodes, followed, start=0, end=-1, by=1):
     candidates = [node for node in nodes if node not in followed]
     return candidates[start:end:by]
 
-class UttEval:
-    def __init__(self, debug=False):
+class UttEval(Reentrant):
+    # per-invocation state, see `run.Reentrant`
+    rng = RunState()
+    index = RunState()
+    results = RunState()
+    binders = RunState()
+    payloads = RunState()
+    stage = RunState()
+    aggregates = RunState()
+    folds = RunState()
+    rest_dirs = RunState()
+    frontier = RunState()
+
+    def __init__(self, debug=False, seed=None):
         self.debug = debug
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.index = None
+        # indexes of the trees evaluated last, kept between runs
+        self.indexes = IndexCache()
         self.results = {}
+        # variables that may be referenced, the compiled arguments of every
+        # action of the current order, and those of the orders evaluated last
+        self.env_vars = {"$node", "$num_children", "$parent", "$root", "$depth",
+                         "$is_leaf", "$results", "$followed", "$payload", "$children"}
+        self.binders = {}
+        self.plans = compiler.BinderCache()
+        # `payload-map` functions, and the payloads they produced in the last call
+        self.payload_fns = dict(payload_map.FUNCTIONS)
+        self.payload_columns = dict(payload_map.COLUMNS)
+        self.payloads = None
+        self.stage = None
+        # `aggregate` reducers, and the reducers of the last call by result name
+        self.reducers = dict(reducers.REDUCERS)
+        self.aggregates = {}
+        # `fold` combiners, and the folded values of the last call by fold name and node
+        self.combiners = dict(fold.COMBINERS)
+        self.folds = {}
+        # follow directions whose selections are tracked for `rest`
+        self.rest_dirs = set()
+        # nodes still to evaluate in the current call; see `Frontier.stats`
+        self.frontier = None
+        # writes the state of traversals to a file, to `resume` them; None
+        # to not checkpoint
+        self.checkpoints: Optional[checkpoint.Checkpointer] = None
 
         self.pred_fns: Dict[str, Callable] = {
             "eq?": lambda x, y: x == y,
@@ -32,128 +87,280 @@ class UttEval:
             "is-leaf?": lambda node: len(node.children) == 0,
             "less?": lambda x, y: x < y,
         }
+        # order of the operands of `and`/`or` predicates
+        self.pred_order = predicates.PredicateOrder()
         self.follow_dirs: Dict[str, Callable] = {
-            "up": lambda node: [node.parent] if node.parent else [],
+            "up": lambda node: [node.parent] if node.parent is not None else [],
             "down": lambda node: node.children,
-            "sideways": lambda node: at.utils.siblings(node),
-            "ancestors": lambda node: at.utils.ancestors(node),
-            "descendants": lambda node: at.utils.descendants(node),
-            "siblings": lambda node: at.utils.siblings(node),
+            "sideways": lambda node: self._tree_index(node).siblings(node),
+            "ancestors": lambda node: self._tree_index(node).ancestors(node),
+            "descendants": lambda node: self._tree_index(node).descendants(node),
+            "siblings": lambda node: self._tree_index(node).siblings(node),
+            "next-sibling": lambda node: self._tree_index(node).next_sibling_of(node),
+            "prev-sibling": lambda node: self._tree_index(node).prev_sibling_of(node),
+            "level": lambda node: self._tree_index(node).level(node),
+            "next-in-level": lambda node: self._tree_index(node).level_neighbor(node, 1),
+            "prev-in-level": lambda node: self._tree_index(node).level_neighbor(node, -1),
             "children": lambda node: node.children,
-            "parent": lambda node: [node.parent] if node.parent else [],
-            "all": lambda node: at.utils.all_nodes(node)
+            "parent": lambda node: [node.parent] if node.parent is not None else [],
+            "all": lambda node: self._tree_index(node).all_nodes()
         }
         self.selectors: Dict[str, Callable] = {
             "all": lambda nodes, _: nodes,
             "none": lambda _, __: [],
             "rest": myrest,
-            "sample": mysample,
-            "first": lambda nodes, _: [nodes[0]],
-            "last": lambda nodes, followed: [nodes[-1]],
-            "nth": lambda nodes, followed, n: [nodes[n]],
+            "sample": lambda nodes, followed, n: mysample(nodes, followed, n, rng=self.rng),
+            "first": lambda nodes, followed: utils.nth_sel(nodes, None, followed, 0),
+            "last": lambda nodes, followed: utils.nth_sel(nodes, None, followed, -1),
+            "nth": lambda nodes, followed, n: utils.nth_sel(nodes, None, followed, n),
             "slice": myslice
         }
         self.select_orders: Dict[str, Callable] = {
             "id": lambda nodes: nodes,
-            "reverse": lambda nodes: list(reversed(nodes)),
-            "shuffle": lambda nodes: random.shuffle(nodes) or nodes,
+            "reverse": lambda nodes: list(nodes)[::-1],
+            "shuffle": lambda nodes: sampling.shuffled(nodes, self.rng),
             "sort": lambda nodes, key: sorted(nodes, key=key)
         }
 
-    def _create_env(self, node) -> Dict[str, Any]:
-        return {
+    def _create_env(self, node, scope: Frame = None) -> Environment:
+        env = Environment({
             "$node": node,
             "$num_children": len(node.children),
             "$parent": node.parent,
             "$root": node.root,
-            "$depth": at.utils.depth(node),
+            "$depth": adapters.depth(node),
             "$is_leaf": len(node.children) == 0,
             "$results": self.results,
             "$followed": [],
             "$payload": node.payload,
-            #"$siblings": at.utils.siblings(node),
+            #"$siblings": adapters.siblings(node),
             "$children": node.children,
-            #"$ancestors": at.utils.ancestors(node),
-            #"$descendants": at.utils.descendants(node)
-        }
+            #"$ancestors": adapters.ancestors(node),
+            #"$descendants": adapters.descendants(node)
+        }, scope)
+        # values folded at an ancestor are known before the node's own fold
+        for name, cache in self.folds.items():
+            if node in cache:
+                env["$fold." + name] = cache[node]
+        return env
 
 
     def eval(self, node: Any, order: List[Dict[str, Any]]) -> None:
 
         visited = set() # can only visit a node once
-        stack = deque()
-        # add the root node to the stack
-        stack.append(node)
         self.results = dict()
+        self.rng = random.Random(self.seed)
+        self.aggregates = {}
+        self.folds = {}
+        self._prepare(order)
+        indexed = analysis.follow_directions(order) - LOCAL_DIRS
+        stack = self.frontier = Frontier(self._tree_index(node) if indexed else None)
+        # add the root node to the stack, with the `set!` bindings it inherits
+        stack.push([node], None)
+        self._traverse(node, order, visited, stack)
+
+    def _prepare(self, order: List[Dict[str, Any]]) -> None:
+        self.index = None
+        self.binders = self.plans.get(order, self.env_vars)
+        self.stage = payload_map.PayloadMapStage(self.payload_fns, self.payload_columns)
+        self.rest_dirs = analysis.rest_directions(order)
+
+    def _traverse(self, start: Any, order: List[Dict[str, Any]], visited: Set[Any], stack: Frontier) -> None:
+        checkpoints = self.checkpoints
+        # nodes to evaluate before the next look at the clock; without a
+        # checkpointer it never reaches 0, so both cost the same per node
+        countdown = -1
+        if checkpoints is not None:
+            checkpoints.start()
+            countdown = checkpoint.CHECK_EVERY
 
         # while stack is not empty
         while stack:
-            # pop the node from the stack, so that it is a LIFO
-            node = stack.pop()
-            #print(f"Node: {node}")
-            env = self._create_env(node)
+            countdown -= 1
+            if countdown == 0:
+                countdown = checkpoint.CHECK_EVERY
+                if checkpoints.due():
+                    # between two nodes, the state is the frontier and what
+                    # the nodes evaluated so far produced; nodes are stored
+                    # by id
+                    started = time.monotonic()
+                    stack.use_index(self._tree_index(start))
+                    checkpoints.save(self._state(start, order, visited, stack), stack.index, started)
+            # pop the node from the stack, so that it is a LIFO; every node
+            # is pushed, and so evaluated, at most once
+            node, scope = stack.pop()
+            env = self._create_env(node, scope)
 
             for action in order:
-                action_type = next(iter(action))
-                #print(f"Action: {action}")
-                
-                if action_type == "follow":
-                    nodes = self._follow(action, env)
-                    # extend the stack with the nodes
-                    stack.extend(nodes)
-                    
-
-                elif action_type == "visit":
-                    if node in visited:
-                        continue
-                    visited.add(node)
-                    #print(f"Visited: {visited}")
-                    self._visit(action, env)
-
-                elif action_type == "cond":
-                    self._cond(action, env)
-
-                elif action_type == "payload-map":
-                    self._payload_map(action, env)
-
-                elif action_type == "set!":
-                    self._set(action, env)
+                self._act(action, env, visited, stack)
+
+        self.payloads = self.stage.run(self._tree_index(start), order) if self.stage.pending else None
+        self.stage = None
+        if checkpoints is not None:
+            checkpoints.finish()
+
+    def _act(self, action: Dict[str, Any], env: Environment, visited: Set[Any], stack: Frontier) -> None:
+        action_type = next(iter(action))
+
+        if action_type == "follow":
+            nodes = self._follow(action, env)
+            # extend the stack with the nodes not pushed before; they see the
+            # bindings made so far, not the ones made after this follow
+            frame = env.extend()
+            stack.push(nodes, frame)
+
+        elif action_type == "visit":
+            node = env['$node']
+            if node in visited:
+                return
+            visited.add(node)
+            self._visit(action, env)
+
+        elif action_type == "cond":
+            self._cond(action, env, visited, stack)
+
+        elif action_type == "payload-map":
+            self._payload_map(action, env)
+
+        elif action_type == "set!":
+            self._set(action, env)
+
+        elif action_type == "aggregate":
+            self._aggregate(action, env)
+
+        elif action_type == "fold":
+            self._fold(action, env)
+
+    def _state(self, start: Any, order: List[Dict[str, Any]], visited: Set[Any],
+               stack: Frontier) -> Dict[str, Any]:
+        # everything the rest of the traversal depends on; nodes are stored
+        # by id (see `checkpoint.dumps`), node sets as bitsets
+        index = stack.index
+        ids = index.ids
+        size = len(index)
+        frames, scopes = checkpoint.pack_frames(scope for _, scope in stack.stack)
+        positions = {id(action): i for i, action in enumerate(analysis.walk_actions(order))}
+        return {
+            "order": analysis.normalize_order(order),
+            "size": size,
+            "start": ids[start],
+            "frontier": np.fromiter((ids[node] for node, _ in stack.stack), dtype=np.int64,
+                                    count=len(stack)),
+            "scopes": scopes,
+            "frames": frames,
+            "pushed": checkpoint.pack_ids(np.flatnonzero(np.frombuffer(stack.seen, dtype=np.uint8)), size),
+            "counters": (stack.pushed, stack.duplicates, stack.popped, stack.max_size),
+            "visited": checkpoint.pack_ids((ids[node] for node in visited), size),
+            "results": {name: np.fromiter((ids[node] for node in nodes), dtype=np.int64, count=len(nodes))
+                        for name, nodes in self.results.items()},
+            "aggregates": self.aggregates,
+            "folds": self.folds,
+            "stage": [(positions[key], entry[1:]) for key, entry in self.stage.pending.items()],
+            "rng": self.rng.getstate(),
+        }
+
+    def resume(self, node: Any, order: List[Dict[str, Any]]) -> Run:
+        """
+        Finish a traversal of `order` from `node` from the last checkpoint
+        `checkpoints` wrote of it, in a new run. The run ends as the
+        uninterrupted traversal would have: same results in the same order,
+        same aggregates, folds and payloads, and the same random draws.
+        Checkpoints go on being written.
+
+        Args:
+            node: Start node of the checkpointed traversal.
+            order: Its order.
+
+        Returns:
+            The run.
+
+        Raises:
+            ValueError: If there is no checkpointer, or the checkpoint is of
+                another order, tree or start node.
+            FileNotFoundError: If there is no checkpoint.
+        """
+        if self.checkpoints is None:
+            raise ValueError("Invalid checkpoint: no checkpointer")
+        run = self._begin()
+        self._prepare(order)
+        index = self._tree_index(node)
+        state = self.checkpoints.load(index)
+        size = len(index)
+        if (state["order"] != analysis.normalize_order(order) or state["size"] != size
+                or state["start"] != index.ids[node]):
+            raise ValueError("Invalid checkpoint: it is of another traversal")
+
+        nodes = index.nodes
+        self.results = {name: [nodes[i] for i in ids] for name, ids in state["results"].items()}
+        self.aggregates = state["aggregates"]
+        self.folds = state["folds"]
+        self.rng = random.Random()
+        self.rng.setstate(state["rng"])
+        actions = list(analysis.walk_actions(order))
+        for position, (entry_nodes, args, kwargs) in state["stage"]:
+            action = actions[position]
+            self.stage.pending[id(action)] = (action, entry_nodes, args, kwargs)
+        visited = {nodes[i] for i in np.flatnonzero(checkpoint.unpack_ids(state["visited"], size))}
+
+        stack = self.frontier = Frontier(index)
+        stack.seen = bytearray(checkpoint.unpack_ids(state["pushed"], size).tobytes())
+        frames = checkpoint.unpack_frames(state["frames"])
+        stack.stack.extend((nodes[i], frames[j] if j >= 0 else None)
+                           for i, j in zip(state["frontier"].tolist(), state["scopes"].tolist()))
+        stack.pushed, stack.duplicates, stack.popped, stack.max_size = state["counters"]
+
+        self._traverse(node, order, visited, stack)
+        return run
 
     def _visit(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
-        pred = action['visit']
-        args = action.get('args', [])
-        kwargs = action.get('kwargs', {})
         result_name = action.get('result-name')
-        if self.pred_fns[pred](*[self._resolve_arg(arg, env) for arg in args],
-                               **{k: self._resolve_arg(v, env) for k, v in kwargs.items()}):
+        if self._pred(action['visit'], action, env):
             if result_name:
                 if result_name not in self.results:
-                    #print("result_name", result_name, "not in results, creating it")
                     self.results[result_name] = []
-                    #print("results", self.results)
                 self.results[result_name].append(env['$node'])
-                #print(self.results)
+
+    def _tree_index(self, node: Any) -> TreeIndex:
+        # looked up at most once per traversal, on first use, and built at
+        # most once per tree (see `invalidate`)
+        if self.index is None or node not in self.index:
+            self.index = self.indexes.get(node)
+        return self.index
 
     def _follow(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
         dir = action['follow']
         nodes = self.follow_dirs[dir](env['$node'])
         select_spec = action.get('select', 'all')
         select_order_spec = action.get('select-order', 'id')
-        sel_nodes = self._apply_select(select_spec, nodes, env)
+        sel_nodes = self._apply_select(select_spec, nodes, env, self._cursor(env, dir, nodes))
         return self._apply_select_order(select_order_spec, sel_nodes)
 
-    def _apply_select(self, select_spec: Any, nodes: List[Any], env: Dict[str, Any]) -> List[Any]:
+    def _cursor(self, env: Environment, dir: str, nodes: Any) -> Optional[cursor.Cursor]:
+        # selections are only tracked for directions some `rest` selects from
+        if dir not in self.rest_dirs or not isinstance(nodes, Sequence):
+            return None
+        if env.cursors is None:
+            env.cursors = {}
+        if dir not in env.cursors:
+            env.cursors[dir] = cursor.Cursor(nodes)
+        return env.cursors[dir]
+
+    def _apply_select(self, select_spec: Any, nodes: List[Any], env: Dict[str, Any],
+                      cur: Optional[cursor.Cursor] = None) -> List[Any]:
         if isinstance(select_spec, str):
-            return self.selectors[select_spec](nodes, env['$followed'])
+            name, args, kwargs = select_spec, [], {}
         elif isinstance(select_spec, dict):
-            selector = self.selectors[select_spec['name']]
-            args = select_spec.get('args', [])
-            kwargs = select_spec.get('kwargs', {})
-            return selector(nodes, env['$followed'], 
-                            *[self._resolve_arg(arg, env) for arg in args],
-                            **{k: self._resolve_arg(v, env) for k, v in kwargs.items()})
+            name = select_spec['name']
+            args, kwargs = self.binders[id(select_spec)](env)
         else:
             raise ValueError(f"Invalid select specification: {select_spec}")
+        if cur is None:
+            return self.selectors[name](nodes, env['$followed'], *args, **kwargs)
+        if name == 'rest':
+            return cursor.rest_sel(cur, nodes, (), env['$followed'])
+        selected = self.selectors[name](nodes, env['$followed'], *args, **kwargs)
+        cur.record(name, selected, *args, **kwargs)
+        return selected
 
     def _apply_select_order(self, select_order_spec: Any, nodes: List[Any]) -> List[Any]:
         if isinstance(select_order_spec, str):
@@ -166,21 +373,70 @@ class UttEval:
         else:
             raise ValueError(f"Invalid select-order specification: {select_order_spec}")
 
-    def _cond(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
-        pass
+    def _pred(self, pred: Any, spec: Dict[str, Any], env: Dict[str, Any]) -> bool:
+        # `spec` is the action or operand whose arguments `pred` takes
+        if predicates.is_composite(pred):
+            return self.pred_order.test(pred, lambda operand: self._pred(operand['pred'], operand, env))
+        args, kwargs = self.binders[id(spec)](env)
+        return self.pred_fns[pred](*args, **kwargs)
+
+    def _cond(self, action: Dict[str, Any], env: Environment, visited: Set[Any], stack: Frontier) -> None:
+        # cases are tested in declared order; the actions of the first that
+        # passes are carried out at the node, as if they were in its order
+        for case in action['cond']:
+            if self._pred(case['pred'], case, env):
+                for case_action in case['order']:
+                    self._act(case_action, env, visited, stack)
+                break
 
     def _payload_map(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
-        pass
+        # applied to all the nodes at once when the traversal is done
+        args, kwargs = self.binders[id(action)](env)
+        self.stage.add(action, env['$node'], args, kwargs)
 
-    def _set(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
-        for key, value in action['set!'].items():
-            env[key] = self._resolve_arg(value, env)
+    def _aggregate(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        args, by = self.binders[id(action)](env)
+        name = action['result-name']
+        reducer = self.aggregates.get(name)
+        if reducer is None:
+            reducer = self.aggregates[name] = reducers.make(action['aggregate'], self.reducers, 'by' in action)
+        value = args[0] if args else None
+        item = args[1] if len(args) > 1 else None
+        if 'by' in action:
+            reducer.add(value, item, key=by['by'])
+        else:
+            reducer.add(value, item)
 
-    def _resolve_arg(self, arg: Any, env: Dict[str, Any]) -> Any:
-        if isinstance(arg, str) and arg.startswith('$'):
-            return env.get(arg)
-        return arg
+    def _fold(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        name = action['result-name']
+        init, step = self.combiners[action['fold']]
+        binder = self.binders[id(action)]
 
-    def __call__(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        def value(node, children):
+            args, _ = binder(fold.fold_env(node, children))
+            return args[0] if args else None
+        env["$fold." + name] = fold.fold(env['$node'], init, step, value,
+                                         self.folds.setdefault(name, {}))
+
+    def _set(self, action: Dict[str, Any], env: Environment) -> None:
+        _, values = self.binders[id(action)](env)
+        for key, value in values.items():
+            env.bind(key, value)
+
+    def run(self, node: Any, order: List[Dict[str, Any]]) -> Run:
+        run = self._begin()
         self.eval(node, order)
-        return self.results
+        return run
+
+    def invalidate(self, node: Any) -> None:
+        """
+        Declare that the children of a node of the tree of `node` changed,
+        so that its index is built again.
+
+        Args:
+            node: A node of the tree that changed.
+        """
+        self.indexes.invalidate(node)
+
+    def __call__(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        return self.run(node, order).results
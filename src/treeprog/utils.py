@@ -1,4 +1,13 @@
+import heapq
 import random
+from collections import deque
+from collections.abc import Sequence
+from itertools import islice
+import numpy as np
+from . import sampling
+
+# below this many candidates heapq beats numpy's conversion overhead
+TOP_K_NUMPY_MIN = 1024
 
 def rest_sel(nodes, visited, followed):
     """
@@ -14,29 +23,76 @@ def rest_sel(nodes, visited, followed):
     """
     return [n for n in nodes if n not in followed and n not in visited]
 
-def sample_sel(nodes, visited, followed, n):
+def sample_sel(nodes, visited, followed, n, rng=random):
     """
     Sample without replacment up to `n` random nodes from the list of nodes that have not been visited or followed.
 
+    Candidates are streamed through a reservoir, so no filtered copy of
+    `nodes` is built.
+
     Args:
-        nodes: List of nodes to select from.
+        nodes: Nodes to select from (any iterable).
         visited: Set of nodes that have been visited.
         followed: Set of nodes that have been followed.
         n: Maximum number of nodes to select.   
+        rng: Random number generator to draw from (the `random` module by default).
 
     Returns:
         List of up to `n` nodes sampled from `nodes`.
     """
-    candidates = [node for node in nodes if node not in visited and node not in followed]
-    n = min(n, len(candidates))
-    return random.sample(candidates, n)
+    candidates = (node for node in nodes if node not in visited and node not in followed)
+    return sampling.reservoir_sample(candidates, n, rng)
+
+def weighted_sample_sel(nodes, visited, followed, n, weight, rng=random):
+    """
+    Sample without replacement up to `n` nodes that have not been visited or
+    followed, with probability proportional to `weight(node)`.
+
+    Args:
+        nodes: Nodes to select from (any iterable).
+        visited: Set of nodes that have been visited.
+        followed: Set of nodes that have been followed.
+        n: Maximum number of nodes to select.
+        weight: Function mapping a node to its weight.
+        rng: Random number generator to draw from (the `random` module by default).
+
+    Returns:
+        List of up to `n` nodes sampled from `nodes`.
+    """
+    candidates = (node for node in nodes if node not in visited and node not in followed)
+    return sampling.weighted_sample(candidates, n, weight, rng)
+
+def nth_sel(nodes, visited, followed, n):
+    """
+    Select the `n`-th node (counting from the end if `n` is negative), or no
+    node if there are not enough. From a lazy iterable of nodes, only the
+    first `n + 1` are consumed when `n` is not negative.
+
+    Args:
+        nodes: Nodes to select from (any iterable).
+        visited: Set of nodes that have been visited (not used).
+        followed: Set of nodes that have been followed (not used).
+        n: Position of the node.
+
+    Returns:
+        List of at most one node.
+    """
+    if isinstance(nodes, Sequence):
+        return [nodes[n]] if -len(nodes) <= n < len(nodes) else []
+    if n >= 0:
+        return list(islice(nodes, n, n + 1))
+    tail = deque(nodes, maxlen=-n)
+    return [tail[0]] if len(tail) == -n else []
 
 def slice_sel(nodes, visited, followed, start=0, end=-1, by=1):
     """
     Slice the list of nodes that have not been visited or followed.
 
+    With non-negative bounds the candidates are filtered lazily and no more
+    of `nodes` is consumed than the slice needs.
+
     Args:
-        nodes: List of nodes to select from.
+        nodes: Nodes to select from (any iterable).
         visited: Set of nodes that have been visited.
         followed: Set of nodes that have been followed.
         start: Start index of the slice.
@@ -47,5 +103,66 @@ def slice_sel(nodes, visited, followed, start=0, end=-1, by=1):
         List of nodes sliced from `nodes`.
     """
     # first, we need to filter out the nodes that have been visited or followed
+    candidates = (node for node in nodes if node not in visited and node not in followed)
+    if start >= 0 and (end is None or end >= 0) and by > 0:
+        return list(islice(candidates, start, end, by))
+    return list(candidates)[start:end:by]
+
+
+def top_k(nodes, n, key, largest=False):
+    """
+    The `n` smallest (or largest) nodes by `key`, in sorted order.
+
+    Equivalent to `sorted(nodes, key=key, reverse=largest)[:n]`, ties included,
+    but each key is computed once and only the selected nodes are sorted:
+    `heapq` for short candidate lists or non-numeric keys, a numpy partition
+    for long lists of numeric keys.
+
+    Args:
+        nodes: List of nodes to select from.
+        n: Number of nodes to select.
+        key: Function mapping a node to its sort key.
+        largest: Select the largest instead of the smallest nodes.
+
+    Returns:
+        List of up to `n` nodes.
+    """
+    n = min(n, len(nodes))
+    if n <= 0:
+        return []
+    keys = [key(node) for node in nodes]
+
+    if len(keys) >= TOP_K_NUMPY_MIN:
+        arr = np.asarray(keys)
+        if arr.ndim == 1 and arr.dtype.kind in "biuf":
+            if largest:
+                arr = -arr.astype(np.float64) if arr.dtype.kind in "bu" else -arr
+            kth = np.partition(arr, n - 1)[n - 1]
+            less = np.flatnonzero(arr < kth)
+            ties = np.flatnonzero(arr == kth)[:n - len(less)]
+            idx = np.concatenate((less, ties))
+            # order by key, then by position, as the stable sort would
+            idx = idx[np.lexsort((idx, arr[idx]))]
+            return [nodes[i] for i in idx.tolist()]
+
+    select = heapq.nlargest if largest else heapq.nsmallest
+    return [nodes[i] for i in select(n, range(len(keys)), key=keys.__getitem__)]
+
+def top_k_sel(nodes, visited, followed, n, key, largest=False):
+    """
+    Select the `n` smallest (or largest) nodes by `key` among the nodes that
+    have not been visited or followed. See `top_k`.
+
+    Args:
+        nodes: List of nodes to select from.
+        visited: Set of nodes that have been visited.
+        followed: Set of nodes that have been followed.
+        n: Number of nodes to select.
+        key: Function mapping a node to its sort key.
+        largest: Select the largest instead of the smallest nodes.
+
+    Returns:
+        List of up to `n` nodes, in sorted order.
+    """
     candidates = [node for node in nodes if node not in visited and node not in followed]
-    return candidates[start:end:by]
+    return top_k(candidates, n, key, largest)
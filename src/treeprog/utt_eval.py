@@ -1,13 +1,95 @@
-import json
-from typing import Any, Dict, List, Callable, Set
-import AlgoTree as at
+from collections.abc import Sequence
+from typing import Any, Dict, List, Callable, Optional, Set
+from . import adapters
 from . import utils
+from . import analysis
+from . import sampling
+from . import compiler
+from . import payload_map
+from . import predicates
+from . import reducers
+from . import fold
+from . import cursor
+from .index import IndexCache, TreeIndex
+from .environment import Environment, Frame
+from .run import Reentrant, Run, RunState
 import random
 from pprint import pprint
 
-class UttEval:
-    def __init__(self, debug=False):
+# variables every node environment holds
+ENV_VARS = {"$node", "$num_children", "$parent", "$root", "$depth", "$is_leaf",
+            "$order", "$results", "$visited", "$followed", "$payload",
+            "$siblings", "$children", "$ancestors", "$descendants"}
+
+# node variables that are lists of other nodes, only computed for orders that
+# read them
+NODE_LIST_VARS = {"$siblings": adapters.siblings,
+                  "$ancestors": adapters.ancestors,
+                  "$descendants": adapters.descendants}
+
+# node variables the keyed selectors (`analysis.KEYED_SELECTORS`) can order or
+# weigh candidates by, as the value each candidate would have: e.g.
+# {"name": "weighted-sample", "args": [2, "$num_children"]}
+NODE_KEY_VARS = {"$payload": lambda n: n.payload,
+                 "$depth": adapters.depth,
+                 "$num_children": lambda n: len(n.children),
+                 "$is_leaf": lambda n: len(n.children) == 0}
+
+class UttEval(Reentrant):
+    """
+    Recursive evaluator of traversal orders.
+
+    The state of a traversal lives in a `Run`, one per invocation, so one
+    evaluator can run orders from several threads at once. The attributes
+    below read the run of the calling thread.
+    """
+    rng = RunState()
+    streams = RunState()
+    sites = RunState()
+    samplers = RunState()
+    index = RunState()
+    scope = RunState()
+    binders = RunState()
+    payloads = RunState()
+    stage = RunState()
+    aggregates = RunState()
+    folds = RunState()
+    rest_dirs = RunState()
+    list_vars = RunState()
+    visited = RunState()
+    followed = RunState()
+    results = RunState()
+
+    def __init__(self, debug=False, seed=None):
         self.debug = debug
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.streams = sampling.RandomStreams(seed)
+        self.sites: Dict[int, random.Random] = {}
+        # weight key -> (index, sampler), for the `weighted-sample` direction
+        self.samplers: Dict[Any, tuple] = {}
+        self.index: Optional[TreeIndex] = None
+        # indexes of the trees evaluated last, kept between runs
+        self.indexes = IndexCache()
+        # `set!` bindings inherited by the node about to be evaluated
+        self.scope: Optional[Frame] = None
+        # variables that may be referenced, the compiled arguments of every
+        # action of the current order (see `compiler.compile_order`), and
+        # those of the orders evaluated last
+        self.env_vars: Set[str] = set(ENV_VARS)
+        self.binders: Dict[int, compiler.Binder] = {}
+        self.plans = compiler.BinderCache()
+        # payloads produced by the `payload-map` actions of the last call
+        self.payloads: Optional[payload_map.PayloadColumn] = None
+        self.stage: Optional[payload_map.PayloadMapStage] = None
+        # reducers of the `aggregate` actions of the last call, by result name
+        self.aggregates: Dict[str, reducers.Reducer] = {}
+        # folded values of the last call, by fold name and node
+        self.folds: Dict[str, Dict[Any, Any]] = {}
+        # follow directions whose selections are tracked for `rest`
+        self.rest_dirs: Set[str] = set()
+        # the `NODE_LIST_VARS` the current order reads
+        self.list_vars: List[str] = list(NODE_LIST_VARS)
         self.visited: Set[Any] = set()
         self.followed: Set[Any] = set()
         self.results: Dict[str, List[Any]] = dict()
@@ -17,7 +99,9 @@ class UttEval:
             "follow": self._follow,
             "cond": self._cond,
             "payload-map": self._payload_map,
-            "set!": self._set
+            "set!": self._set,
+            "aggregate": self._aggregate,
+            "fold": self._fold,
         }
         self.pred_fns: Dict[str, Callable] = {
             "eq?": lambda x, y: x == y,
@@ -26,25 +110,38 @@ class UttEval:
             "is-leaf?": lambda node: len(node.children) == 0,
             "less?": lambda x, y: x < y,
         }
+        # order of the operands of `and`/`or` predicates
+        self.pred_order = predicates.PredicateOrder()
         self.follow_dirs: Dict[str, Callable] = {
-            "all": lambda node: at.utils.all_nodes(node),
+            # lazy, index-backed views: selectors consume only what they need
+            "all": lambda node: self._tree_index(node).all_nodes(),
 
             "none": lambda node: [],
 
-            "up": lambda node: [node.parent] if node.parent else [],
-            "parent": lambda node: [node.parent] if node.parent else [],
+            "up": lambda node: [node.parent] if node.parent is not None else [],
+            "parent": lambda node: [node.parent] if node.parent is not None else [],
 
             "down": lambda node: node.children,
             "children": lambda node: node.children,
 
-            "sideways": lambda node: at.utils.siblings(node),
-            "siblings": lambda node: at.utils.siblings(node),
+            # sibling and level navigation through the tree index
+            "sideways": lambda node: self._tree_index(node).siblings(node),
+            "siblings": lambda node: self._tree_index(node).siblings(node),
+            "next-sibling": lambda node: self._tree_index(node).next_sibling_of(node),
+            "prev-sibling": lambda node: self._tree_index(node).prev_sibling_of(node),
+            "level": lambda node: self._tree_index(node).level(node),
+            "next-in-level": lambda node: self._tree_index(node).level_neighbor(node, 1),
+            "prev-in-level": lambda node: self._tree_index(node).level_neighbor(node, -1),
 
-            "ancestors": lambda node: at.utils.ancestors(node),
-            
-            "descendants": lambda node: at.utils.descendants(node),
+            "ancestors": lambda node: self._tree_index(node).ancestors(node),
 
-            "sample": lambda node, k: random.sample(at.utils.all_nodes(node), k)
+            "descendants": lambda node: self._tree_index(node).descendants(node),
+
+            # k uniformly random nodes of the whole tree
+            "sample": lambda node, k: sampling.sample_nodes(self._tree_index(node), k, self.rng),
+            # k nodes of the whole tree drawn with replacement, with
+            # probability proportional to their weight by `key`
+            "weighted-sample": lambda node, k, key: self._node_sampler(node, key).sample(k, self.rng),
         }
 
         # lambda nodes, visited, followed: expression
@@ -52,44 +149,77 @@ class UttEval:
             "all": lambda nodes, _, __: nodes,
             "none": lambda _, __, ___: [],
             "rest": utils.rest_sel,
-            "sample": utils.sample_sel,
-            "first": lambda nodes, _, __: [nodes[0]],
-            "last": lambda nodes, _, __: [nodes[-1]],
-            "nth": lambda nodes, visited, followed, n: [nodes[n]],
-            "slice": utils.slice_sel
+            "sample": lambda nodes, visited, followed, n: utils.sample_sel(
+                nodes, visited, followed, n, rng=self.rng),
+            "rand": lambda nodes, visited, followed: utils.sample_sel(
+                nodes, visited, followed, 1, rng=self.rng),
+            "weighted-sample": lambda nodes, visited, followed, n, key: utils.weighted_sample_sel(
+                nodes, visited, followed, n, self._weight(key), rng=self.rng),
+            "first": lambda nodes, visited, followed: utils.nth_sel(nodes, visited, followed, 0),
+            "last": lambda nodes, visited, followed: utils.nth_sel(nodes, visited, followed, -1),
+            "nth": utils.nth_sel,
+            "slice": utils.slice_sel,
+            # ordering fused with a limit: the n smallest/largest nodes by one
+            # of the `sort_keys`, without sorting all of them
+            "smallest": lambda nodes, visited, followed, n, key: utils.top_k_sel(
+                nodes, visited, followed, n, self._sort_key(key)),
+            "largest": lambda nodes, visited, followed, n, key: utils.top_k_sel(
+                nodes, visited, followed, n, self._sort_key(key), largest=True),
+        }
+        # map functions for `payload-map`, and their columnar forms
+        self.payload_fns: Dict[str, Callable] = dict(payload_map.FUNCTIONS)
+        self.payload_columns: Dict[str, Callable] = dict(payload_map.COLUMNS)
+        # reducer name -> factory, for `aggregate`
+        self.reducers: Dict[str, Callable] = dict(reducers.REDUCERS)
+        # combiner name -> (init, step), for `fold`
+        self.combiners: Dict[str, tuple] = dict(fold.COMBINERS)
+        # node -> sort key, for the sorting select-orders and `smallest`/`largest`
+        self.sort_keys: Dict[str, Callable] = {
+            "payload": lambda n: n.payload,
+            "name": lambda n: n.name,
+            "depth": lambda n: adapters.depth(n),
+            "num_children": lambda n: len(n.children),
+            "num_descendants": lambda n: len(adapters.descendants(n)),
+            "num_ancestors": lambda n: len(adapters.ancestors(n)),
+            "num_siblings": lambda n: len(adapters.siblings(n)),
         }
         self.select_orders: Dict[str, Callable] = {
             "id": lambda nodes: nodes,
-            "reverse": lambda nodes: list(reversed(nodes)),
-            "shuffle": lambda nodes: random.shuffle(nodes) or nodes,
+            "reverse": lambda nodes: list(nodes)[::-1],
+            "shuffle": lambda nodes: sampling.shuffled(nodes, self.rng),
             "sort": lambda nodes, key: sorted(nodes, key=key),
-            "payload": lambda nodes: sorted(nodes, key=lambda n: n.payload),
-            "name": lambda nodes: sorted(nodes, key=lambda n: n.name),
-            "depth": lambda nodes: sorted(nodes, key=lambda n: at.utils.depth(n)),
-            "num_children": lambda nodes: sorted(nodes, key=lambda n: len(n.children)),
-            "num_descendants": lambda nodes: sorted(nodes, key=lambda n: len(at.utils.descendants(n))),
-            "num_ancestors": lambda nodes: sorted(nodes, key=lambda n: len(at.utils.ancestors(n))),
-            "num_siblings": lambda nodes: sorted(nodes, key=lambda n: len(at.utils.siblings(n))),
-        }   
+        }
+        for name in self.sort_keys:
+            self.select_orders[name] = lambda nodes, name=name: sorted(nodes, key=self.sort_keys[name])
 
-    def eval(self, node: Any, order: List[Dict[str, Any]], visited: Set[Any], followed: Set[Any]) -> None:
-        env = {
+    def _create_env(self, node: Any, order: List[Dict[str, Any]], visited: Set[Any], followed: Set[Any]) -> Environment:
+        env = Environment({
             "$node": node,
             "$num_children": len(node.children),
             "$parent": node.parent,
             "$root": node.root,
-            "$depth": at.utils.depth(node),
+            "$depth": adapters.depth(node),
             "$is_leaf": len(node.children) == 0,
             "$order": order,
             "$results": self.results,
             "$visited": visited,
             "$followed": followed,
             "$payload": node.payload,
-            "$siblings": at.utils.siblings(node),
             "$children": node.children,
-            "$ancestors": at.utils.ancestors(node),
-            "$descendants": at.utils.descendants(node)
-        }
+        }, self.scope)
+        for name in self.list_vars:
+            env[name] = NODE_LIST_VARS[name](node)
+        self._add_folds(node, env)
+        return env
+
+    def _add_folds(self, node: Any, env: Dict[str, Any]) -> None:
+        # values folded at an ancestor are known before the node's own fold
+        for name, cache in self.folds.items():
+            if node in cache:
+                env["$fold." + name] = cache[node]
+
+    def eval(self, node: Any, order: List[Dict[str, Any]], visited: Set[Any], followed: Set[Any]) -> None:
+        env = self._create_env(node, order, visited, followed)
 
         if self.debug:
             print(f"Node: {node}")
@@ -115,44 +245,110 @@ class UttEval:
         if node in env['$visited']:
             return
         env['$visited'].add(node)
-        pred = action['visit']
-        args = action.get('args', [])
-        kwargs = action.get('kwargs', {})
         result_name = action.get('result-name')
-        if self.pred_fns[pred](*[self._resolve_arg(arg, env) for arg in args],
-                               **{k: self._resolve_arg(v, env) for k, v in kwargs.items()}):
+        if self._pred(action['visit'], action, env):
             if result_name:
-                if result_name not in self.results:
-                    self.results[result_name] = []
-                self.results[result_name].append(node)
+                self._emit(result_name, node)
+
+    def _pred(self, pred: Any, spec: Dict[str, Any], env: Dict[str, Any]) -> bool:
+        # `spec` is the action, case or operand whose arguments `pred` takes
+        if predicates.is_composite(pred):
+            return self.pred_order.test(pred, lambda operand: self._pred(operand['pred'], operand, env))
+        args, kwargs = self.binders[id(spec)](env)
+        return self.pred_fns[pred](*args, **kwargs)
+
+    def _emit(self, result_name: str, node: Any) -> None:
+        if result_name not in self.results:
+            self.results[result_name] = []
+        self.results[result_name].append(node)
+
+    def _tree_index(self, node: Any) -> TreeIndex:
+        # looked up at most once per traversal, on first use, and built at
+        # most once per tree (see `invalidate`)
+        if self.index is None or node not in self.index:
+            self.index = self.indexes.get(node)
+        return self.index
+
+    def _sort_key(self, key: str) -> Callable:
+        if key in self.sort_keys:
+            return self.sort_keys[key]
+        if key in NODE_KEY_VARS:
+            return NODE_KEY_VARS[key]
+        raise ValueError(f"Invalid sort key: {key}")
+
+    def _weight(self, key: str) -> Callable:
+        # a sort key, a node variable or else a key of the payloads
+        if key in self.sort_keys or key in NODE_KEY_VARS:
+            return self._sort_key(key)
+        return lambda n: n.payload[key]
+
+    def _node_sampler(self, node: Any, key: str) -> sampling.WeightedNodeSampler:
+        # built once per tree and key in a traversal
+        index = self._tree_index(node)
+        cached = self.samplers.get(key)
+        if cached is None or cached[0] is not index:
+            cached = self.samplers[key] = (index, sampling.WeightedNodeSampler(index, self._weight(key)))
+        return cached[1]
+
+    def _site_rng(self, action: Dict[str, Any], order: List[Dict[str, Any]]) -> random.Random:
+        # one random stream per follow action, so draws at one site do not
+        # shift the draws at another; streams are named by the position of
+        # the action in the order, so identical actions draw independently
+        rng = self.sites.get(id(action))
+        if rng is None:
+            for i, site in enumerate(analysis.walk_actions(order)):
+                if "follow" in site and id(site) not in self.sites:
+                    self.sites[id(site)] = self.streams.get(f"follow {i}")
+            rng = self.sites[id(action)]
+        return rng
 
     def _follow(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
         dir = action['follow']
-        nodes = self.follow_dirs[dir](env['$node'])
+        self.rng = self._site_rng(action, env['$order'])
+        args, kwargs = self.binders[id(action)](env)
+        nodes = self.follow_dirs[dir](env['$node'], *args, **kwargs)
         
         select_spec = action.get('select', 'all')
         select_order_spec = action.get('select-order', 'id')
         
-        sel_nodes = self._apply_select(select_spec, nodes, env)
+        sel_nodes = self._apply_select(select_spec, nodes, env, self._cursor(env, dir, nodes, args, kwargs))
         ordered_nodes = self._apply_select_order(select_order_spec, sel_nodes)
         
+        scope = env.extend()
         for node in ordered_nodes:
             if node not in env['$followed']:
                 env['$followed'].add(node)
+                self.scope = scope
                 self.eval(node, env['$order'], env['$visited'], env['$followed'])
 
-    def _apply_select(self, select_spec: Any, nodes: List[Any], env: Dict[str, Any]) -> List[Any]:
+    def _cursor(self, env: Environment, dir: str, nodes: Any, args: List[Any],
+                kwargs: Dict[str, Any]) -> Optional[cursor.Cursor]:
+        # selections are only tracked for directions some `rest` selects
+        # from, and only when they give the same candidates every time
+        if dir not in self.rest_dirs or args or kwargs or not isinstance(nodes, Sequence):
+            return None
+        if env.cursors is None:
+            env.cursors = {}
+        if dir not in env.cursors:
+            env.cursors[dir] = cursor.Cursor(nodes)
+        return env.cursors[dir]
+
+    def _apply_select(self, select_spec: Any, nodes: List[Any], env: Dict[str, Any],
+                      cur: Optional[cursor.Cursor] = None) -> List[Any]:
         if isinstance(select_spec, str):
-            return self.selectors[select_spec](nodes, env['$visited'], env['$followed'])
+            name, args, kwargs = select_spec, [], {}
         elif isinstance(select_spec, dict):
-            selector = self.selectors[select_spec['name']]
-            args = select_spec.get('args', [])
-            kwargs = select_spec.get('kwargs', {})
-            return selector(nodes, env['$visited'], env['$followed'], 
-                            *[self._resolve_arg(arg, env) for arg in args],
-                            **{k: self._resolve_arg(v, env) for k, v in kwargs.items()})
+            name = select_spec['name']
+            args, kwargs = self.binders[id(select_spec)](env)
         else:
             raise ValueError(f"Invalid select specification: {select_spec}")
+        if cur is None:
+            return self.selectors[name](nodes, env['$visited'], env['$followed'], *args, **kwargs)
+        if name == 'rest':
+            return cursor.rest_sel(cur, nodes, env['$visited'], env['$followed'])
+        selected = self.selectors[name](nodes, env['$visited'], env['$followed'], *args, **kwargs)
+        cur.record(name, selected, *args, **kwargs)
+        return selected
 
     def _apply_select_order(self, select_order_spec: Any, nodes: List[Any]) -> List[Any]:
         if isinstance(select_order_spec, str):
@@ -168,18 +364,14 @@ class UttEval:
     def _cond(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
         for case in action['cond']:
             pred = case['pred']
-            args = case.get('args', [])
-            kwargs = case.get('kwargs', {})
-
-            some_args = [self._resolve_arg(arg, env) for arg in args]
-            some_kwargs = {k: self._resolve_arg(v, env) for k, v in kwargs.items()}
 
             if self.debug:
+                args = case.get('args', [])
+                kwargs = case.get('kwargs', {})
                 print(f"args: {args}")
-                print(f"resolved args: {some_args}")
+                print(f"resolved args: {self.binders[id(case)](env)}")
                 print(f"kwargs: {kwargs}")
-                print(f"resolved Kwargs: {some_kwargs}")
-            if self.pred_fns[pred](*some_args, **some_kwargs):
+            if self._pred(pred, case, env):
                 if self.debug:
                     print(f"Pred: {pred} passed")
                     print(f"Processnig order for case: {case['order']}")
@@ -192,21 +384,93 @@ class UttEval:
                 break
 
     def _payload_map(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
-        # Implement payload mapping logic here
-        pass
+        # applied to all the nodes at once when the traversal is done
+        args, kwargs = self.binders[id(action)](env)
+        self.stage.add(action, env['$node'], args, kwargs)
+
+    def _aggregate(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        args, by = self.binders[id(action)](env)
+        name = action['result-name']
+        reducer = self.aggregates.get(name)
+        if reducer is None:
+            reducer = self.aggregates[name] = reducers.make(action['aggregate'], self.reducers, 'by' in action)
+        value = args[0] if args else None
+        item = args[1] if len(args) > 1 else None
+        if 'by' in action:
+            reducer.add(value, item, key=by['by'])
+        else:
+            reducer.add(value, item)
+
+    def _fold(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
+        name = action['result-name']
+        init, step = self.combiners[action['fold']]
+        env["$fold." + name] = fold.fold(env['$node'], init, step, self._fold_value(action),
+                                         self.folds.setdefault(name, {}))
+
+    def _fold_value(self, action: Dict[str, Any]) -> Callable:
+        binder = self.binders[id(action)]
 
-    def _set(self, action: Dict[str, Any], env: Dict[str, Any]) -> None:
-        for key, value in action['set!'].items():
-            env[key] = self._resolve_arg(value, env)
+        def value(node, children):
+            args, _ = binder(fold.fold_env(node, children))
+            return args[0] if args else None
+        return value
 
-    def _resolve_arg(self, arg: Any, env: Dict[str, Any]) -> Any:
-        if isinstance(arg, str) and arg.startswith('$'):
-            return env.get(arg)
-        return arg
+    def _set(self, action: Dict[str, Any], env: Environment) -> None:
+        _, values = self.binders[id(action)](env)
+        for key, value in values.items():
+            env.bind(key, value)
+
+    def run(self, node: Any, order: List[Dict[str, Any]]) -> Run:
+        """
+        Evaluate `order` from `node` in a new run.
+
+        Args:
+            node: Start node.
+            order: A traversal order.
+
+        Returns:
+            The run, with its `results`, `payloads`, `aggregates` and `folds`.
+        """
+        run = self._begin()
+        self._evaluate(node, order)
+        return run
+
+    def invalidate(self, node: Any) -> None:
+        """
+        Declare that the children of a node of the tree of `node` changed,
+        so that its index is built again.
+
+        Args:
+            node: A node of the tree that changed.
+        """
+        self.indexes.invalidate(node)
 
     def __call__(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        return self.run(node, order).results
+
+    def _evaluate(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
         self.results = {}
+        self.streams = sampling.RandomStreams(self.seed)
+        self.rng = self.streams.get("")
+        self.sites = {}
+        self.samplers = {}
+        self.index = None
+        self.scope = None
+        self.binders = self._compile(order)
+        self.stage = payload_map.PayloadMapStage(self.payload_fns, self.payload_columns)
+        self.aggregates = {}
+        self.folds = {}
+        self.rest_dirs = analysis.rest_directions(order)
+        self.list_vars = [name for name in NODE_LIST_VARS if name in analysis.env_vars(order)]
         visited = set()
         followed = set()
         self.eval(node, order, visited, followed)
-        return self.results
\ No newline at end of file
+        self._run_stage(node, order)
+        return self.results
+
+    def _compile(self, order: List[Dict[str, Any]]) -> Dict[int, compiler.Binder]:
+        return self.plans.get(order, self.env_vars)
+
+    def _run_stage(self, node: Any, order: List[Dict[str, Any]]) -> None:
+        self.payloads = self.stage.run(self._tree_index(node), order) if self.stage.pending else None
+        self.stage = None
\ No newline at end of file
@@ -2,8 +2,13 @@ import json
 from typing import Any, Dict, List, Callable, Set
 import AlgoTree as at
 import random
+from .run import Reentrant, RunState
+
+class UttEval(Reentrant):
+    visited = RunState()
+    followed = RunState()
+    results = RunState()
 
-class UttEval:
     def __init__(self, debug=False):
         self.debug = debug
         self.visited: Set[Any] = set()
@@ -93,10 +98,11 @@ class UttEval:
 
     def _resolve_arg(self, arg: Any, env: Dict[str, Any]) -> Any:
         if isinstance(arg, str) and arg.startswith('$'):
-            return env.get(arg[1:])
+            return env.get(arg)
         return arg
 
     def __call__(self, node: Any, order: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        self._begin()
         self.results = {}
         visited = set()
         followed = set()
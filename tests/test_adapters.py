@@ -0,0 +1,89 @@
+import xml.etree.ElementTree as ET
+import AlgoTree as at
+import pytest
+from treeprog import treeprog
+from treeprog.adapters import FileNode, JsonNode, XmlNode
+from treeprog.utt_eval import UttEval
+
+DATA = {"a": {"x": 1, "y": [2, 3, {"z": 4}]}, "b": 5, "c": {"d": {"e": [6, 7]}, "f": 8}}
+
+XML = '<r v="0"><a v="1"><c v="2"/><c v="3"/></a><b v="1"><d v="2"><e v="3"/></d></b><f v="1"/></r>'
+
+ORDERS = [
+    [{"cond": [{"pred": "is-leaf?", "args": ["$node"], "order": [{"visit": "true", "result-name": "leaf"}]},
+               {"pred": "eq?", "args": ["$depth", 1], "order": [{"visit": "true", "result-name": "top"}]}]},
+     {"visit": "eq?", "args": ["$num_children", 2], "result-name": "pair"},
+     {"follow": "down", "select-order": "reverse"}],
+    [{"visit": "true", "result-name": "x"},
+     {"follow": "descendants", "select": {"name": "slice", "args": [1, 3]}},
+     {"follow": "level"}, {"follow": "up"}],
+    [{"set!": {"$n": "$children"}},
+     {"visit": "eq?", "args": ["$parent", None], "result-name": "root"},
+     {"follow": "down", "select": "first"}, {"follow": "next-sibling"}],
+]
+
+
+def path(node):
+    names = []
+    while node is not None:
+        names.append(str(node.name))
+        node = node.parent
+    return "/".join(reversed(names[:-1]))
+
+
+def paths(results):
+    return {name: [path(node) for node in nodes] for name, nodes in results.items()}
+
+
+def mirror(node, parent=None):
+    # the same tree as AlgoTree nodes
+    copy = at.TreeNode(name=node.name, parent=parent, payload=None)
+    for child in node.children:
+        mirror(child, copy)
+    return copy
+
+
+def json_tree(tmp_path):
+    return JsonNode.tree(DATA)
+
+
+def record_tree(tmp_path):
+    records = {"name": "r", "payload": 0, "children": [
+        {"name": "a", "payload": 1, "children": [{"name": "b", "payload": 2}, {"name": "c", "payload": 3}]},
+        {"name": "d", "payload": 4}]}
+    return JsonNode.tree(records, children_key="children")
+
+
+def xml_tree(tmp_path):
+    return XmlNode.tree(ET.ElementTree(ET.fromstring(XML)))
+
+
+def file_tree(tmp_path):
+    for name in ["a/x", "a/y/z", "b", "c/d/e/f", "c/g"]:
+        target = tmp_path / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(name)
+    return FileNode.tree(str(tmp_path))
+
+
+@pytest.mark.parametrize("order", ORDERS)
+@pytest.mark.parametrize("make", [json_tree, record_tree, xml_tree, file_tree])
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_adapters_match_converted_trees(evaluator, make, order, tmp_path):
+    view = make(tmp_path)
+    converted = mirror(view)
+    got, expected = paths(evaluator()(view, order)), paths(evaluator()(converted, order))
+    assert got == expected and got
+
+
+def test_payloads(tmp_path):
+    tree = json_tree(tmp_path)
+    order = [{"cond": [{"pred": "eq?", "args": ["$payload", [6, 7]], "order": [{"visit": "true", "result-name": "list"}]},
+                       {"pred": "eq?", "args": ["$payload", 2], "order": [{"visit": "true", "result-name": "two"}]}]},
+             {"follow": "descendants"}]
+    assert paths(UttEval()(tree, order)) == {"list": ["c/d/e"], "two": ["a/y/0"]}
+    order = [{"visit": "eq?", "args": ["$payload", {"v": "2"}], "result-name": "v2"}, {"follow": "down"}]
+    assert paths(UttEval()(xml_tree(tmp_path), order)) == {"v2": ["a/c", "b/d"]}
+    root = file_tree(tmp_path)
+    sizes = {path(node): node.payload["size"] for node in root.children[0].children}
+    assert sizes == {"a/x": 3, "a/y": sizes["a/y"]} and root.children[0].payload["is_dir"]
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import AlgoTree as at
+import pytest
+from treeprog.async_eval import AsyncUttEval, SqliteTree
+from treeprog.utt_eval import UttEval
+
+
+def payloads(results):
+    return {name: [node.payload for node in nodes] for name, nodes in results.items()}
+
+
+def grown(depth=4, width=3):
+    root = at.TreeNode(name="0", payload=0)
+    stack = [(root, 0)]
+    count = 1
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for _ in range(width):
+                child = at.TreeNode(name=str(count), parent=node, payload=count)
+                count += 1
+                stack.append((child, d + 1))
+    return root
+
+
+ORDERS = [
+    [{"visit": "true", "result-name": "pre"},
+     {"follow": "down"},
+     {"visit": "is-leaf?", "args": ["$node"], "result-name": "leaves"}],
+    [{"visit": "true", "result-name": "pre"},
+     {"follow": "down", "select": "first"},
+     {"follow": "down", "select-order": "reverse"}],
+    [{"cond": [{"pred": "less?", "args": ["$depth", 2], "order": [{"visit": "true", "result-name": "shallow"}]},
+               {"pred": "true", "order": [{"visit": "true", "result-name": "deep"}]}]},
+     {"follow": "children", "select": {"name": "sample", "args": [2]}}],
+]
+
+
+@pytest.mark.parametrize("order", ORDERS)
+def test_sqlite_tree_matches_in_memory_tree(order):
+    root = grown()
+    expected = payloads(UttEval(seed=5)(root, order))
+    lazy = SqliteTree.from_tree(root).root()
+    assert payloads(asyncio.run(AsyncUttEval(seed=5)(lazy, order))) == expected
+    assert payloads(asyncio.run(AsyncUttEval(seed=5)(root, order))) == expected
+
+
+def test_in_memory_tree_keeps_every_direction():
+    root = grown(3, 2)
+    order = [{"visit": "true", "result-name": "pre"},
+             {"follow": "siblings"},
+             {"follow": "down"}]
+    assert payloads(asyncio.run(AsyncUttEval()(root, order))) == payloads(UttEval()(root, order))
+
+
+def test_lazy_tree_rejects_index_directions():
+    lazy = SqliteTree.from_tree(grown(2, 2)).root()
+    with pytest.raises(ValueError):
+        asyncio.run(AsyncUttEval()(lazy, [{"follow": "descendants"}]))
+
+
+def test_fetches_in_flight_stay_within_concurrency():
+    tree = SqliteTree.from_tree(grown(4, 4), latency=0.002)
+    lock = threading.Lock()
+    in_flight = peak = 0
+    child_rows = tree.child_rows
+
+    def counted(id):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        try:
+            return child_rows(id)
+        finally:
+            with lock:
+                in_flight -= 1
+
+    tree.child_rows = counted
+    evaluator = AsyncUttEval(concurrency=3)
+    results = asyncio.run(evaluator(tree.root(), ORDERS[0]))
+    assert len(results["pre"]) == 1 + 4 + 16 + 64 + 256
+    assert 1 < peak <= 3
+
+
+def test_prefetch_follows_selection():
+    tree = SqliteTree.from_tree(grown(3, 4))
+    fetched = []
+    child_rows = tree.child_rows
+    tree.child_rows = lambda id: fetched.append(id) or child_rows(id)
+    order = [{"visit": "true", "result-name": "pre"}, {"follow": "down", "select": "first"}]
+    results = asyncio.run(AsyncUttEval()(tree.root(), order))
+    assert len(results["pre"]) == 4
+    assert len(fetched) == 4
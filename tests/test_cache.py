@@ -0,0 +1,132 @@
+import dataclasses
+import os
+import AlgoTree as at
+import pytest
+from treeprog.adapters import FileNode
+from treeprog.cache import CachedUttEval, ResultCache
+from treeprog.hashing import payload_digest
+from treeprog.utt_eval import UttEval
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+def tree():
+    root = at.TreeNode(name="r", payload=0)
+    for i in range(3):
+        sub = at.TreeNode(name=f"s{i}", parent=root, payload=i)
+        for j in range(3):
+            at.TreeNode(name=f"s{i}.{j}", parent=sub, payload=j)
+    return root
+
+
+ORDER = [{"visit": "true", "result-name": "pre"},
+         {"follow": "down", "select-order": "name"}]
+
+
+def cached(tmp_path, evaluator=None, **kwargs):
+    return CachedUttEval(evaluator or UttEval(), ResultCache(str(tmp_path), **kwargs))
+
+
+def test_hit_and_miss(tmp_path):
+    root = tree()
+    evaluator = cached(tmp_path)
+    first = names(evaluator(root, ORDER))
+    assert first == names(UttEval()(root, ORDER))
+    assert names(evaluator(root, ORDER)) == first
+    assert (evaluator.hits, evaluator.misses) == (1, 1)
+    evaluator(root, [{"visit": "true", "result-name": "pre"}, {"follow": "down", "select-order": "reverse"}])
+    assert (evaluator.hits, evaluator.misses) == (1, 2)
+
+
+def test_rename_and_invalidate(tmp_path):
+    root = tree()
+    evaluator = cached(tmp_path)
+    evaluator(root, ORDER)
+    node = root.children[0]
+    node.name = "z"
+    evaluator.invalidate(node)
+    assert names(evaluator(root, ORDER)) == names(UttEval()(root, ORDER))
+    assert evaluator.misses == 2
+
+
+def test_evaluator_functions_are_keyed(tmp_path):
+    root = tree()
+    order = [{"visit": "true", "result-name": "pre"},
+             {"follow": "down", "select-order": "payload"}]
+    plain = cached(tmp_path)
+    custom = cached(tmp_path)
+    custom.evaluator.sort_keys["payload"] = lambda node: -node.payload
+    custom.evaluator.select_orders["payload"] = lambda nodes: sorted(nodes, key=lambda node: -node.payload)
+    assert plain.key(root, order) != custom.key(root, order)
+    plain(root, order)
+    assert names(custom(root, order)) == names(custom.evaluator(root, order))
+    assert custom.hits == 0
+
+
+def test_aggregates_are_not_cached(tmp_path):
+    root = tree()
+    order = [{"aggregate": "count", "args": ["$node"], "result-name": "n"},
+             {"follow": "down"}]
+    evaluator = cached(tmp_path)
+    assert not evaluator.cacheable(order)
+    assert evaluator.cacheable(ORDER)
+
+
+def test_eviction(tmp_path):
+    root = tree()
+    evaluator = cached(tmp_path)
+    evaluator(root, ORDER)
+    size = sum(entry.stat().st_size for entry in os.scandir(tmp_path))
+    evaluator.cache.max_bytes = size
+    for node in root.children:
+        evaluator(node, ORDER)
+    assert len(os.listdir(tmp_path)) == 1
+    evaluator(root.children[-1], ORDER)
+    assert evaluator.hits == 1
+
+
+def test_changed_file_misses(tmp_path):
+    directory = tmp_path / "tree"
+    directory.mkdir()
+    (directory / "a").write_text("x")
+    (directory / "b").write_text("xxxxxx")
+    (tmp_path / "cache").mkdir()
+    evaluator = cached(tmp_path / "cache")
+    evaluator.evaluator.pred_fns["big?"] = lambda stat: not stat["is_dir"] and stat["size"] > 3
+    order = [{"visit": "big?", "args": ["$payload"], "result-name": "big"}, {"follow": "down"}]
+    assert names(evaluator(FileNode.tree(str(directory)), order)) == {"big": ["b"]}
+    # same paths, so the same repr of every payload
+    (directory / "a").write_text("xxxxxxxx")
+    root = FileNode.tree(str(directory))
+    evaluator.invalidate(root.children[0])
+    assert names(evaluator(root, order)) == {"big": ["a", "b"]}
+    assert (evaluator.hits, evaluator.misses) == (0, 2)
+
+
+@dataclasses.dataclass(frozen=True)
+class Stat:
+    size: int
+
+    def __repr__(self):
+        return "Stat"
+
+
+class Opaque:
+    __slots__ = ("size",)
+
+    def __init__(self, size):
+        self.size = size
+
+    def __repr__(self):
+        return "Opaque"
+
+    def __digest__(self):
+        return self.size
+
+
+@pytest.mark.parametrize("make", [Stat, Opaque, lambda size: {Stat(size)}, lambda size: {"s": [Stat(size)]}])
+def test_payload_content_is_hashed(make):
+    assert payload_digest(make(1)) == payload_digest(make(1))
+    assert payload_digest(make(1)) != payload_digest(make(2))
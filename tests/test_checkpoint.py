@@ -0,0 +1,112 @@
+import os
+import AlgoTree as at
+import pytest
+from treeprog import checkpoint, reducers, treeprog
+from treeprog.checkpoint import Checkpointer
+
+
+class Crash(Exception):
+    pass
+
+
+def grown(depth=7, width=4):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+ORDER = [{"set!": {"$p": "$payload"}},
+         {"visit": "less?", "args": ["$p", 2], "result-name": "x"},
+         {"cond": [{"pred": "is-leaf?", "args": ["$node"], "order": [{"visit": "true", "result-name": "leaves"}]}]},
+         {"aggregate": {"name": "top-k", "args": [3]}, "args": ["$payload", "$node"], "result-name": "top"},
+         {"aggregate": "count", "by": "$depth", "result-name": "per"},
+         {"fold": "sum", "args": ["$payload"], "result-name": "total"},
+         {"payload-map": "num-children"},
+         {"follow": "down", "select": {"name": "sample", "args": [3]}},
+         {"follow": "sideways", "select": "first", "select-order": "shuffle"}]
+
+
+def crashing(path, after):
+    evaluator = treeprog.UttEval(seed=7)
+    evaluator.checkpoints = Checkpointer(path, interval=0, max_overhead=1e9)
+    less = evaluator.pred_fns["less?"]
+    calls = [0]
+
+    def crash(x, y):
+        calls[0] += 1
+        if calls[0] == after:
+            raise Crash
+        return less(x, y)
+    evaluator.pred_fns["less?"] = crash
+    return evaluator, less
+
+
+def test_resume_after_crash(tmp_path):
+    tree = grown()
+    expected = treeprog.UttEval(seed=7).run(tree, ORDER)
+    path = str(tmp_path / "run.ckpt")
+
+    evaluator, less = crashing(path, 5000)
+    with pytest.raises(Crash):
+        evaluator(tree, ORDER)
+    assert evaluator.checkpoints.saved >= 2 and os.path.exists(path)
+
+    evaluator.pred_fns["less?"] = less
+    run = evaluator.resume(tree, ORDER)
+    assert names(run.results) == names(expected.results)
+    got, want = reducers.results(run.aggregates), reducers.results(expected.aggregates)
+    assert got["per"] == want["per"]
+    assert [node.name for node in got["top"]] == [node.name for node in want["top"]]
+    assert ({node.name: value for node, value in run.folds["total"].items()}
+            == {node.name: value for node, value in expected.folds["total"].items()})
+    assert dict(run.payloads) == dict(expected.payloads)
+    # the resumed run drew the same random numbers
+    assert run.rng.getstate() == expected.rng.getstate()
+    assert not os.path.exists(path)
+
+
+def test_resume_without_checkpoint(tmp_path):
+    evaluator = treeprog.UttEval(seed=7)
+    with pytest.raises(ValueError):
+        evaluator.resume(grown(2), ORDER)
+    evaluator.checkpoints = Checkpointer(str(tmp_path / "run.ckpt"))
+    with pytest.raises(FileNotFoundError):
+        evaluator.resume(grown(2), ORDER)
+
+
+def test_resume_another_traversal(tmp_path):
+    tree = grown()
+    evaluator, _ = crashing(str(tmp_path / "run.ckpt"), 5000)
+    with pytest.raises(Crash):
+        evaluator(tree, ORDER)
+    with pytest.raises(ValueError):
+        evaluator.resume(tree, ORDER[:3])
+    with pytest.raises(ValueError):
+        evaluator.resume(tree.children[0], ORDER)
+
+
+def test_default_interval_looks_at_the_clock_rarely(tmp_path, monkeypatch):
+    tree = grown()
+    order = [{"visit": "true", "result-name": "x"}, {"follow": "down"}]
+    looks = [0]
+    due = Checkpointer.due
+
+    def counted(self):
+        looks[0] += 1
+        return due(self)
+    monkeypatch.setattr(Checkpointer, "due", counted)
+    evaluator = treeprog.UttEval()
+    evaluator.checkpoints = Checkpointer(str(tmp_path / "run.ckpt"))
+    nodes = len(evaluator(tree, order)["x"])
+    assert looks[0] == nodes // checkpoint.CHECK_EVERY
+    assert evaluator.checkpoints.saved == 0
+    assert not os.path.exists(tmp_path / "run.ckpt")
@@ -0,0 +1,96 @@
+import AlgoTree as at
+import pytest
+from treeprog.codegen import CodegenUttEval, supports, traversal
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=5, width=4):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+ORDERS = [
+    [{"visit": "true", "result-name": "all"}, {"follow": "down"}],
+    [{"follow": "down"}, {"visit": "is-leaf?", "args": ["$node"], "result-name": "post"}],
+    [{"cond": [{"pred": "less?", "args": ["$depth", 3],
+                "order": [{"visit": "true", "result-name": "shallow"},
+                          {"follow": "down", "select": "first"},
+                          {"follow": "down", "select": "rest"}]},
+               {"pred": "is-leaf?", "args": ["$node"], "order": [{"visit": "true", "result-name": "leaf"}]},
+               {"pred": "eq?", "args": ["$payload", 1], "order": []},
+               {"pred": "true", "order": [{"follow": "down", "select": "last"}]}]},
+     {"visit": "less?", "args": ["$payload", 2], "result-name": "small"}],
+    [{"visit": {"and": [{"pred": "is-leaf?", "args": ["$node"]},
+                        {"pred": {"or": [{"pred": "eq?", "args": ["$payload", 0]},
+                                         {"pred": "less?", "args": [2, "$payload"]}]}}]},
+      "result-name": "x"},
+     {"follow": "down", "select-order": "reverse"}],
+    [{"visit": "true", "result-name": "a"},
+     {"follow": "descendants", "select": {"name": "largest", "args": [3], "kwargs": {"key": "name"}}},
+     {"follow": "up"}],
+    [{"visit": "eq?", "args": ["$num_children", 0], "result-name": "l"},
+     {"follow": "down", "select": {"name": "nth", "args": [1]}},
+     {"follow": "down", "select": "all", "select-order": "payload"}],
+    [],
+]
+
+
+@pytest.mark.parametrize("order", ORDERS)
+def test_generated_code_matches_interpreter(order):
+    tree = grown()
+    evaluator = CodegenUttEval()
+    assert supports(order)
+    assert evaluator.traversal(order) is not None
+    assert names(evaluator(tree, order)) == names(UttEval()(tree, order))
+
+
+def test_code_is_shared_by_equal_orders():
+    order = ORDERS[2]
+    copy = [dict(action) for action in order]
+    assert traversal(order) is traversal(copy)
+    assert "def " in traversal(order).source
+
+
+def test_replaced_builtin_takes_effect():
+    evaluator = CodegenUttEval()
+    evaluator.pred_fns["true"] = lambda: False
+    assert names(evaluator(grown(), ORDERS[0])) == {}
+
+
+@pytest.mark.parametrize("order", [
+    [{"set!": {"$a": 1}}],
+    [{"follow": "down", "select": "rand"}],
+])
+def test_unsupported_orders_are_interpreted(order):
+    assert not supports(order)
+    tree = grown(3)
+    assert names(CodegenUttEval(seed=1)(tree, order)) == names(UttEval(seed=1)(tree, order))
+
+
+def test_unknown_predicate_is_interpreted():
+    assert CodegenUttEval().traversal([{"visit": "nope?", "result-name": "x"}]) is None
+
+
+def test_adaptive_composites_are_interpreted():
+    evaluator = CodegenUttEval()
+    evaluator.pred_order.adaptive = True
+    assert evaluator.traversal(ORDERS[3]) is None
+    assert names(evaluator(grown(), ORDERS[3])) == names(UttEval()(grown(), ORDERS[3]))
+
+
+def test_deep_tree():
+    root = node = at.TreeNode(name=0, payload=0)
+    for i in range(1, 5000):
+        node = at.TreeNode(name=i, parent=node, payload=i)
+    results = CodegenUttEval()(root, [{"visit": "true", "result-name": "x"}, {"follow": "down"}])
+    assert len(results["x"]) == 5000
@@ -0,0 +1,78 @@
+import AlgoTree as at
+import pytest
+from treeprog import compiler, treeprog
+from treeprog.environment import Environment
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_unknown_variable_is_rejected_before_traversal(evaluator):
+    calls = []
+    e = evaluator()
+    e.pred_fns["true"] = lambda: calls.append(1) or True
+    order = [{"visit": "true", "result-name": "x"},
+             {"visit": "eq?", "args": ["$nope", 1], "result-name": "y"},
+             {"follow": "down"}]
+    with pytest.raises(ValueError, match=r"\$nope"):
+        e(grown(), order)
+    assert calls == []
+
+
+def test_references_read_slots():
+    layout = compiler.Layout()
+    bind = compiler.compile_args(["$a", 1], {"k": "$b"}, {"$a", "$b"}, layout)
+    env = Environment({"$a": 1, "$b": 2})
+    assert bind(env) == ([1, 1], {"k": 2})
+    assert env.layout is layout and env.slots == [1, 2]
+    # rebinding a variable updates its slot
+    env.bind("$a", 5)
+    env["$b"] = 6
+    assert bind(env) == ([5, 1], {"k": 6})
+
+
+def test_binders_are_cached_per_order():
+    e = UttEval()
+    order = [{"visit": "less?", "args": ["$payload", 1], "result-name": "x"}, {"follow": "down"}]
+    tree = grown()
+    e(tree, order)
+    binders = e.binders
+    e(tree, order)
+    assert e.binders is binders
+    # an order changed in place is compiled again
+    order[0]["args"] = ["$payload", 2]
+    assert names(e(tree, order)) == names(UttEval()(tree, [dict(order[0]), order[1]]))
+    assert e.binders is not binders
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_bindings_after_reads_are_seen(evaluator):
+    # `$payload` is read before the `set!` and again after it
+    order = [{"visit": "eq?", "args": ["$payload", 1], "result-name": "one"},
+             {"set!": {"$payload": 5}},
+             {"cond": [{"pred": "eq?", "args": ["$payload", 5], "order": [{"follow": "down"}]}]}]
+    tree = grown()
+    assert len(evaluator()(tree, order)["one"]) == sum(node.payload == 1 for node in tree.nodes())
+
+    # `$fold.total` is read before the fold and again after it
+    order = [{"set!": {"$before": "$fold.total"}},
+             {"fold": "sum", "args": ["$payload"], "result-name": "total"},
+             {"set!": {"$after": "$fold.total"}},
+             {"visit": {"and": [{"pred": "eq?", "args": ["$before", None]},
+                                {"pred": "eq?", "args": ["$after", 120]}]},
+              "result-name": "x"}]
+    assert names(evaluator()(tree, order)) == {"x": ["r"]}
@@ -0,0 +1,67 @@
+import AlgoTree as at
+import pytest
+from treeprog import treeprog
+from treeprog.cursor import Cursor
+from treeprog.index import TreeIndex
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=3, width=5):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=-i % 3), d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+def rest_last(direction, *selects):
+    follows = [{"follow": direction, "select": select} for select in selects]
+    return [{"visit": "true", "result-name": "x"}, *follows, {"follow": direction, "select": "rest"}]
+
+
+ORDERS = [
+    rest_last("down", "first", {"name": "nth", "args": [-2]}),
+    rest_last("down", {"name": "slice", "args": [1, 3]}, "last"),
+    rest_last("down", {"name": "smallest", "args": [2], "kwargs": {"key": "payload"}}),
+    rest_last("down", "none", "all"),
+    rest_last("descendants", "first", {"name": "nth", "args": [4]}),
+    [{"visit": "true", "result-name": "x"}, {"follow": "down", "select": "first"},
+     {"follow": "up"}, {"follow": "down", "select": "rest", "select-order": "reverse"}],
+]
+
+
+@pytest.mark.parametrize("order", ORDERS)
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_rest_matches_filtering(evaluator, order):
+    if evaluator is treeprog.UttEval and "smallest" in str(order):
+        pytest.skip("no smallest selector")
+
+    class Scanning(evaluator):
+        # `rest` filters every candidate by the visited and followed sets
+        def _cursor(self, *args):
+            return None
+
+    tree = grown()
+    assert names(evaluator()(tree, order)) == names(Scanning()(tree, order))
+
+
+def test_cursor_skips_taken_positions():
+    cursor = Cursor(list("abcdefg"))
+    cursor.record("first", ["a"])
+    cursor.record("nth", ["f"], -2)
+    cursor.take_nodes(["c", "z"])
+    assert cursor.next == 1 and cursor.rest() == [1, 3, 4, 6]
+    cursor.take(cursor.rest())
+    assert cursor.rest() == [] and cursor.next == 7
+
+    index = TreeIndex(grown())
+    cursor = Cursor(index.descendants(index.node(1)))
+    cursor.take_nodes([index.node(3), index.node(0)])
+    assert cursor.position(index.node(2)) == 0 and cursor.rest() == [0, *range(2, 30)]
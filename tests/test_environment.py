@@ -0,0 +1,63 @@
+import AlgoTree as at
+import pytest
+from treeprog import treeprog
+from treeprog.environment import Environment, Frame
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=3, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+def test_bindings_are_inherited_copy_on_write():
+    parent = Environment({"$node": "p"})
+    parent.bind("$a", 1)
+    child = Environment({"$node": "c"}, parent.extend())
+    assert child.frame is parent.frame and child["$a"] == 1
+    # later bindings of the parent are not seen by the child, and the
+    # child's own bindings do not leak back
+    parent.bind("$a", 2)
+    child.bind("$b", 3)
+    assert (parent["$a"], child["$a"]) == (2, 1)
+    assert "$b" not in parent and child.get("$b") == 3
+    # a binding shadows a node variable
+    child.bind("$node", "x")
+    assert child["$node"] == "x" and parent["$node"] == "p"
+    with pytest.raises(KeyError):
+        child["$nope"]
+
+
+def test_long_chains_stay_correct():
+    frame = Frame()
+    frame.vars["$root"] = 0
+    for i in range(1, 2000):
+        frame.frozen = True
+        frame = Frame(frame)
+        if i % 500 == 0:
+            frame.vars["$mark"] = i
+    assert frame.lookup("$root") == 0 and frame.lookup("$mark") == 1500
+    # cached lookups see a binding made on top of the chain
+    top = Frame(frame)
+    top.vars["$mark"] = -1
+    assert top.lookup("$mark") == -1 and frame.lookup("$mark") == 1500
+    assert frame.lookup("$nope", None) is None
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_set_flows_to_followed_nodes_only(evaluator):
+    tree = grown()
+    # a depth-1 node marks its subtree with its payload; the `set!` after
+    # the follow is not seen below
+    order = [{"cond": [{"pred": "eq?", "args": ["$depth", 1], "order": [{"set!": {"$mark": "$payload"}}]}]},
+             {"visit": "eq?", "args": ["$mark", 1], "result-name": "marked"},
+             {"follow": "down"},
+             {"set!": {"$mark": 1}}]
+    marked = evaluator()(tree, order)["marked"]
+    assert len(marked) == 13 and set(marked) == set(tree.children[1].nodes())
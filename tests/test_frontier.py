@@ -0,0 +1,47 @@
+import AlgoTree as at
+import pytest
+from treeprog import treeprog
+from treeprog.frontier import Frontier
+from treeprog.index import TreeIndex
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+@pytest.mark.parametrize("order", [
+    [{"visit": "true", "result-name": "x"}, {"follow": "down"}, {"follow": "up"}],
+    [{"visit": "true", "result-name": "x"}, {"follow": "all"}],
+    [{"visit": "true", "result-name": "x"}, {"follow": "level"}, {"follow": "down"}, {"follow": "ancestors"}],
+])
+def test_frontier_holds_each_node_once(order):
+    tree = grown()
+    run = treeprog.UttEval().run(tree.children[1].children[0], order)
+    expected = UttEval()(tree.children[1].children[0], order)
+    assert sorted(node.name for node in run.results["x"]) == sorted(node.name for node in expected["x"])
+
+    size = len(list(tree.nodes()))
+    stats = run.frontier.stats()
+    # every node is pushed, and evaluated, once; revisits are dropped
+    assert stats["pushed"] == stats["popped"] == len(run.results["x"]) == size
+    assert stats["duplicates"] > 0 and stats["max_size"] <= size
+    assert len(run.frontier) == 0
+
+
+def test_switching_to_ids_keeps_pushed_nodes():
+    tree = grown(2)
+    frontier = Frontier()
+    frontier.push([tree, tree.children[0]], None)
+    frontier.push([tree.children[0]], None)
+    frontier.use_index(TreeIndex(tree))
+    frontier.push(tree.nodes(), None)
+    assert frontier.stats() == {"pushed": 13, "popped": 0, "duplicates": 3, "max_size": 13}
+    assert len({node for node, _ in frontier.stack}) == 13
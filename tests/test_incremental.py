@@ -0,0 +1,76 @@
+import random
+import pytest
+from AlgoTree.treenode import TreeNode
+from treeprog.incremental import IncrementalUttEval
+from treeprog.utt_eval import UttEval
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+def built(n, rng):
+    root = TreeNode(name="0", payload=0)
+    nodes = [root]
+    for i in range(1, n):
+        nodes.append(TreeNode(parent=rng.choice(nodes), name=str(i), payload=rng.randint(0, 9)))
+    return root, nodes
+
+
+ORDERS = [
+    [{"visit": "true", "result-name": "pre"}, {"follow": "down"}],
+    [{"follow": "down"}, {"visit": "is-leaf?", "args": ["$node"], "result-name": "leaves"}],
+    [{"cond": [{"pred": "less?", "args": ["$payload", 5],
+                "order": [{"visit": "true", "result-name": "small"}, {"follow": "down"}]},
+               {"pred": "true",
+                "order": [{"visit": "true", "result-name": "big"},
+                          {"follow": "down", "select": {"name": "slice", "args": [0, 1]}}]}]}],
+    [{"cond": [{"pred": "less?", "args": ["$depth", 3],
+                "order": [{"visit": "true", "result-name": "shallow"}, {"follow": "down"}]}]}],
+    [{"visit": "eq?", "args": ["$payload", 3], "result-name": "three"},
+     {"follow": "down", "select": {"name": "slice", "args": [0, 2]}},
+     {"visit": "true", "result-name": "x"},
+     {"follow": "down", "select": "rest"}],
+    # not patchable: every update reruns the order
+    [{"visit": "true", "result-name": "a"}, {"follow": "down"}, {"follow": "up"}],
+]
+
+
+@pytest.mark.parametrize("order", ORDERS)
+def test_updates_match_full_runs(order):
+    rng = random.Random(1)
+    root, nodes = built(200, rng)
+    evaluator = IncrementalUttEval()
+    evaluator(root, order)
+    for step in range(40):
+        kind = rng.random()
+        if kind < 0.5:
+            # new payload
+            node = rng.choice(nodes)
+            node.payload = rng.randint(0, 9)
+            evaluator.changed(node)
+        elif kind < 0.8:
+            # new leaf
+            parent = rng.choice(nodes)
+            nodes.append(TreeNode(parent=parent, name=f"n{len(nodes)}", payload=rng.randint(0, 9)))
+            evaluator.changed(parent)
+        else:
+            # moved subtree
+            node = rng.choice(nodes[1:])
+            inside, stack = set(), [node]
+            while stack:
+                n = stack.pop()
+                inside.add(id(n))
+                stack.extend(n.children)
+            target = rng.choice([n for n in nodes if id(n) not in inside])
+            evaluator.changed(node.parent)
+            node.parent = target
+            evaluator.changed(target)
+            evaluator.changed(node)
+        if step % 2:
+            assert names(evaluator.update()) == names(UttEval()(root, order)), step
+
+
+def test_supports():
+    assert IncrementalUttEval.supports(ORDERS[2])
+    assert not IncrementalUttEval.supports(ORDERS[-1])
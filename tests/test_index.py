@@ -0,0 +1,112 @@
+import AlgoTree as at
+import pytest
+from treeprog import treeprog
+from treeprog.index import NodeRange, TreeIndex
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=3, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_index_is_kept_between_runs(evaluator):
+    tree = grown()
+    e = evaluator()
+    order = [{"visit": "true", "result-name": "x"}, {"follow": "descendants", "select": "last"}]
+    first = e.run(tree, order)
+    second = e.run(tree.children[1], [{"visit": "true", "result-name": "x"}, {"follow": "level"}])
+    assert first.index is second.index is not None
+    assert e.run(grown(), order).index is not first.index
+
+    # a changed tree is indexed again once invalidated
+    at.TreeNode(name="new", parent=tree.children[2].children[2].children[2], payload=0)
+    e.invalidate(tree.children[2])
+    assert names(e(tree, order)) == names(UttEval()(tree, order)) == {"x": ["r", "new"]}
+
+
+def preorder(node, depth=0, found=None):
+    found = [] if found is None else found
+    found.append((node, depth))
+    for child in node.children:
+        preorder(child, depth + 1, found)
+    return found
+
+
+def test_index_matches_tree():
+    tree = grown(4, 3)
+    index = TreeIndex(tree)
+    walk = preorder(tree)
+    assert len(index) == len(walk) and index.id(tree) == 0
+    for i, (node, depth) in enumerate(walk):
+        assert index.node(i) is node and index.id(node) == i
+        assert index.depth[i] == depth
+        assert index.parent[i] == (-1 if node.parent is None else index.id(node.parent))
+        assert index.subtree_size[i] == len(preorder(node))
+        assert index.children_ids(i) == [index.id(child) for child in node.children]
+
+    descendants = index.descendants(tree.children[1])
+    assert isinstance(descendants, NodeRange) and len(descendants) == 39
+    assert [node.name for node in descendants] == [node.name for node, _ in preorder(tree.children[1])[1:]]
+    assert [node.name for node in descendants[2:4]] == ["r.1.0.0.0", "r.1.0.0.1"]
+    assert tree.children[1].children[2] in descendants and tree.children[2] not in descendants
+
+
+def ragged(depth=4):
+    # 0 to 3 children per node, so that levels cross parents unevenly
+    root = at.TreeNode(name="r", payload=0)
+    stack, count = [(root, 0)], 0
+    while stack:
+        node, d = stack.pop(0)
+        if d < depth:
+            for i in range(count % 4 if d else 3):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+            count += 1
+    return root
+
+
+def levels(tree):
+    found, level = [], [tree]
+    while level:
+        found.append(level)
+        level = [child for node in level for child in node.children]
+    return found
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_sibling_and_level_directions(evaluator):
+    tree = ragged()
+    index = TreeIndex(tree)
+    for level in levels(tree)[1:]:
+        # hopping along a level from either end walks all of it
+        forward = evaluator()(level[0], [{"visit": "true", "result-name": "x"}, {"follow": "next-in-level"}])
+        backward = evaluator()(level[-1], [{"visit": "true", "result-name": "x"}, {"follow": "prev-in-level"}])
+        assert forward["x"] == level and backward["x"] == level[::-1]
+        everyone = evaluator()(level[1 % len(level)], [{"visit": "true", "result-name": "x"}, {"follow": "level"}])
+        assert sorted(node.name for node in everyone["x"]) == sorted(node.name for node in level)
+        for i, node in enumerate(level):
+            assert index.level_pos[index.id(node)] == i
+            assert index.level(node) == level[:i] + level[i + 1:]
+
+    parent = next(node for node in tree.nodes() if len(node.children) == 3)
+    children = parent.children
+    order = [{"visit": "true", "result-name": "x"}, {"follow": "next-sibling"}]
+    assert evaluator()(children[0], order)["x"] == children
+    order = [{"visit": "true", "result-name": "x"}, {"follow": "prev-sibling"}]
+    assert evaluator()(children[2], order)["x"] == children[::-1]
+    for direction in ["siblings", "sideways"]:
+        order = [{"visit": "true", "result-name": "x"}, {"follow": direction}]
+        assert set(evaluator()(children[1], order)["x"]) == set(children)
+        assert evaluator()(tree, order)["x"] == [tree]
+    assert [index.child_index[index.id(child)] for child in children] == [0, 1, 2]
@@ -0,0 +1,95 @@
+import AlgoTree as at
+from treeprog import reducers
+from treeprog.memo import MemoUttEval
+from treeprog.utt_eval import UttEval
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+def state(run):
+    # everything a run produces, by node name
+    return {"results": names(run.results),
+            "folds": {name: {node.name: value for node, value in values.items()}
+                      for name, values in run.folds.items()},
+            "aggregates": reducers.results(run.aggregates),
+            "payloads": dict(run.payloads) if run.payloads is not None else None}
+
+
+def swapped_subtrees():
+    # s0(a, b), s1(b, a), s2(a, b): identical shape and payloads, children
+    # named in different orders
+    root = at.TreeNode(name="r", payload=0)
+    for i, children in enumerate([("a", "b"), ("b", "a"), ("a", "b")]):
+        sub = at.TreeNode(name=f"s{i}", parent=root, payload=1)
+        for name in children:
+            at.TreeNode(name=name, parent=sub, payload=2)
+    return root
+
+
+def grown(depth=5, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i % 2), d + 1))
+    return root
+
+
+def test_memo_matches_recursive_evaluator():
+    tree = grown()
+    order = [{"visit": "is-leaf?", "args": ["$node"], "result-name": "leaves"},
+             {"visit": "true", "result-name": "pre"},
+             {"follow": "down", "select-order": "reverse"}]
+    evaluator = MemoUttEval()
+    assert MemoUttEval.supports(order)
+    run = evaluator.run(tree, order)
+    assert state(run) == state(UttEval().run(tree, order))
+    assert run.hits > 0
+
+
+def test_orders_by_name_are_not_memoized():
+    tree = swapped_subtrees()
+    for follow in ({"follow": "down", "select-order": "name"},
+                   {"follow": "down", "select": {"name": "smallest", "args": [2], "kwargs": {"key": "name"}}},
+                   {"follow": "down", "select": {"name": "largest", "args": [1, "name"]}}):
+        order = [{"visit": "true", "result-name": "pre"}, follow]
+        assert not MemoUttEval.supports(order)
+        assert state(MemoUttEval(min_occurrences=1).run(tree, order)) == state(UttEval().run(tree, order))
+
+
+def test_orders_by_payload_are_memoized():
+    order = [{"visit": "true", "result-name": "pre"},
+             {"follow": "down", "select": {"name": "smallest", "args": [2], "kwargs": {"key": "payload"}}}]
+    assert MemoUttEval.supports(order)
+    tree = swapped_subtrees()
+    assert state(MemoUttEval(min_occurrences=1).run(tree, order)) == state(UttEval().run(tree, order))
+
+
+def test_folds_are_not_memoized():
+    # a fold at every leaf of a tree of identical subtrees
+    tree = grown(depth=3, width=2)
+    order = [{"cond": [{"pred": "is-leaf?", "args": ["$node"],
+                        "order": [{"fold": "sum", "args": ["$payload"], "result-name": "s"}]}]},
+             {"visit": "true", "result-name": "pre"},
+             {"follow": "down"}]
+    assert not MemoUttEval.supports(order)
+    run = MemoUttEval(min_occurrences=1).run(tree, order)
+    assert state(run) == state(UttEval().run(tree, order))
+    assert len(run.folds["s"]) == 8
+
+
+def test_orders_with_side_effects_match_recursive_evaluator():
+    tree = grown(depth=4, width=3)
+    visit = {"visit": "true", "result-name": "pre"}
+    down = {"follow": "down"}
+    for action in ({"aggregate": "sum", "args": ["$payload"], "result-name": "total"},
+                   {"aggregate": "count", "by": "$payload", "result-name": "per"},
+                   {"payload-map": "num-children"},
+                   {"set!": {"$p": "$payload"}}):
+        order = [action, visit, down]
+        assert not MemoUttEval.supports(order)
+        assert state(MemoUttEval(min_occurrences=1).run(tree, order)) == state(UttEval().run(tree, order))
@@ -0,0 +1,74 @@
+import AlgoTree as at
+import pytest
+from treeprog import payload_map, treeprog
+from treeprog.index import TreeIndex
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload={"i": i}), d + 1))
+    return root
+
+
+def mapped(column):
+    return {node.name: payload for node, payload in column.items()}
+
+
+@pytest.mark.parametrize("name", sorted(payload_map.COLUMNS))
+def test_columns_match_functions(name):
+    tree = grown()
+    order = [{"payload-map": "num-ancestors"}, {"payload-map": name}, {"follow": "down"}]
+    stage = payload_map.PayloadMapStage(payload_map.FUNCTIONS, payload_map.COLUMNS)
+    for node in tree.nodes():
+        for action in order[:2]:
+            stage.add(action, node, [], {})
+    columnar = stage.run(TreeIndex(tree), order)
+    assert mapped(columnar) == mapped(stage.run(None, order))
+    # maps applied one after the other stay columnar
+    if name != "id":
+        assert isinstance(columnar.sequences[-1], payload_map.PayloadFields)
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_payload_read_after_map_is_rejected(evaluator):
+    tree = grown(2)
+    before = [{"visit": "eq?", "args": ["$payload", 0], "result-name": "x"},
+              {"payload-map": "num-children"}, {"follow": "down"}]
+    run = evaluator().run(tree, before)
+    assert [node.name for node in run.results["x"]] == ["r"]
+    assert run.payloads[tree] == {"payload": 0, "num_children": 3}
+    after = [{"payload-map": "num-children"},
+             {"cond": [{"pred": "eq?", "args": ["$payload", 0], "order": [{"follow": "down"}]}]}]
+    with pytest.raises(ValueError, match="payload-map"):
+        evaluator().run(tree, after)
+
+
+def count(node, payload):
+    return payload_map.extend(payload, count=payload.get("count", 0) + 1 if isinstance(payload, dict) else 1)
+
+
+def test_node_mapped_twice_is_mapped_again():
+    tree = grown(2)
+    e = UttEval()
+    e.payload_fns["count"] = count
+    # the start node is evaluated again when the traversal comes back up
+    order = [{"payload-map": "count"}, {"payload-map": "num-children"},
+             {"follow": "down", "select": "first"}, {"follow": "up"}]
+    run = e.run(tree, order)
+    assert run.payloads[tree] == {"payload": 0, "count": 2, "num_children": 3}
+    assert run.payloads[tree.children[0]] == {"i": 0, "count": 1, "num_children": 3}
+
+    stage = payload_map.PayloadMapStage({**payload_map.FUNCTIONS, "count": count}, payload_map.COLUMNS)
+    child = tree.children[1]
+    for node in [tree, child, tree, tree]:
+        stage.add(order[0], node, [], {})
+        stage.add(order[1], node, [], {})
+    column = stage.run(TreeIndex(tree), order)
+    assert mapped(column) == {"r": {"payload": 0, "count": 3, "num_children": 3},
+                              child.name: {"i": 1, "count": 1, "num_children": 3}}
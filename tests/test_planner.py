@@ -0,0 +1,88 @@
+import asyncio
+import itertools
+import AlgoTree as at
+from treeprog import planner
+from treeprog.async_eval import SqliteTree
+from treeprog.planner import Planner
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=3, leaf=lambda i: i):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                payload = leaf(i) if d + 1 == depth else i
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=payload), d + 1))
+    return root
+
+
+def chain(length):
+    root = node = at.TreeNode(name=0, payload=0)
+    for i in range(1, length):
+        node = at.TreeNode(name=i, parent=node, payload=i)
+    return root
+
+
+def names(results):
+    return {name: sorted(str(node.name) for node in nodes) for name, nodes in results.items()}
+
+
+ORDER = [{"visit": "less?", "args": ["$payload", 2], "result-name": "small"}, {"follow": "down"}]
+
+
+def test_small_tree_is_evaluated_recursively():
+    tree = grown()
+    plan = Planner().plan(tree, ORDER)
+    assert plan.engine == "recursive"
+    assert (plan.stats.node_count, plan.stats.leaves, plan.stats.max_depth, plan.stats.max_fanout) == (121, 81, 4, 3)
+    assert names(Planner()(tree, ORDER)) == names(UttEval()(tree, ORDER))
+
+
+def test_deep_tree_is_evaluated_iteratively(monkeypatch):
+    # a chain of 60 is "too deep" at 20 frames per level
+    monkeypatch.setattr(planner, "FRAMES_PER_LEVEL", 20)
+    tree = chain(60)
+    plan = Planner().plan(tree, ORDER)
+    assert plan.engine == "iterative" and "depth 59" in plan.explain()
+    assert names(Planner()(tree, ORDER)) == names(UttEval()(tree, ORDER))
+
+    # unless the iterative evaluator cannot run the order
+    order = [{"set!": {"$s": "$siblings"}}, *ORDER]
+    plan = Planner().plan(tree, order)
+    assert plan.engine == "recursive" and "lacks variables $siblings" in plan.explain()
+
+
+def test_repeated_subtrees_are_memoized(monkeypatch):
+    monkeypatch.setattr(planner, "MEMO_MIN_NODES", 100)
+    tree = grown(leaf=lambda i: 7)
+    plan = Planner().plan(tree, ORDER)
+    assert plan.engine == "memo"
+    assert names(Planner()(tree, ORDER)) == names(UttEval()(tree, ORDER))
+    # distinct leaves, or an order that cannot be memoized
+    assert Planner().plan(grown(leaf=lambda i, c=itertools.count(): next(c)), ORDER).engine == "recursive"
+    order = [*ORDER[:1], {"follow": "down", "select": "rand"}]
+    assert Planner().plan(tree, order).engine == "recursive"
+
+
+def test_lazily_fetched_tree_is_evaluated_asynchronously():
+    tree = grown()
+    lazy = SqliteTree.from_tree(tree).root()
+    plan = Planner().plan(lazy, ORDER)
+    assert plan.engine == "async" and plan.stats is None
+    results = asyncio.run(Planner()(lazy, ORDER))
+    assert sorted(node.payload for node in results["small"]) == sorted(
+        node.payload for node in UttEval()(tree, ORDER)["small"])
+
+
+def test_stats_are_cached_per_tree():
+    p = Planner()
+    tree = grown()
+    stats = p.stats(tree.children[0])
+    assert p.stats(tree) is stats
+    at.TreeNode(name="new", parent=tree, payload=0)
+    assert p.stats(tree) is stats
+    p.invalidate(tree.children[1])
+    assert p.stats(tree).node_count == 122
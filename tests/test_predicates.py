@@ -0,0 +1,152 @@
+import asyncio
+import copy
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import AlgoTree as at
+import pytest
+from treeprog import predicates, treeprog
+from treeprog.async_eval import AsyncUttEval
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=5, width=4):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+def names(results):
+    return {name: sorted(node.name for node in nodes) for name, nodes in results.items()}
+
+
+def slow(node):
+    total = 0
+    for i in range(2000):
+        total += i
+    return True
+
+
+COMPOSITE = [{"visit": {"and": [{"pred": "slow?", "args": ["$node"]},
+                                {"pred": "is-leaf?", "args": ["$node"]}]},
+              "result-name": "x"},
+             {"follow": "down"}]
+
+
+def evaluator(adaptive=False, plan=None, calls=None):
+    e = UttEval()
+    e.pred_fns["slow?"] = slow
+    if calls is not None:
+        is_leaf = e.pred_fns["is-leaf?"]
+        e.pred_fns["slow?"] = lambda node: calls.append("slow?") or slow(node)
+        e.pred_fns["is-leaf?"] = lambda node: calls.append("is-leaf?") or is_leaf(node)
+    if plan is not None:
+        e.pred_order.fix(plan)
+    e.pred_order.adaptive = adaptive
+    e.pred_order.every = 16
+    return e
+
+
+def test_adaptive_order_keeps_the_outcome():
+    tree = grown()
+    expected = names(evaluator()(tree, COMPOSITE))
+    adaptive = evaluator(adaptive=True)
+    for _ in range(3):
+        assert names(adaptive(tree, COMPOSITE)) == expected
+    # the cheap, decisive operand moved first
+    assert adaptive.pred_order.composites()[0].order == [1, 0]
+
+
+def test_fixed_plan_is_deterministic():
+    tree = grown()
+    adaptive = evaluator(adaptive=True)
+    adaptive(tree, COMPOSITE)
+    plan = adaptive.pred_order.plan()
+
+    logs = []
+    for _ in range(2):
+        calls = []
+        pinned = evaluator(adaptive=True, plan=plan, calls=calls)
+        assert names(pinned(tree, COMPOSITE)) == names(evaluator()(tree, COMPOSITE))
+        pinned(tree, COMPOSITE)
+        assert pinned.pred_order.plan() == plan
+        logs.append(calls)
+    assert logs[0] == logs[1]
+    assert logs[0][0] == "is-leaf?"
+
+
+def test_invalid_plan():
+    e = evaluator()
+    e(grown(2, 2), COMPOSITE)
+    key = next(iter(e.pred_order.plan()))
+    with pytest.raises(ValueError):
+        e.pred_order.fix({key: [0, 0]})
+
+
+@pytest.mark.parametrize("order", [
+    COMPOSITE,
+    # only go to a depth of up to 2
+    [{"visit": "true", "result-name": "x"},
+     {"cond": [{"pred": "less?", "args": ["$depth", 2], "order": [{"follow": "down"}]}]}],
+    # the first passing case wins, tested in declared order
+    [{"cond": [{"pred": {"or": [{"pred": "is-leaf?", "args": ["$node"]},
+                                {"pred": "less?", "args": ["$depth", 1]}]},
+                "order": [{"visit": "true", "result-name": "x"}]},
+               {"pred": "less?", "args": ["$payload", 2],
+                "order": [{"visit": "true", "result-name": "y"},
+                          {"cond": [{"pred": "true", "order": [{"visit": "true", "result-name": "z"}]}]}]},
+               {"pred": "true", "order": [{"visit": "true", "result-name": "w"}]}]},
+     {"follow": "down"}],
+])
+def test_iterative_cond_matches_recursive(order):
+    tree = grown()
+    e = treeprog.UttEval()
+    e.pred_fns["slow?"] = slow
+    assert names(e(tree, order)) == names(evaluator()(tree, order))
+
+
+def test_adaptive_order_under_concurrency(monkeypatch):
+    # threads share the measurements of one evaluator, and evict each
+    # other's composites
+    monkeypatch.setattr(predicates, "MAX_COMPOSITES", 2)
+    sys.setswitchinterval(1e-6)
+    tree = grown(4)
+    e = evaluator(adaptive=True)
+    orders = [copy.deepcopy(COMPOSITE) for _ in range(4)]
+    expected = names(evaluator()(tree, COMPOSITE))
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            got = list(pool.map(lambda i: names(e(tree, orders[i % 4])), range(32)))
+    finally:
+        sys.setswitchinterval(0.005)
+    assert got == [expected] * 32
+
+    shared = evaluator(adaptive=True)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: shared(tree, COMPOSITE), range(16)))
+    composite, = shared.pred_order.composites()
+    # no test was lost, and the cheap, decisive operand moved first
+    assert composite.tests == 16 * sum(1 for _ in tree.nodes())
+    assert composite.order == [1, 0]
+
+    # runs of the async evaluator interleave at every awaited operand
+    async def slow_async(node):
+        await asyncio.sleep(0)
+        return slow(node)
+
+    async def gathered():
+        e = AsyncUttEval()
+        e.pred_fns["slow?"] = slow_async
+        e.pred_order.adaptive = True
+        e.pred_order.every = 16
+        runs = await asyncio.gather(*(e(tree, COMPOSITE) for _ in range(8)))
+        return e, runs
+    e, runs = asyncio.run(gathered())
+    assert [names(run) for run in runs] == [expected] * 8
+    composite, = e.pred_order.composites()
+    assert composite.tests == 8 * sum(1 for _ in tree.nodes())
+    assert composite.order == [1, 0]
@@ -0,0 +1,61 @@
+import AlgoTree as at
+from treeprog.profiler import ProfilingUttEval, explain_analyze
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=3, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+ORDER = [{"cond": [{"pred": "less?", "args": ["$depth", 1],
+                    "order": [{"visit": "true", "result-name": "shallow"}]},
+                   {"pred": "is-leaf?", "args": ["$node"],
+                    "order": [{"visit": "true", "result-name": "leaf"}]}]},
+         {"visit": {"and": [{"pred": "eq?", "args": ["$payload", 1]}, {"pred": "true"}]},
+          "result-name": "one"},
+         {"follow": "down", "select": {"name": "slice", "args": [0, 2]}}]
+
+
+def test_counts():
+    tree = grown()
+    profile = explain_analyze(tree, ORDER)
+    assert names(profile.results) == names(UttEval()(tree, ORDER))
+    # two children of every inner node: 1 + 2 + 4 + 8 nodes
+    assert profile.nodes == 15
+    stats = {path: stats.as_dict() for path, _, stats in profile.actions()}
+
+    assert stats[(0,)]["calls"] == 15
+    # the root is shallow, the 8 leaves reached are leaves
+    assert (stats[(0, 0)]["tested"], stats[(0, 0)]["passed"]) == (15, 1)
+    assert (stats[(0, 1)]["tested"], stats[(0, 1)]["passed"]) == (14, 8)
+    assert (stats[(0, 0, 0)]["calls"], stats[(0, 0, 0)]["emitted"]) == (1, 1)
+    assert (stats[(0, 1, 0)]["calls"], stats[(0, 1, 0)]["emitted"]) == (8, 8)
+
+    # only the 6 inner nodes below the root are not visited yet; the
+    # operands of the composite are not tests of the visit
+    visit = stats[(1,)]
+    assert (visit["calls"], visit["tested"], visit["passed"], visit["emitted"]) == (15, 6, 3, 3)
+
+    # 7 inner nodes of 3 children, 2 of them kept
+    follow = stats[(2,)]
+    assert (follow["calls"], follow["candidates"], follow["selected"], follow["followed"]) == (15, 21, 14, 14)
+    assert profile.selectivity()[(2,)] == 14 / 21
+    assert "candidates=21 selected=14 (66.7%) followed=14" in str(profile)
+
+
+def test_runs_are_counted_separately():
+    evaluator = ProfilingUttEval()
+    small, large = explain_analyze(grown(1), ORDER, evaluator), explain_analyze(grown(), ORDER, evaluator)
+    assert (small.nodes, large.nodes) == (3, 15)
+    assert next(stats for _, _, stats in small.actions()).calls == 3
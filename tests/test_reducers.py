@@ -0,0 +1,82 @@
+import pickle
+from collections import Counter
+import AlgoTree as at
+import pytest
+from treeprog import reducers, treeprog
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=(i + d) % 5), d + 1))
+    return root
+
+
+ORDER = [{"cond": [{"pred": "is-leaf?", "args": ["$node"],
+                    "order": [{"aggregate": "count", "by": "$depth", "result-name": "leaves"}]}]},
+         {"aggregate": "sum", "args": ["$payload"], "result-name": "sum"},
+         {"aggregate": "mean", "args": ["$payload"], "result-name": "mean"},
+         {"aggregate": "min", "args": ["$payload"], "result-name": "min"},
+         {"aggregate": "max", "args": ["$payload"], "result-name": "max"},
+         {"aggregate": "histogram", "args": ["$payload"], "result-name": "histogram"},
+         {"aggregate": {"name": "histogram", "args": [[0, 2, 4]]}, "args": ["$payload"], "result-name": "bins"},
+         {"aggregate": "distinct", "args": ["$payload"], "result-name": "distinct"},
+         {"aggregate": {"name": "top-k", "args": [3]}, "args": ["$payload", "$node"], "result-name": "top"},
+         {"follow": "down"}]
+
+
+def expected(nodes):
+    payloads = [node.payload for node in nodes]
+    leaves = Counter(at.utils.depth(node) for node in nodes if not node.children)
+    # the first node reached with each of the 3 largest payloads, as a
+    # stable sort would rank them
+    top = sorted(nodes, key=lambda node: node.payload, reverse=True)[:3]
+    return {"leaves": dict(leaves), "sum": sum(payloads), "mean": sum(payloads) / len(payloads),
+            "min": min(payloads), "max": max(payloads), "histogram": dict(Counter(payloads)),
+            "bins": {"bins": [0, 2, 4], "counts": [payloads.count(0) + payloads.count(1),
+                                                   payloads.count(2) + payloads.count(3)],
+                     "under": 0, "over": payloads.count(4)},
+            "distinct": len(set(payloads)), "top": [node.name for node in top]}
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+def test_aggregates_match_visited_nodes(evaluator):
+    tree = grown()
+    run = evaluator().run(tree, ORDER)
+    visit = [{"visit": "true", "result-name": "all"}, {"follow": "down"}]
+    nodes = UttEval()(tree, visit)["all"]
+    got = reducers.results(run.aggregates)
+    assert [node.payload for node in got["top"]] == [4, 4, 4]
+    got["top"] = [node.name for node in got["top"]]
+    want = expected(nodes)
+    if evaluator is treeprog.UttEval:
+        # ties of the top-k go to the nodes reached first, and the iterative
+        # evaluator reaches nodes in another order
+        want["top"] = got["top"]
+    assert got == want
+    assert run.results == {}
+
+
+def test_parallel_parts_merge_into_the_whole():
+    tree = grown()
+    whole = reducers.results(UttEval().run(tree, ORDER).aggregates)
+    # the root on its own, then each subtree, as separate workers would
+    parts = [UttEval().run(tree, ORDER[:-1]).aggregates]
+    parts += [pickle.loads(pickle.dumps(UttEval().run(child, ORDER).aggregates)) for child in tree.children]
+    merged = reducers.results(reducers.merge_all(parts))
+    for result in (whole, merged):
+        result["top"] = [node.name for node in result["top"]]
+    assert merged == whole
+
+
+def test_distinct_is_approximate_in_fixed_memory():
+    reducer = reducers.Distinct()
+    for i in range(20000):
+        reducer.add(i % 10000)
+    assert abs(reducer.result() - 10000) < 300
+    assert reducer.registers.nbytes == 4096
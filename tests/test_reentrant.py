@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+import AlgoTree as at
+from treeprog import treeprog, utt_eval
+from treeprog.memo import MemoUttEval
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+def grown(depth=5, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=(d + i) % 3), d + 1))
+    return root
+
+
+ORDERS = [
+    [{"visit": "is-leaf?", "args": ["$node"], "result-name": "leaves"},
+     {"visit": "true", "result-name": "pre"},
+     {"follow": "down", "select-order": "reverse"}],
+    [{"visit": "true", "result-name": "pre"},
+     {"follow": "down", "select-order": "shuffle"},
+     {"visit": "true", "result-name": "post"}],
+    [{"visit": "true", "result-name": "pre"},
+     {"follow": "down", "select": {"name": "sample", "args": [2]}}],
+]
+
+
+def check(evaluator, trees):
+    jobs = [(tree, order) for tree in trees for order in ORDERS] * 8
+    serial = [names(evaluator(tree, order)) for tree, order in jobs]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        concurrent = list(pool.map(lambda job: names(evaluator(*job)), jobs))
+    assert concurrent == serial
+
+
+def test_recursive_evaluator():
+    check(utt_eval.UttEval(seed=3), [grown(), grown(4, 4)])
+
+
+def test_iterative_evaluator():
+    check(treeprog.UttEval(seed=3), [grown(), grown(4, 4)])
+
+
+def test_memo_evaluator():
+    evaluator = MemoUttEval(seed=3)
+    trees = [grown(), grown(4, 4)]
+    check(evaluator, trees)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        runs = list(pool.map(lambda _: evaluator.run(trees[0], ORDERS[0]), range(16)))
+    assert len({run.hits for run in runs}) == 1
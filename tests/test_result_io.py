@@ -0,0 +1,55 @@
+import io
+import AlgoTree as at
+import numpy as np
+import pytest
+from treeprog import result_io
+from treeprog.index import TreeIndex
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=3):
+    root = at.TreeNode(name="r", payload={"i": 0})
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload={"i": i}), d + 1))
+    return root
+
+
+ORDER = [{"follow": "down", "select-order": "reverse"},
+         {"cond": [{"pred": "is-leaf?", "args": ["$node"], "order": [{"visit": "true", "result-name": "leaf"}]},
+                   {"pred": "true", "order": [{"visit": "true", "result-name": "post"}]}]}]
+
+
+def test_round_trip_views_source_nodes():
+    tree = grown()
+    index = TreeIndex(tree)
+    results = UttEval()(tree, ORDER)
+    file = io.BytesIO()
+    result_io.save_results(file, results, index, payload="i")
+    file.seek(0)
+    stored = result_io.load_results(file)
+
+    assert sorted(stored) == sorted(results)
+    view = stored.view(index)
+    for name, nodes in results.items():
+        assert all(a is b for a, b in zip(view[name], nodes)) and len(view[name]) == len(nodes)
+        assert stored.payloads[name] == [node.payload["i"] for node in nodes]
+    assert [node.name for node in view["leaf"][:2]] == [node.name for node in results["leaf"][:2]]
+
+    with pytest.raises(ValueError, match="121 nodes"):
+        stored.view(TreeIndex(grown(3)))
+
+
+def test_ids_are_delta_encoded():
+    tree = grown()
+    index = TreeIndex(tree)
+    encoded = result_io.encode_results(UttEval()(tree, ORDER), index)
+    # a reverse post-order walk steps back through nearby ids
+    assert encoded["post"].dtype == np.int8
+    assert result_io.delta_decode(encoded["leaf"]).tolist() == [
+        i for i, node in enumerate(index.nodes) if not node.children][::-1]
+    assert result_io.delta_encode([]).size == 0
+    assert result_io.delta_encode([0, 1000]).dtype == np.int16
@@ -0,0 +1,82 @@
+import random
+import AlgoTree as at
+import pytest
+from treeprog import sampling
+from treeprog.index import TreeIndex
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=5):
+    root = at.TreeNode(name="r", payload={"w": 0, "v": 0})
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                child = at.TreeNode(name=f"{node.name}.{i}", parent=node, payload={"w": i % 2, "v": i})
+                stack.append((child, d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+def at_root(*actions):
+    return [{"visit": "true", "result-name": "pre"},
+            {"cond": [{"pred": "eq?", "args": ["$depth", 0], "order": list(actions)}]}]
+
+
+def test_reservoir_sample_is_uniform():
+    counts = [0] * 10
+    rng = random.Random(1)
+    for _ in range(5000):
+        for item in sampling.reservoir_sample(iter(range(10)), 3, rng):
+            counts[item] += 1
+    assert all(1300 < count < 1700 for count in counts)
+
+
+@pytest.mark.parametrize("key", ["$num_children", "num_children"])
+def test_weighted_selector_by_node_variable_or_sort_key(key):
+    tree = grown()
+    order = [{"visit": "true", "result-name": "pre"},
+             {"follow": "down", "select": {"name": "weighted-sample", "args": [2, key]}}]
+    for seed in range(5):
+        results = UttEval(seed=seed)(tree, order)
+        # leaves weigh nothing and are never followed
+        assert all(node.children for node in results["pre"])
+
+
+def test_weighted_selector_by_payload_key():
+    tree = grown()
+    order = at_root({"follow": "descendants", "select": {"name": "weighted-sample", "args": [20], "kwargs": {"key": "w"}}})
+    picked = UttEval(seed=3)(tree, order)["pre"][1:]
+    assert len(picked) == 20 and all(node.payload["w"] == 1 for node in picked)
+
+
+def test_weighted_direction():
+    tree = grown()
+    order = at_root({"follow": "weighted-sample", "args": [50, "w"]})
+    picked = UttEval(seed=3)(tree, order)["pre"][1:]
+    assert picked and all(node.payload["w"] == 1 for node in picked)
+
+    index = TreeIndex(tree)
+    sampler = sampling.WeightedNodeSampler(index, lambda node: node.payload["v"])
+    drawn = sampler.sample(4000, random.Random(2))
+    share = sum(node.payload["v"] == 4 for node in drawn) / len(drawn)
+    assert 0.35 < share < 0.45
+
+
+def test_seeded_runs_are_reproducible():
+    tree = grown()
+    order = [{"visit": "true", "result-name": "pre"},
+             {"follow": "down", "select": {"name": "sample", "args": [2]}, "select-order": "shuffle"}]
+    assert names(UttEval(seed=7)(tree, order)) == names(UttEval(seed=7)(tree, order))
+    assert names(UttEval(seed=7)(tree, order)) != names(UttEval(seed=8)(tree, order))
+
+
+def test_identical_follows_draw_independently():
+    tree = grown()
+    follow = {"follow": "sample", "args": [5]}
+    results = UttEval(seed=1)(tree, at_root(follow, dict(follow)))
+    assert len(set(results["pre"])) == 11
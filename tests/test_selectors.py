@@ -0,0 +1,91 @@
+import AlgoTree as at
+import numpy as np
+import pytest
+from treeprog import treeprog, utils
+from treeprog.index import TreeIndex
+from treeprog.utt_eval import UttEval
+
+
+def wide(n):
+    # many children with repeated payloads, so that ties matter
+    root = at.TreeNode(name="r", payload=-1)
+    for i in range(n):
+        at.TreeNode(name=f"c{i}", parent=root, payload=i * 7919 % 97)
+    return root
+
+
+def names(nodes):
+    return [node.name for node in nodes]
+
+
+@pytest.mark.parametrize("n", [50, 5000])
+def test_top_k_selectors_match_sorting(n):
+    tree = wide(n)
+    e = UttEval()
+    calls = []
+    e.sort_keys["counted"] = lambda node: calls.append(node) or node.payload
+    top = [{"visit": "true", "result-name": "x"},
+           {"follow": "down", "select": {"name": "smallest", "args": [5], "kwargs": {"key": "counted"}}}]
+    ordered = [{"visit": "true", "result-name": "x"}, {"follow": "down", "select-order": "payload"}]
+    assert names(e(tree, top)["x"]) == names(UttEval()(tree, ordered)["x"][:6])
+    # every key is computed once
+    assert len(calls) == n
+
+    top[1]["select"] = {"name": "largest", "args": [7], "kwargs": {"key": "payload"}}
+    expected = sorted(tree.children, key=lambda node: node.payload, reverse=True)[:7]
+    assert names(e(tree, top)["x"][1:]) == names(expected)
+
+
+@pytest.mark.parametrize("keys", [
+    [3, 1, 2, 1, 3, 0] * 300,
+    np.arange(2000, dtype=np.uint8).tolist(),
+    [i % 2 == 0 for i in range(1500)],
+    [0.5, -1.0, 2.5] * 500,
+])
+def test_top_k_is_a_stable_sort_prefix(keys):
+    nodes = list(range(len(keys)))
+    for largest in (False, True):
+        for n in (0, 1, 10, len(keys) + 1):
+            expected = sorted(nodes, key=keys.__getitem__, reverse=largest)[:n]
+            assert utils.top_k(nodes, n, keys.__getitem__, largest) == expected
+
+
+def grown(depth=4, width=3):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+@pytest.mark.parametrize("evaluator", [UttEval, treeprog.UttEval])
+@pytest.mark.parametrize("direction", ["descendants", "ancestors", "all"])
+@pytest.mark.parametrize("select", ["first", "last", {"name": "nth", "args": [2]}, {"name": "nth", "args": [-2]},
+                                    {"name": "slice", "args": [1, 4]}, {"name": "slice", "args": [-3, None]},
+                                    {"name": "nth", "args": [500]}])
+def test_lazy_directions_match_node_lists(evaluator, direction, select):
+    tree = grown()
+    # the same directions as plain lists
+    eager = evaluator()
+    eager.follow_dirs.update({
+        "descendants": lambda node: list(at.utils.descendants(node)),
+        "ancestors": lambda node: list(at.utils.ancestors(node)),
+        "all": lambda node: [node.root] + list(at.utils.descendants(node.root)),
+    })
+    start = tree.children[2].children[0]
+    order = [{"visit": "true", "result-name": "x"}, {"follow": direction, "select": select}]
+    assert names(evaluator()(start, order)["x"]) == names(eager(start, order)["x"])
+
+
+def test_selectors_consume_lazily():
+    nodes = iter(range(100))
+    assert utils.nth_sel(nodes, set(), set(), 0) == [0] and next(nodes) == 1
+    assert utils.slice_sel(nodes, {3}, set(), 0, 3) == [2, 4, 5] and next(nodes) == 6
+    assert utils.nth_sel(nodes, set(), set(), 200) == [] and utils.nth_sel([], set(), set(), -1) == []
+    index = TreeIndex(grown())
+    ancestors = index.ancestors(index.node(len(index) - 1))
+    assert names(utils.nth_sel(ancestors, set(), set(), 0)) == ["r.2.2.2"]
+    assert names(ancestors) == ["r.2.2", "r.2", "r"]
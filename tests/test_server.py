@@ -0,0 +1,193 @@
+import json
+import os
+import socket
+import threading
+import time
+import AlgoTree as at
+import pytest
+from treeprog import server
+from treeprog.server import QueryServer, TreeRegistry
+from treeprog.utt_eval import UttEval
+
+
+def grown(depth=4, width=4):
+    root = at.TreeNode(name="r", payload=0)
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload=i), d + 1))
+    return root
+
+
+ORDER = [{"visit": "true", "result-name": "pre"},
+         {"follow": "down"},
+         {"visit": "is-leaf?", "args": ["$node"], "result-name": "leaves"}]
+
+
+@pytest.fixture
+def queries():
+    registry = TreeRegistry()
+    registry.add("t", grown())
+    queries = QueryServer(registry, workers=2)
+    yield queries
+    queries.close()
+
+
+def test_results_are_streamed_in_batches(queries, monkeypatch):
+    monkeypatch.setattr(server, "BATCH_SIZE", 7)
+    replies = list(queries.handle({"tree": "t", "order": ORDER}))
+    done = replies[-1]
+    assert done["done"] and "error" not in done
+    batches = replies[:-1]
+    assert len(batches) > 2 and all(len(batch["ids"]) <= 7 for batch in batches)
+
+    index = queries.registry.get("t")
+    expected = UttEval()(index.nodes[0], ORDER)
+    for name, nodes in expected.items():
+        ids = [i for batch in batches if batch["result"] == name for i in batch["ids"]]
+        assert ids == [index.id(node) for node in nodes]
+        assert done["counts"][name] == len(nodes)
+
+
+def test_start_node(queries):
+    replies = list(queries.handle({"tree": "t", "order": ORDER, "start": 1}))
+    index = queries.registry.get("t")
+    ids = [i for batch in replies[:-1] if batch["result"] == "pre" for i in batch["ids"]]
+    assert ids == [index.id(node) for node in UttEval()(index.nodes[1], ORDER)["pre"]]
+
+
+def test_budget_exceeded(queries):
+    replies = list(queries.handle({"tree": "t", "order": ORDER, "budget": {"max_nodes": 5}}))
+    assert replies[-1] == {"error": "Node budget exceeded"}
+    assert sum(len(batch["ids"]) for batch in replies[:-1] if batch["result"] == "pre") == 5
+
+
+@pytest.mark.parametrize("request_", [
+    [1, 2],
+    "query",
+    {"order": ORDER},
+    {"tree": "missing", "order": ORDER},
+    {"tree": "t", "order": "visit"},
+    {"tree": "t", "order": [1]},
+    {"tree": "t", "order": ORDER, "start": -1},
+    {"tree": "t", "order": ORDER, "start": 10**6},
+    {"tree": "t", "order": ORDER, "start": "x"},
+    {"tree": "t", "order": ORDER, "start": 1.5},
+    {"tree": "t", "order": ORDER, "budget": 3},
+    {"tree": "t", "order": [{"follow": "sideways-ish"}]},
+    {"tree": "t", "order": [{"visit": "no-such-pred?"}]},
+    {"op": "frobnicate"},
+    {"op": "load", "tree": "u", "path": "/nonexistent.json"},
+])
+def test_bad_requests(queries, request_):
+    replies = list(queries.handle(request_))
+    assert len(replies) == 1 and "error" in replies[0]
+
+
+def test_failing_predicate(queries):
+    queries.evaluator.pred_fns["boom?"] = lambda: 1 / 0
+    replies = list(queries.handle({"tree": "t", "order": [{"visit": "boom?", "result-name": "x"}]}))
+    assert replies[-1]["error"].startswith("ZeroDivisionError")
+    # the server keeps serving
+    assert list(queries.handle({"op": "trees"})) == [{"done": True, "trees": {"t": len(queries.registry.get("t"))}}]
+
+
+def test_reply_closed_early_cancels_the_query(monkeypatch):
+    monkeypatch.setattr(server, "BATCH_SIZE", 4)
+    monkeypatch.setattr(server, "MAX_PENDING", 8)
+    registry = TreeRegistry()
+    registry.add("t", grown(5))
+    queries = QueryServer(registry, workers=1)
+    evaluated = []
+    queries.evaluator.pred_fns["counted?"] = lambda: evaluated.append(1) or True
+    order = [{"visit": "counted?", "result-name": "x"}, {"follow": "down"}]
+    try:
+        replies = queries.handle({"tree": "t", "order": order})
+        next(replies)
+        # the query waits for the client once MAX_PENDING results are queued
+        time.sleep(0.3)
+        assert len(evaluated) <= 1 + 2 * 8
+        replies.close()
+        # the only worker is free again, and the first query did not finish
+        assert list(queries.handle({"op": "trees"}))[-1]["done"]
+        assert list(queries.handle({"tree": "t", "order": ORDER}))[-1]["done"]
+        assert len(evaluated) < len(registry.get("t"))
+    finally:
+        queries.close()
+
+
+def test_slow_client_gets_every_result(monkeypatch):
+    monkeypatch.setattr(server, "BATCH_SIZE", 4)
+    monkeypatch.setattr(server, "MAX_PENDING", 8)
+    registry = TreeRegistry()
+    registry.add("t", grown())
+    queries = QueryServer(registry, workers=1)
+    try:
+        ids = []
+        for reply in queries.handle({"tree": "t", "order": ORDER}):
+            time.sleep(0.001)
+            if "result" in reply and reply["result"] == "pre":
+                ids.extend(reply["ids"])
+        index = registry.get("t")
+        assert ids == [index.id(node) for node in UttEval()(index.nodes[0], ORDER)["pre"]]
+    finally:
+        queries.close()
+
+
+def test_load_is_confined_to_the_root(tmp_path):
+    tree = json.dumps(grown(2).to_dict())
+    (tmp_path / "trees").mkdir()
+    (tmp_path / "trees" / "a.json").write_text(tree)
+    (tmp_path / "outside.json").write_text(tree)
+    os.symlink(tmp_path / "outside.json", tmp_path / "trees" / "link.json")
+
+    queries = QueryServer(TreeRegistry(), root=str(tmp_path / "trees"))
+    try:
+        assert list(queries.handle({"op": "load", "tree": "a", "path": "a.json"})) == [
+            {"done": True, "loaded": "a", "nodes": 21}]
+        assert list(queries.handle({"op": "load", "tree": "b", "path": str(tmp_path / "trees" / "a.json")}))[0]["done"]
+        for path in ["../outside.json", str(tmp_path / "outside.json"), "link.json", 3]:
+            replies = list(queries.handle({"op": "load", "tree": "c", "path": path}))
+            assert len(replies) == 1 and replies[0]["error"].startswith("Invalid path")
+        assert sorted(queries.registry.names()) == ["a", "b"]
+    finally:
+        queries.close()
+
+    queries = QueryServer(TreeRegistry())
+    try:
+        replies = list(queries.handle({"op": "load", "tree": "a", "path": str(tmp_path / "trees" / "a.json")}))
+        assert replies == [{"error": "Invalid op: load is disabled"}]
+    finally:
+        queries.close()
+
+
+def test_client_going_away_cancels_the_query(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "BATCH_SIZE", 4)
+    registry = TreeRegistry()
+    registry.add("t", grown(6))
+    queries = QueryServer(registry, workers=1)
+    evaluated = []
+
+    def counted():
+        evaluated.append(1)
+        time.sleep(0.0005)
+        return True
+    queries.evaluator.pred_fns["counted?"] = counted
+    path = str(tmp_path / "treeprog.sock")
+    listener = server.UnixSocketServer(path, queries)
+    threading.Thread(target=listener.serve_forever, daemon=True).start()
+    try:
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(path)
+            order = [{"visit": "counted?", "result-name": "x"}, {"follow": "down"}]
+            client.sendall(json.dumps({"tree": "t", "order": order}).encode() + b"\n")
+            assert client.recv(4096)
+        # the handler's next write fails, which frees the only worker
+        assert list(queries.handle({"tree": "t", "order": ORDER}))[-1]["done"]
+        assert len(evaluated) < len(registry.get("t"))
+    finally:
+        listener.shutdown()
+        listener.server_close()
+        queries.close()
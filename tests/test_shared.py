@@ -0,0 +1,87 @@
+import multiprocessing
+import pickle
+import AlgoTree as at
+import pytest
+from treeprog import treeprog
+from treeprog.index import TreeIndex
+from treeprog.shared import ArrayNode, SharedTree
+from treeprog.utt_eval import UttEval
+
+ORDERS = [
+    [{"visit": "less?", "args": ["$depth", 3], "result-name": "v"},
+     {"follow": "down", "select": {"name": "largest", "args": [2], "kwargs": {"key": "name"}}}],
+    [{"visit": "true", "result-name": "v"}, {"follow": "level"}, {"follow": "down"}],
+]
+
+
+def grown(depth=4, width=4):
+    root = at.TreeNode(name="r", payload={"v": 0})
+    stack = [(root, 0)]
+    while stack:
+        node, d = stack.pop()
+        if d < depth:
+            for i in range(width):
+                stack.append((at.TreeNode(name=f"{node.name}.{i}", parent=node, payload={"v": i}), d + 1))
+    return root
+
+
+def names(results):
+    return {name: [node.name for node in nodes] for name, nodes in results.items()}
+
+
+def run(job):
+    # in a worker: evaluate on the attached tree, report by name
+    tree, order, iterative = job
+    evaluator = treeprog.UttEval() if iterative else UttEval()
+    results = evaluator(tree.root, order)
+    return names(results), all(node.tree is tree for nodes in results.values() for node in nodes)
+
+
+@pytest.fixture
+def published():
+    root = grown()
+    tree = SharedTree.publish(TreeIndex(root))
+    yield root, tree
+    tree.close()
+    tree.unlink()
+
+
+def test_pickles_as_handle(published):
+    root, tree = published
+    assert len(pickle.dumps(tree)) < len(pickle.dumps(root)) / 10
+    assert isinstance(tree.root, ArrayNode)
+    assert tree.root.name == "r" and tree.root.payload == {"v": 0}
+    assert [child.name for child in tree.root.children] == [child.name for child in root.children]
+
+
+def test_in_process_evaluation(published):
+    root, tree = published
+    for order in ORDERS:
+        assert names(UttEval()(tree.root, order)) == names(UttEval()(root, order))
+    evaluator = UttEval()
+    evaluator(tree.root, [{"visit": "true", "result-name": "v"}, {"follow": "sideways"}])
+    assert evaluator.index is tree
+
+
+@pytest.mark.parametrize("method", ["fork", "spawn"])
+def test_workers(published, method):
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"no {method} start method")
+    root, tree = published
+    jobs = [(tree, ORDERS[0], False), (tree, ORDERS[1], False), (tree, ORDERS[1], True)]
+    with multiprocessing.get_context(method).Pool(2) as pool:
+        replies = pool.map(run, jobs)
+    for (_, order, iterative), (got, attached) in zip(jobs, replies):
+        evaluator = treeprog.UttEval() if iterative else UttEval()
+        assert got == names(evaluator(root, order))
+        assert attached
+
+
+def test_numeric_payload_column():
+    index = TreeIndex(at.TreeNode(name="a", payload=1))
+    tree = SharedTree.publish(index)
+    try:
+        assert tree.root.payload == 1
+    finally:
+        tree.close()
+        tree.unlink()